@@ -19,6 +19,9 @@
 
 """GStreamer Development Utilities Common Data module."""
 
+import logging
+import threading
+
 import gi
 
 from gi.repository import GObject
@@ -34,6 +37,12 @@ class Dispatcher (object):
 
         pass
 
+    def call_main(self, func, *args):
+        """Call func with args from the main thread.  Processes use this for
+        anything that touches the UI, like notifying consumers."""
+
+        func(*args)
+
 
 class DefaultDispatcher (Dispatcher):
 
@@ -66,3 +75,69 @@ class GSourceDispatcher (Dispatcher):
 
         GObject.source_remove(self.source_id)
         self.source_id = None
+
+
+class ThreadedDispatcher (Dispatcher):
+
+    """Runs the iterator in a worker thread until it is exhausted or returns
+    False, without blocking the main loop.  Its return values only serve as
+    points where cancelling takes effect.  Work handed to call_main is run
+    from the main loop with idle_add, unless the dispatcher is cancelled or
+    called again by then.  The dispatcher itself should only be called and
+    cancelled from the main thread.
+
+    If the iterator raises an exception, it is logged and passed to
+    handle_error from the main loop, so that the caller can clean up (e.g.
+    remove its progress dialog) instead of waiting forever."""
+
+    def __init__(self):
+
+        Dispatcher.__init__(self)
+
+        self.logger = logging.getLogger("dispatcher")
+
+        self.__generation = 0
+        self.__worker = threading.local()
+
+    def __call__(self, iterator):
+
+        self.__generation += 1
+        thread = threading.Thread(target=self.__run,
+                                  args=(iterator, self.__generation,))
+        thread.daemon = True
+        thread.start()
+
+    def cancel(self):
+
+        self.__generation += 1
+
+    def call_main(self, func, *args):
+
+        generation = getattr(self.__worker, "generation", None)
+        if generation is None:
+            # Not called from a worker thread.
+            func(*args)
+            return
+
+        def idle_call():
+            if generation == self.__generation:
+                func(*args)
+            return False
+
+        GObject.idle_add(idle_call)
+
+    def handle_error(self, exc):
+
+        pass
+
+    def __run(self, iterator, generation):
+
+        self.__worker.generation = generation
+
+        try:
+            for result in iterator:
+                if not result or generation != self.__generation:
+                    break
+        except Exception as exc:
+            self.logger.exception("error in dispatched process")
+            self.call_main(self.handle_error, exc)
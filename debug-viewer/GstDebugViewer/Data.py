@@ -22,6 +22,11 @@
 import os
 import logging
 import re
+import struct
+import sys
+import threading
+import zlib
+from array import array
 
 # Nanosecond resolution (like Gst.SECOND)
 SECOND = 1000000000
@@ -131,18 +136,26 @@ debug_levels = [debug_level_none,
 
 # For stripping color codes:
 _escape = re.compile("\x1b\\[[0-9;]*m")
+# Most escape sequences in coloured logs are resets, which can be removed
+# without the (much slower) regular expression:
+_escape_reset = "\x1b[00m"
 
 
 def strip_escape(s):
 
-    # FIXME: This can be optimized further!
+    if not "\x1b" in s:
+        return s
 
+    s = s.replace(_escape_reset, "")
     while "\x1b" in s:
-        s = _escape.sub("", s)
+        s, count = _escape.subn("", s)
+        if count == 0:
+            # Stray escape character.
+            break
     return s
 
 
-def default_log_line_regex_():
+def default_log_line_regex_(ansi=True):
 
     # "DEBUG             "
     LEVEL = "([A-Z]+)\s+"
@@ -161,7 +174,11 @@ def default_log_line_regex_():
     OBJECT = "(?:<([^>]+)>)?"
     MESSAGE = "(.+)"
 
-    ANSI = "(?:\x1b\\[[0-9;]*m\\s*)*\\s*"
+    if ansi:
+        ANSI = "(?:\x1b\\[[0-9;]*m\\s*)*\\s*"
+    else:
+        # For lines without escape sequences (see strip_escape).
+        ANSI = "\\s*"
 
     # New log format:
     expressions = [TIME, ANSI, PID, ANSI, THREAD, ANSI, LEVEL, ANSI,
@@ -174,9 +191,9 @@ def default_log_line_regex_():
     return expressions
 
 
-def default_log_line_regex():
+def default_log_line_regex(ansi=True):
 
-    return re.compile("".join(default_log_line_regex_()))
+    return re.compile("".join(default_log_line_regex_(ansi)))
 
 
 class Producer (object):
@@ -195,6 +212,11 @@ class Producer (object):
         for consumer in self.consumers:
             consumer.handle_load_finished()
 
+    def have_lines_appended(self, start, stop):
+
+        for consumer in self.consumers:
+            consumer.handle_lines_appended(start, stop)
+
 
 class SortHelper (object):
 
@@ -224,10 +246,9 @@ class SortHelper (object):
         time_len = len(time_args(0))
 
         # We remember the previous insertion point. This gives a nice speed up
-        # for larger bubbles which are already sorted. TODO: In practice, log
-        # lines only get out of order across threads. Need to check if it pays
-        # to parse the thread here and maintain multiple insertion points for
-        # heavily interleaved parts of the log.
+        # for larger bubbles which are already sorted. Heavily interleaved logs
+        # are better handled by merging per-thread runs, see
+        # LineCache.merge_threads.
         pos = 0
         pos_time_string = ""
 
@@ -266,147 +287,2253 @@ class SortHelper (object):
             seek(save_offset)
 
 
+def _offsets_typecode():
+
+    # Python 2 has no "Q" typecode, but "L" is 64 bits wide on LP64 platforms.
+    for typecode in ("Q", "L",):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    raise ValueError("platform lacks a 64 bit array type")
+
+OFFSETS_TYPECODE = _offsets_typecode()
+TIMES_TYPECODE = OFFSETS_TYPECODE
+
+
+# Line indices, trigram indices and block files are kept in the cache
+# directory up to this total size.  When it is exceeded, prune_cache removes
+# the least recently used files.
+cache_max_size = 2 * 1024 * 1024 * 1024
+
+
+def cache_dir():
+    """Return the directory holding the line indices, trigram indices and
+    block files of the logs that were opened."""
+
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    if not cache_home:
+        cache_home = os.path.expanduser(os.path.join("~", ".cache"))
+
+    return os.path.join(cache_home, "gst-debug-viewer")
+
+
+def _cache_path(log_path, kind, suffix):
+
+    from hashlib import sha1
+
+    name = sha1(log_path).hexdigest() + suffix
+
+    return os.path.join(cache_dir(), kind, name)
+
+
+def _touch_cache_file(path):
+
+    # The modification time tells prune_cache which files were used last.
+    try:
+        os.utime(path, None)
+    except EnvironmentError:
+        pass
+
+
+def prune_cache(max_size=None, keep=()):
+    """Remove the least recently used files of the cache directory until the
+    remaining ones take at most max_size bytes (cache_max_size by default).
+    Passing 0 clears the cache.  The paths in keep are not removed.  Returns
+    the number of removed files."""
+
+    logger = logging.getLogger("cache")
+
+    if max_size is None:
+        max_size = cache_max_size
+
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(cache_dir()):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except EnvironmentError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path,))
+    entries.sort()
+
+    total_size = sum((size for mtime, size, path in entries))
+    removed = 0
+    for mtime, size, path in entries:
+        if total_size <= max_size:
+            break
+        if path in keep:
+            continue
+        try:
+            os.unlink(path)
+        except EnvironmentError as exc:
+            logger.warning("cannot remove cache file %r: %s", path, exc)
+            continue
+        total_size -= size
+        removed += 1
+
+    if removed:
+        logger.debug("removed %i files from the cache", removed)
+    return removed
+
+
+class LineIndexFile (object):
+
+    """Sidecar file holding the line index of a log file.
+
+    The index is stored in the user cache directory, or next to the log file
+    if next_to_log is set (falling back to the cache directory if that is not
+    writable).  It is only used if the size, modification time and checksums
+    of the head and tail of the log still match.  Saving an index prunes the
+    cache directory, see prune_cache."""
+
+    suffix = ".gstdv-index"
+    magic = "GSTDVIDX"
+    version = 2
+
+    next_to_log = False
+
+    # magic, byte order, offset item size, version, log size, log mtime, head
+    # checksum, tail checksum, number of lines.
+    _header = struct.Struct("=8sBBxxIQdIIQ")
+    _check_size = 64 * 1024
+
+    def __init__(self, log_path):
+
+        self.logger = logging.getLogger("lineindex")
+
+        self.log_path = log_path
+        self.paths = [_cache_path(log_path, "index", self.suffix)]
+        if self.next_to_log:
+            self.paths.insert(0, log_path + self.suffix)
+
+    def _get_key(self, fileobj):
+
+        stat = os.stat(self.log_path)
+        size = len(fileobj)
+        n = self._check_size
+        head_crc = zlib.crc32(fileobj[:n]) & 0xffffffff
+        tail_crc = zlib.crc32(fileobj[max(size - n, 0):size]) & 0xffffffff
+
+        return (size, stat.st_mtime, head_crc, tail_crc,)
+
+    def _pack_header(self, key, n_lines):
+
+        return self._header.pack(self.magic,
+                                 sys.byteorder == "little",
+                                 array(OFFSETS_TYPECODE).itemsize,
+                                 self.version,
+                                 *(key + (n_lines,)))
+
+    def _read(self, fileobj, read_func):
+        """Return read_func (index_file, n_lines) for the first matching index
+        file, or None if there is no usable one.  read_func may raise
+        EnvironmentError or EOFError for files that cannot be read, and return
+        None for stale ones."""
+
+        try:
+            key = self._get_key(fileobj)
+        except EnvironmentError as exc:
+            self.logger.warning("cannot stat log file: %s", exc)
+            return None
+
+        header_size = self._header.size
+        for path in self.paths:
+            try:
+                index_file = open(path, "rb")
+            except EnvironmentError:
+                continue
+            try:
+                header = index_file.read(header_size)
+                if len(header) != header_size:
+                    continue
+                n_lines = self._header.unpack(header)[-1]
+                if header != self._pack_header(key, n_lines):
+                    self.logger.debug("index file %r is stale", path)
+                    continue
+                result = read_func(index_file, n_lines)
+            except (EnvironmentError, EOFError,) as exc:
+                self.logger.warning("cannot read index file %r: %s", path, exc)
+                continue
+            finally:
+                index_file.close()
+            if result is None:
+                self.logger.debug("index file %r is stale", path)
+                continue
+
+            _touch_cache_file(path)
+
+            self.logger.debug("loaded %i lines from index file %r",
+                              n_lines, path)
+            return result
+
+        return None
+
+    def _write(self, fileobj, n_lines, write_func):
+        """Write an index file with the header for n_lines, followed by what
+        write_func (index_file) writes."""
+
+        from tempfile import mkstemp
+
+        try:
+            key = self._get_key(fileobj)
+        except EnvironmentError as exc:
+            self.logger.warning("cannot stat log file: %s", exc)
+            return
+
+        for path in self.paths:
+            dirname, basename = os.path.split(path)
+            try:
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                fd, temp_path = mkstemp(prefix=basename + "-tmp", dir=dirname)
+            except EnvironmentError:
+                continue
+            try:
+                index_file = os.fdopen(fd, "wb")
+                try:
+                    index_file.write(self._pack_header(key, n_lines))
+                    write_func(index_file)
+                finally:
+                    index_file.close()
+                os.rename(temp_path, path)
+            except EnvironmentError as exc:
+                self.logger.warning("cannot write index file %r: %s",
+                                    path, exc)
+                try:
+                    os.unlink(temp_path)
+                except EnvironmentError:
+                    pass
+                continue
+
+            self.logger.debug("saved %i lines to index file %r",
+                              n_lines, path)
+            prune_cache(keep=(path,))
+            return
+
+    def load(self, fileobj):
+        """Return (offsets, levels, times) from a matching index file, or None
+        if there is no usable index."""
+
+        def read(index_file, n_lines):
+            offsets = array(OFFSETS_TYPECODE)
+            offsets.fromfile(index_file, n_lines)
+            levels = array("B")
+            levels.fromfile(index_file, n_lines)
+            times = array(TIMES_TYPECODE)
+            times.fromfile(index_file, n_lines)
+            return (offsets, levels, times,)
+
+        return self._read(fileobj, read)
+
+    def save(self, fileobj, offsets, levels, times):
+
+        def write(index_file):
+            offsets.tofile(index_file)
+            levels.tofile(index_file)
+            times.tofile(index_file)
+
+        self._write(fileobj, len(offsets), write)
+
+
+def _iter_zstd_frames(fileobj, read_size):
+    """Read the zstd frames of fileobj and yield them in (data, frame_start)
+    pieces of about read_size bytes.  frame_start is True for the first piece
+    of a frame.  Skippable frames are left out."""
+
+    def read(size):
+        data = fileobj.read(size)
+        if len(data) != size:
+            raise EOFError("truncated zstd frame")
+        return data
+
+    while True:
+        magic = fileobj.read(4)
+        if not magic:
+            return
+        elif len(magic) != 4:
+            raise EOFError("truncated zstd frame")
+
+        magic_number, = struct.unpack("<I", magic)
+        if magic_number & 0xfffffff0 == 0x184d2a50:
+            # Skippable frame.
+            frame_size, = struct.unpack("<I", read(4))
+            read(frame_size)
+            continue
+        elif magic_number != 0xfd2fb528:
+            raise IOError("invalid zstd frame magic %#x" % (magic_number,))
+
+        descriptor = read(1)
+        flags = ord(descriptor)
+        single_segment = flags >> 5 & 1
+        # Window descriptor, dictionary ID and frame content size fields:
+        header_size = ((not single_segment) + (0, 1, 2, 4,)[flags & 3] +
+                       (single_segment, 2, 4, 8,)[flags >> 6])
+        pieces = [magic, descriptor, read(header_size)]
+        pending_size = 5 + header_size
+        frame_start = True
+
+        last_block = False
+        while not last_block:
+            block_header = read(3)
+            value, = struct.unpack("<I", block_header + "\0")
+            last_block = value & 1
+            block_type = value >> 1 & 3
+            if block_type == 1:
+                # RLE block, a single byte repeated (size) times.
+                block_size = 1
+            elif block_type == 3:
+                raise IOError("invalid zstd block type")
+            else:
+                block_size = value >> 3
+            pieces.append(block_header)
+            pieces.append(read(block_size))
+            pending_size += 3 + block_size
+            if pending_size >= read_size and not last_block:
+                yield ("".join(pieces), frame_start,)
+                pieces = []
+                pending_size = 0
+                frame_start = False
+
+        if flags & 4:
+            # Content checksum.
+            pieces.append(read(4))
+        yield ("".join(pieces), frame_start,)
+
+
+class BlockFile (object):
+
+    """Random access to the contents of a compressed log file.
+
+    On first use, the log is decompressed once and stored in the user cache
+    directory as independently compressed blocks of block_size bytes, along
+    with a table of block offsets.  Reading any position then only needs to
+    decompress a single block.  The block file is reused as long as the size,
+    modification time and head checksum of the compressed log still match.
+
+    Supports the part of the mmap interface used for log files: len, slicing,
+    find, rfind, seek, tell, read, readline and close.  If the block file
+    cannot be created in the cache directory, an anonymous temporary file is
+    used instead and path is set to None."""
+
+    suffix = ".gstdv-blocks"
+    magic = "GSTDVBLK"
+    version = 1
+    block_size = 4 * 1024 * 1024
+
+    formats = (("\x1f\x8b", "gzip",),
+               ("\xfd7zXZ\x00", "xz",),
+               ("\x28\xb5\x2f\xfd", "zstd",),)
+
+    # magic, version, block size, log size, log mtime, head checksum,
+    # uncompressed size, number of blocks.
+    _header = struct.Struct("=8sIIQdIQQ")
+    _check_size = 64 * 1024
+    _read_size = 1024 * 1024
+    _cached_blocks = 4
+
+    def __init__(self, log_path):
+
+        self.logger = logging.getLogger("blockfile")
+
+        self.log_path = log_path
+        self.path = _cache_path(log_path, "blocks", self.suffix)
+
+        log_fileobj = open(log_path, "rb")
+        try:
+            self.format = self.detect(log_fileobj)
+            if self.format is None:
+                raise IOError("%s is not a compressed file" % (log_path,))
+            self.__key = self.__get_key(log_fileobj)
+        finally:
+            log_fileobj.close()
+
+        # Fail early if the decompressor is not available:
+        self.__new_decompressor()
+
+        self.__build_progress = 0.
+        self.__fileobj = None
+        self.__size = 0
+        self.__pos = 0
+        self.__data_start = self._header.size
+        self.__block_offsets = array(OFFSETS_TYPECODE)
+        self.__blocks = {}
+        self.__lock = threading.Lock()
+
+        self.ready = self.__open(self.path)
+
+    @classmethod
+    def detect(cls, fileobj):
+        """Return the name of the compression format of fileobj, or None."""
+
+        fileobj.seek(0)
+        magic = fileobj.read(8)
+        fileobj.seek(0)
+        for prefix, name in cls.formats:
+            if magic.startswith(prefix):
+                return name
+        return None
+
+    def __get_key(self, log_fileobj):
+
+        stat = os.fstat(log_fileobj.fileno())
+        head_crc = zlib.crc32(log_fileobj.read(self._check_size)) & 0xffffffff
+        log_fileobj.seek(0)
+
+        return (stat.st_size, stat.st_mtime, head_crc,)
+
+    def __new_decompressor(self):
+
+        if self.format == "gzip":
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.format == "xz":
+            try:
+                import lzma
+            except ImportError:
+                try:
+                    from backports import lzma
+                except ImportError:
+                    raise IOError("reading xz compressed logs requires "
+                                  "the lzma module")
+            return lzma.LZMADecompressor()
+        elif self.format == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise IOError("reading zstd compressed logs requires "
+                              "the zstandard module")
+            return zstandard.ZstdDecompressor().decompressobj()
+
+    def __iter_decompressed(self, log_fileobj, log_size):
+
+        read_size = self._read_size
+        log_size = float(max(log_size, 1))
+
+        if self.format == "zstd":
+            # Depending on its version, the decompressor of the zstandard
+            # module stops at the end of the first frame without unused_data
+            # or eof to tell.  The frames are therefore split up here, each
+            # one gets a new decompressor.
+            for data, frame_start in _iter_zstd_frames(log_fileobj,
+                                                       read_size):
+                if frame_start:
+                    decompressor = self.__new_decompressor()
+                output = decompressor.decompress(data)
+                if output:
+                    yield output
+                self.__build_progress = log_fileobj.tell() / log_size
+            return
+
+        decompressor = self.__new_decompressor()
+        while True:
+            data = log_fileobj.read(read_size)
+            if not data:
+                break
+            while data:
+                if getattr(decompressor, "eof", False):
+                    # Concatenated members/streams/frames.
+                    decompressor = self.__new_decompressor()
+                output = decompressor.decompress(data)
+                if output:
+                    yield output
+                data = decompressor.unused_data
+                if data:
+                    decompressor = self.__new_decompressor()
+            self.__build_progress = log_fileobj.tell() / log_size
+
+    def __open(self, path):
+
+        try:
+            fileobj = open(path, "rb")
+        except EnvironmentError:
+            return False
+
+        header_size = self._header.size
+        try:
+            header = fileobj.read(header_size)
+            if len(header) != header_size:
+                fileobj.close()
+                return False
+            fields = self._header.unpack(header)
+            size, n_blocks = fields[-2:]
+            if header != self.__pack_header(size, n_blocks):
+                self.logger.debug("block file %r is stale", path)
+                fileobj.close()
+                return False
+            fileobj.seek(-(n_blocks + 1) * self.__block_offsets.itemsize, 2)
+            block_offsets = array(OFFSETS_TYPECODE)
+            block_offsets.fromfile(fileobj, n_blocks + 1)
+        except (EnvironmentError, EOFError,) as exc:
+            self.logger.warning("cannot read block file %r: %s", path, exc)
+            fileobj.close()
+            return False
+
+        # The block table is replaced as a whole, while other threads might
+        # be reading blocks:
+        with self.__lock:
+            self.__fileobj = fileobj
+            self.__size = size
+            self.__block_offsets = block_offsets
+            self.__blocks.clear()
+
+        _touch_cache_file(path)
+        self.logger.debug("using block file %r (%i blocks)", path, n_blocks)
+        return True
+
+    def __pack_header(self, size, n_blocks):
+
+        return self._header.pack(self.magic, self.version, self.block_size,
+                                 *(self.__key + (size, n_blocks,)))
+
+    def __create(self):
+
+        from tempfile import mkstemp, TemporaryFile
+
+        dirname, basename = os.path.split(self.path)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, temp_path = mkstemp(prefix=basename + "-tmp", dir=dirname)
+        except EnvironmentError as exc:
+            self.logger.warning("cannot create block file in %r, using a "
+                                "temporary file: %s", dirname, exc)
+            self.path = None
+            return (TemporaryFile(), None,)
+
+        return (os.fdopen(fd, "w+b"), temp_path,)
+
+    def build(self):
+        """Generator that creates the block file.  Yields True from time to
+        time, until the file is ready."""
+
+        block_size = self.block_size
+        block_offsets = array(OFFSETS_TYPECODE, [0])
+        fileobj, temp_path = self.__create()
+        try:
+            fileobj.write(self.__pack_header(0, 0))
+            log_fileobj = open(self.log_path, "rb")
+            try:
+                pending = []
+                pending_size = 0
+                offset = 0
+                size = 0
+                for data in self.__iter_decompressed(log_fileobj,
+                                                     self.__key[0]):
+                    pending.append(data)
+                    pending_size += len(data)
+                    while pending_size >= block_size:
+                        data = "".join(pending)
+                        block = zlib.compress(data[:block_size], 1)
+                        fileobj.write(block)
+                        offset += len(block)
+                        block_offsets.append(offset)
+                        size += block_size
+                        pending = [data[block_size:]]
+                        pending_size -= block_size
+                    yield True
+                if pending_size:
+                    block = zlib.compress("".join(pending), 1)
+                    fileobj.write(block)
+                    offset += len(block)
+                    block_offsets.append(offset)
+                    size += pending_size
+            finally:
+                log_fileobj.close()
+            block_offsets.tofile(fileobj)
+            fileobj.seek(0)
+            fileobj.write(self.__pack_header(size, len(block_offsets) - 1))
+            fileobj.flush()
+        except (EnvironmentError, zlib.error, EOFError,):
+            fileobj.close()
+            if temp_path is not None:
+                os.unlink(temp_path)
+            raise
+
+        if temp_path is not None:
+            fileobj.close()
+            os.rename(temp_path, self.path)
+            self.ready = self.__open(self.path)
+            prune_cache(keep=(self.path,))
+        else:
+            fileobj.seek(0)
+            with self.__lock:
+                self.__fileobj = fileobj
+                self.__size = size
+                self.__block_offsets = block_offsets
+                self.__blocks.clear()
+            self.ready = True
+
+        self.__build_progress = 1.
+        self.logger.debug("created block file (%i blocks)",
+                          len(block_offsets) - 1)
+
+    def get_build_progress(self):
+
+        return self.__build_progress
+
+    def __get_block(self, block_index):
+
+        # The block cache, offsets and file object are shared between
+        # threads, only decompression runs unlocked.
+        with self.__lock:
+            try:
+                return self.__blocks[block_index]
+            except KeyError:
+                pass
+
+            block_offsets = self.__block_offsets
+            if block_index >= len(block_offsets) - 1:
+                return ""
+
+            start = block_offsets[block_index]
+            self.__fileobj.seek(self.__data_start + start)
+            compressed = self.__fileobj.read(
+                block_offsets[block_index + 1] - start)
+        data = zlib.decompress(compressed)
+
+        with self.__lock:
+            blocks = self.__blocks
+            if len(blocks) >= self._cached_blocks:
+                blocks.clear()
+            blocks[block_index] = data
+
+        return data
+
+    def __len__(self):
+
+        return self.__size
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.__size)
+            if step != 1:
+                raise ValueError("slice steps are not supported")
+            return self.__read_range(start, stop)
+
+        if index < 0:
+            index += self.__size
+        if not 0 <= index < self.__size:
+            raise IndexError("index out of range")
+
+        return self.__read_range(index, index + 1)
+
+    def __read_range(self, start, stop):
+
+        block_size = self.block_size
+        chunks = []
+        while start < stop:
+            block_index, block_offset = divmod(start, block_size)
+            block = self.__get_block(block_index)
+            chunk = block[block_offset:block_offset + stop - start]
+            if not chunk:
+                break
+            chunks.append(chunk)
+            start += len(chunk)
+
+        return "".join(chunks)
+
+    def find(self, sub, start=0, end=None):
+
+        if end is None or end > self.__size:
+            end = self.__size
+
+        window = self.block_size + len(sub) - 1
+        pos = start
+        while pos < end:
+            i = self.__read_range(pos, min(pos + window, end)).find(sub)
+            if i != -1:
+                return pos + i
+            pos += self.block_size
+
+        return -1
+
+    def rfind(self, sub, start=0, end=None):
+
+        if end is None or end > self.__size:
+            end = self.__size
+
+        window = self.block_size + len(sub) - 1
+        pos = end
+        while pos > start:
+            chunk_start = max(pos - window, start)
+            i = self.__read_range(chunk_start, pos).rfind(sub)
+            if i != -1:
+                return chunk_start + i
+            pos -= self.block_size
+
+        return -1
+
+    def seek(self, pos, whence=0):
+
+        if whence == 1:
+            pos += self.__pos
+        elif whence == 2:
+            pos += self.__size
+
+        if not 0 <= pos <= self.__size:
+            raise ValueError("seek out of range")
+
+        self.__pos = pos
+
+    def tell(self):
+
+        return self.__pos
+
+    def read(self, size=-1):
+
+        start = self.__pos
+        if size < 0:
+            stop = self.__size
+        else:
+            stop = min(start + size, self.__size)
+
+        data = self.__read_range(start, stop)
+        self.__pos += len(data)
+
+        return data
+
+    def readline(self):
+
+        line = self.line_at(self.__pos)
+        self.__pos += len(line)
+
+        return line
+
+    def line_at(self, pos):
+        """Return the line starting at pos.  This does not use the file
+        position."""
+
+        block_start = pos - pos % self.block_size
+        block = self.__get_block(block_start // self.block_size)
+        i = pos - block_start
+
+        j = block.find("\n", i)
+        if j != -1:
+            return block[i:j + 1]
+
+        # Continued in the next block(s).
+        chunks = [block[i:]]
+        next_start = block_start + len(block)
+        while next_start < self.__size:
+            next_block = self.__get_block(next_start // self.block_size)
+            j = next_block.find("\n")
+            if j != -1:
+                chunks.append(next_block[:j + 1])
+                break
+            chunks.append(next_block)
+            next_start += len(next_block)
+
+        return "".join(chunks)
+
+    def close(self):
+
+        with self.__lock:
+            if self.__fileobj is not None:
+                self.__fileobj.close()
+                self.__fileobj = None
+            self.__blocks.clear()
+
+
+def read_line(fileobj, offset):
+    """Return the line of fileobj (an mmap or BlockFile) starting at offset,
+    including the newline.  Unlike seek and readline, this does not use the
+    file position, so the same mapping can be read from several places (and
+    threads) at once."""
+
+    if isinstance(fileobj, BlockFile):
+        return fileobj.line_at(offset)
+
+    end = fileobj.find("\n", offset) + 1 or len(fileobj)
+    return fileobj[offset:end]
+
+
+def _map_log_file(path):
+    """Return a read-only, mmap like object for the contents of the log file at
+    path, decompressing it transparently if needed."""
+
+    import mmap
+
+    real_fileobj = open(path, "rb")
+    try:
+        if BlockFile.detect(real_fileobj) is not None:
+            return BlockFile(path)
+        return mmap.mmap(real_fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        real_fileobj.close()
+
+
+def _line_level_regexes(multiline=False):
+    """Return the bare and ANSI regular expressions used to extract the
+    hours/minutes/seconds of the timestamp (group 1), its fractional part
+    (group 2), the thread (group 3) and the debug level character (group 4) of
+    a log line, and a mapping from that character to the debug level.
+
+    With multiline set, the expressions match a newline followed by a log line
+    prefix, for finding all lines in a larger string.  Unlike an anchored
+    pattern, the literal newline lets the regex engine skip ahead quickly."""
+
+    dict_levels = {"T": debug_level_trace, "F": debug_level_fixme,
+                   "L": debug_level_log, "D": debug_level_debug,
+                   "I": debug_level_info, "W": debug_level_warning,
+                   "E": debug_level_error, " ": debug_level_none}
+    ANSI = "(?:\x1b\\[[0-9;]*m)?"
+    ANSI_PATTERN = (r"(\d+:\d\d:\d\d)\.(\d+) " + ANSI +
+                    r" *\d+" + ANSI +
+                    r" +(0x[0-9a-f]+) +" + ANSI +
+                    r"([TFLDIEW ])")
+    BARE_PATTERN = ANSI_PATTERN.replace(ANSI, "")
+
+    if multiline:
+        return (re.compile("\n" + BARE_PATTERN),
+                re.compile("\n" + ANSI_PATTERN),
+                dict_levels,)
+
+    return (re.compile(BARE_PATTERN), re.compile(ANSI_PATTERN), dict_levels,)
+
+
+def _scan_lines(fileobj, start, stop):
+    """Scanning engine that matches the lines starting in the byte range
+    [start, stop) of fileobj one by one.
+
+    Like _scan_chunks, this is a generator yielding (offset, line_offsets,
+    matches) for batches of lines, where offset is the end of the batch and
+    line_offsets and matches are lists holding the offset and match object
+    (see _line_level_regexes) of each line that could be parsed."""
+
+    rexp_bare, rexp_ansi, dict_levels = _line_level_regexes()
+    rexp = rexp_bare
+    rexp_match = rexp.match
+    readline = fileobj.readline
+    limit = LineCache._lines_per_iteration
+
+    fileobj.seek(start)
+    offset = start
+    line_offsets = []
+    matches = []
+    while offset < stop:
+        line = readline()
+        if not line:
+            break
+        line_offset = offset
+        offset += len(line)
+        match = rexp_match(line)
+        if match is None:
+            if rexp is rexp_ansi or not "\x1b" in line:
+                continue
+
+            match = rexp_ansi.match(line)
+            if match is None:
+                continue
+            # Switch to slower ANSI parsing:
+            rexp = rexp_ansi
+            rexp_match = rexp.match
+
+        line_offsets.append(line_offset)
+        matches.append(match)
+        if len(matches) >= limit:
+            yield (offset, line_offsets, matches,)
+            line_offsets = []
+            matches = []
+
+    yield (offset, line_offsets, matches,)
+
+
+def _scan_chunks(fileobj, start, stop):
+    """Scanning engine that matches all lines of large chunks of fileobj in
+    one go, which avoids most of the per line overhead of _scan_lines.  Chunks
+    containing escape sequences are matched with the ANSI expression."""
+
+    from operator import methodcaller
+
+    rexp_bare, rexp_ansi, dict_levels = _line_level_regexes(multiline=True)
+    chunk_size = LineCache._scan_chunk_size
+    find = fileobj.find
+    size = len(fileobj)
+    get_start = methodcaller("start")
+
+    pos = start
+    while pos < stop:
+        # Extend the chunk to the end of the line containing its last byte:
+        end = find("\n", min(pos + chunk_size, stop) - 1)
+        if end == -1:
+            end = size
+        else:
+            end += 1
+        # With a newline in front, match.start() is the line offset relative
+        # to pos:
+        data = "\n" + fileobj[pos:end]
+        if "\x1b" in data:
+            finditer = rexp_ansi.finditer
+        else:
+            finditer = rexp_bare.finditer
+        matches = list(finditer(data))
+        yield (end, map(pos.__add__, map(get_start, matches)), matches,)
+        pos = end
+
+
+class _SecondsCache (dict):
+
+    """Maps the "0:00:00" part of timestamps to nanoseconds."""
+
+    def __missing__(self, secs_string):
+
+        value = self[secs_string] = _parse_secs(secs_string)
+        return value
+
+
+def _convert_matches(matches, seconds_cache, dict_levels):
+    """Return lists of the levels and timestamps for the given matches of the
+    line level expressions."""
+
+    from operator import add, methodcaller
+
+    secs = map(seconds_cache.__getitem__, map(methodcaller("group", 1), matches))
+    fractions = map(int, map(methodcaller("group", 2), matches))
+    levels = map(dict_levels.__getitem__, map(methodcaller("group", 4), matches))
+
+    return (levels, map(add, secs, fractions),)
+
+
+def _is_sorted(l):
+
+    return l == sorted(l)
+
+
+def _parse_secs(st):
+    """Parse the "0:00:00" part of a timestamp to nanoseconds."""
+
+    h, m, s = st.split(":")
+
+    return (int(h) * 60 ** 2 + int(m) * 60 + int(s)) * SECOND
+
+
+def _new_columns():
+
+    return (array(OFFSETS_TYPECODE), array("B"), array(TIMES_TYPECODE),)
+
+
+def _merge_runs(runs, offsets, levels, times):
+    """Merge runs of (offsets, levels, times) arrays that are each sorted by
+    timestamp, appending the result to offsets, levels and times.  Ties are
+    resolved by file offset, so that sequential and parallel loading give the
+    same order however they split the lines into runs (indices like the
+    TrigramIndex depend on it).  This is a generator that yields True
+    periodically while merging."""
+
+    import heapq
+
+    offsets_append = offsets.append
+    levels_append = levels.append
+    times_append = times.append
+    heapreplace = heapq.heapreplace
+    heappop = heapq.heappop
+
+    limit = LineCache._lines_per_iteration
+    y = limit
+    heap = []
+    for run_index, (run_offsets, run_levels, run_times,) in enumerate(runs):
+        if len(run_times):
+            heap.append((run_times[0], run_offsets[0], run_index, 0,))
+    heapq.heapify(heap)
+
+    while heap:
+        y -= 1
+        if y == 0:
+            y = limit
+            yield True
+        ts, offset, run_index, i = heap[0]
+        run_offsets, run_levels, run_times = runs[run_index]
+        offsets_append(offset)
+        levels_append(run_levels[i])
+        times_append(ts)
+        i += 1
+        if i < len(run_times):
+            heapreplace(heap, (run_times[i], run_offsets[i], run_index, i,))
+        else:
+            heappop(heap)
+
+
+def _index_range(fileobj, start, stop, bulk_scan=True):
+    """Index the lines starting in the byte range [start, stop) of fileobj.
+    Returns the (offsets, levels, times) arrays, sorted by timestamp."""
+
+    offsets, levels, times = _new_columns()
+
+    dict_levels = _line_level_regexes()[2]
+    seconds_cache = _SecondsCache()
+
+    if bulk_scan:
+        scan = _scan_chunks
+    else:
+        scan = _scan_lines
+
+    in_order = True
+    for end, chunk_offsets, matches in scan(fileobj, start, stop):
+        if not matches:
+            continue
+        chunk_levels, chunk_times = _convert_matches(matches, seconds_cache,
+                                                     dict_levels)
+        if in_order and ((times and chunk_times[0] < times[-1]) or
+                         not _is_sorted(chunk_times)):
+            in_order = False
+        offsets.extend(chunk_offsets)
+        levels.extend(chunk_levels)
+        times.extend(chunk_times)
+
+    if not in_order:
+        # Stable sort, equal timestamps keep their order in the file:
+        order = sorted(xrange(len(times)), key=times.__getitem__)
+        offsets = array(OFFSETS_TYPECODE, (offsets[i] for i in order))
+        levels = array("B", (levels[i] for i in order))
+        times = array(TIMES_TYPECODE, (times[i] for i in order))
+
+    return (offsets, levels, times,)
+
+
+def _index_chunk(args):
+    """Index the lines starting in the byte range [start, stop) of the log file
+    at path.  Called in worker processes by the parallel load process of
+    LineCache.
+
+    Returns the offsets, levels and timestamps as strings of the packed arrays,
+    sorted by timestamp, along with the first and last timestamp."""
+
+    path, start, stop, bulk_scan = args
+
+    fileobj = _map_log_file(path)
+    try:
+        offsets, levels, times = _index_range(fileobj, start, stop,
+                                              bulk_scan)
+    finally:
+        fileobj.close()
+
+    if times:
+        first_ts, last_ts = times[0], times[-1]
+    else:
+        first_ts = last_ts = None
+
+    return (offsets.tostring(), levels.tostring(), times.tostring(),
+            first_ts, last_ts,)
+
+
+class TimePyramid (object):
+
+    """Line counts per debug level in buckets of time, at power of two
+    resolutions.  The buckets of level 0 are 2 ** shift nanoseconds wide and
+    start at first_ts, each following level merges pairs of buckets of the
+    level below, up to a single bucket.  Level 0 has at most max_buckets
+    buckets, adding lines beyond that drops it and increments shift.
+
+    counts[level][debug_level] is an array of line counts per bucket.  Using
+    the level that matches the resolution needed, get_counts sums up the
+    lines of a time range in time proportional to the number of
+    partitions."""
+
+    max_buckets = 1 << 16
+
+    def __init__(self):
+
+        self.first_ts = None
+        self.shift = 0
+        self.counts = []
+        self.n_lines = 0
+
+    def add(self, times, levels, start=0, stop=None):
+        """Count the lines in [start, stop) of the times and levels arrays.
+        They should be sorted by time, lines out of order are counted but can
+        end up in the wrong bucket."""
+
+        from bisect import bisect_left
+
+        if stop is None:
+            stop = len(times)
+        if start >= stop:
+            return
+
+        range_times = times[start:stop]
+        old_layout = (self.shift, len(self.counts),)
+        self.__ensure_range(min(range_times), max(range_times))
+
+        base = self.counts[0]
+        first_ts = self.first_ts
+        shift = self.shift
+        first_bucket = (times[start] - first_ts) >> shift
+        i = start
+        while i < stop:
+            bucket = (times[i] - first_ts) >> shift
+            end = bisect_left(times, first_ts + ((bucket + 1) << shift),
+                              i, stop)
+            if end - i == 1:
+                base[levels[i]][bucket] += 1
+            else:
+                chunk = levels[i:end]
+                for level, level_counts in enumerate(base):
+                    count = chunk.count(level)
+                    if count:
+                        level_counts[bucket] += count
+            i = end
+
+        self.n_lines += stop - start
+        if (self.shift, len(self.counts),) != old_layout:
+            # Levels were dropped or added, the new ones are still empty.
+            self.__update_levels(0, len(base[0]))
+        else:
+            self.__update_levels(first_bucket, bucket + 1)
+
+    def __ensure_range(self, first_ts, last_ts):
+
+        if self.first_ts is None:
+            self.first_ts = first_ts
+            while (last_ts - first_ts) >> self.shift >= self.max_buckets:
+                self.shift += 1
+            self.counts = [[array("I") for level in debug_levels]]
+        elif first_ts < self.first_ts:
+            # Lines older than the first bucket, prepend buckets.
+            count = ((self.first_ts - first_ts - 1) >> self.shift) + 1
+            self.first_ts -= count << self.shift
+            for level_counts in self.counts[0]:
+                level_counts[:0] = array("I", [0]) * count
+            del self.counts[1:]
+            size = len(self.counts[0][0])
+            self.__resize(size)
+            self.__update_levels(0, size)
+
+        while (last_ts - self.first_ts) >> self.shift >= self.max_buckets:
+            if len(self.counts) == 1:
+                # A single bucket, merging it with nothing copies it.
+                self.counts.append([array("I", level_counts)
+                                    for level_counts in self.counts[0]])
+            del self.counts[0]
+            self.shift += 1
+
+        self.__resize(((last_ts - self.first_ts) >> self.shift) + 1)
+
+    def __resize(self, size):
+
+        # Grow level 0 to at least size buckets and the levels above to match, adding
+        # levels until the top one has a single bucket.
+        size = max(size, len(self.counts[0][0]))
+        k = 0
+        while True:
+            if k == len(self.counts):
+                self.counts.append([array("I") for level in debug_levels])
+            for level_counts in self.counts[k]:
+                if len(level_counts) < size:
+                    level_counts.extend(array("I", [0]) *
+                                        (size - len(level_counts)))
+            if size == 1:
+                break
+            size = (size + 1) >> 1
+            k += 1
+
+    def __update_levels(self, start, stop):
+
+        from operator import add
+
+        # Recompute the buckets above the level 0 buckets [start, stop).
+        for k in xrange(1, len(self.counts)):
+            start >>= 1
+            stop = (stop + 1) >> 1
+            for lower, upper in zip(self.counts[k - 1], self.counts[k]):
+                pairs = lower[2 * start:2 * stop]
+                if len(pairs) % 2:
+                    pairs.append(0)
+                upper[start:stop] = array("I", map(add, pairs[::2],
+                                                   pairs[1::2]))
+
+    def get_counts(self, start_ts, stop_ts, n):
+        """Return a list of n tuples of line counts per debug level, for n
+        partitions of equal width of the time range [start_ts, stop_ts].
+        Lines are attributed to partitions by the middle of their bucket,
+        using the widest buckets that are at most a quarter partition wide."""
+
+        if self.first_ts is None or stop_ts < start_ts:
+            return [(0,) * len(debug_levels)] * n
+
+        step = float(stop_ts - start_ts) / n
+        k = 0
+        while (k + 1 < len(self.counts) and
+               4 << (self.shift + k + 1) <= step):
+            k += 1
+        shift = self.shift + k
+        counts = self.counts[k]
+
+        size = len(counts[0])
+        first = max((start_ts - self.first_ts) >> shift, 0)
+        last = min(((stop_ts - self.first_ts) >> shift) + 1, size)
+        if first >= last:
+            return [(0,) * len(debug_levels)] * n
+
+        offset = self.first_ts - start_ts + (1 << shift >> 1)
+        partitions = []
+        for bucket in xrange(first, last):
+            partition = int((offset + (bucket << shift)) / step)
+            partitions.append(min(max(partition, 0), n - 1))
+
+        result = []
+        for level_counts in counts:
+            partition_counts = [0] * n
+            for partition, count in zip(partitions,
+                                        level_counts[first:last]):
+                if count:
+                    partition_counts[partition] += count
+            result.append(partition_counts)
+
+        return zip(*result)
+
+
 class LineCache (Producer):
     """
-    offsets: file position for each line
-    levels: the debug level for each line
+    offsets: file position for each line (64 bit array)
+    levels: the debug level for each line (byte array)
+    times: the timestamp in nanoseconds for each line (64 bit array)
+
+    Files of at least _parallel_min_size bytes are indexed in parallel by
+    worker processes, in chunks of _parallel_chunk_size bytes.  Set jobs to
+    the number of worker processes to use, 1 disables parallel indexing and
+    None uses one process per CPU.
+
+    Once lines appear out of order, the sequential load process collects
+    monotonic runs of lines per thread if merge_threads is set, and merges
+    them by timestamp when done.  Otherwise each out of order line is inserted
+    using SortHelper, which degrades badly for heavily interleaved logs.
+
+    With bulk_scan set, lines are matched in chunks of _scan_chunk_size bytes
+    at a time (see _scan_chunks), otherwise one by one (see _scan_lines).
+    Matching a chunk holds the interpreter lock throughout, so the chunk size
+    also bounds how long a ThreadedDispatcher running the load process can
+    stall the main loop.
+
+    After loading, update can be used to index data appended to the file.
+    The TimePyramid of the lines is created by get_time_pyramid on demand,
+    and kept up to date by update.
     """
 
     _lines_per_iteration = 50000
+    _scan_chunk_size = 512 * 1024
+    _parallel_min_size = 64 * 1024 * 1024
+    _parallel_chunk_size = 16 * 1024 * 1024
+
+    jobs = None
+    merge_threads = True
+    bulk_scan = True
 
-    def __init__(self, fileobj, dispatcher):
+    def __init__(self, fileobj, dispatcher, index_file=None, path=None):
 
         Producer.__init__(self)
 
         self.logger = logging.getLogger("linecache")
         self.dispatcher = dispatcher
+        self.index_file = index_file
+        self.path = path
 
         self.__fileobj = fileobj
-        self.__fileobj.seek(0, 2)
-        self.__file_size = self.__fileobj.tell()
-        self.__fileobj.seek(0)
+        self.__file_size = 0
+        self.__progress_offset = 0
+        self.__pool = None
 
-        self.offsets = []
-        self.levels = []  # FIXME
+        self.offsets, self.levels, self.times = _new_columns()
+        self.time_pyramid = None
 
     def start_loading(self):
 
-        self.logger.debug("dispatching load process")
+        import multiprocessing
+
         self.have_load_started()
-        self.dispatcher(self.__process())
+
+        self.__fileobj.seek(0, 2)
+        self.__file_size = self.__fileobj.tell()
+        self.__fileobj.seek(0)
+
+        if self.index_file is not None:
+            index = self.index_file.load(self.__fileobj)
+            if index is not None:
+                self.logger.debug("using line index from index file")
+                self.offsets, self.levels, self.times = index
+                self.have_load_finished()
+                return
+
+        jobs = self.__get_jobs()
+        if jobs > 1:
+            self.logger.debug("dispatching parallel load process (%i jobs)",
+                              jobs)
+            # Fork the workers here, from the main thread, rather than in the
+            # process, which a threaded dispatcher runs in a worker thread.
+            # A child forked from there could inherit locks that the main
+            # thread holds at the time, like those of the logging module.
+            self.__pool = multiprocessing.Pool(jobs)
+            try:
+                self.dispatcher(self.__process_parallel(self.__pool))
+            except:
+                self.close()
+                raise
+        else:
+            self.logger.debug("dispatching load process")
+            self.dispatcher(self.__process())
 
     def get_progress(self):
 
-        return float(self.__fileobj.tell()) / self.__file_size
+        if not self.__file_size:
+            return 0.
+
+        return float(self.__progress_offset) / self.__file_size
+
+    def update(self, fileobj):
+        """Index the lines appended to the file since loading (or the previous
+        update).  fileobj must be a new mapping of the grown file, it replaces
+        the old one.  Returns the number of lines added.
+
+        The new lines are sorted among themselves and added at the end, even
+        if they are older than lines indexed before."""
+
+        old_size = self.__file_size
+        self.__fileobj = fileobj
+        self.__file_size = len(fileobj)
+
+        start = old_size
+        if old_size and fileobj[old_size - 1] != "\n":
+            # The previous last line was still being written.  If it was too
+            # short to be indexed back then, give it another try:
+            line_start = fileobj.rfind("\n", 0, old_size) + 1
+            if line_start not in self.offsets[-64:]:
+                start = line_start
+
+        offsets, levels, times = _index_range(fileobj, start,
+                                              self.__file_size,
+                                              self.bulk_scan)
+        old_count = len(self.offsets)
+        self.offsets.extend(offsets)
+        self.levels.extend(levels)
+        self.times.extend(times)
+        if self.time_pyramid is not None:
+            self.time_pyramid.add(self.times, self.levels, old_count)
+        self.__progress_offset = self.__file_size
+
+        self.logger.debug("indexed %i appended lines", len(offsets))
+
+        return len(offsets)
+
+    def get_time_pyramid(self):
+        """Return the TimePyramid of the indexed lines, which is created on
+        the first call.  Only valid once loading finished."""
+
+        if self.time_pyramid is None:
+            self.time_pyramid = TimePyramid()
+            self.time_pyramid.add(self.times, self.levels)
+        return self.time_pyramid
+
+    def __get_jobs(self):
+
+        if self.path is None or self.__file_size < self._parallel_min_size:
+            return 1
+
+        if self.jobs is not None:
+            return self.jobs
+
+        import multiprocessing
+
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
 
     def __process(self):
 
+        from operator import methodcaller
+
         offsets = self.offsets
         levels = self.levels
+        times = self.times
 
-        dict_levels = {"T": debug_level_trace, "F": debug_level_fixme,
-                       "L": debug_level_log, "D": debug_level_debug,
-                       "I": debug_level_info, "W": debug_level_warning,
-                       "E": debug_level_error, " ": debug_level_none}
-        ANSI = "(?:\x1b\\[[0-9;]*m)?"
-        ANSI_PATTERN = (r"\d:\d\d:\d\d\.\d+ " + ANSI +
-                        r" *\d+" + ANSI +
-                        r" +0x[0-9a-f]+ +" + ANSI +
-                        r"([TFLDIEW ])")
-        BARE_PATTERN = ANSI_PATTERN.replace(ANSI, "")
-        rexp_bare = re.compile(BARE_PATTERN)
-        rexp_ansi = re.compile(ANSI_PATTERN)
-        rexp = rexp_bare
+        dict_levels = _line_level_regexes()[2]
+        seconds_cache = _SecondsCache()
+        get_thread = methodcaller("group", 3)
 
         # Moving attribute lookups out of the loop:
-        readline = self.__fileobj.readline
-        tell = self.__fileobj.tell
-        rexp_match = rexp.match
         levels_append = levels.append
         offsets_append = offsets.append
-        dict_levels_get = dict_levels.get
+        times_append = times.append
 
-        self.__fileobj.seek(0)
-        limit = self._lines_per_iteration
-        last_line = ""
-        i = 0
+        if self.bulk_scan:
+            scan = _scan_chunks
+        else:
+            scan = _scan_lines
+
+        last_ts = 0
         sort_helper = SortHelper(self.__fileobj, offsets)
         find_insert_position = sort_helper.find_insert_position
-        while True:
-            i += 1
-            if i >= limit:
-                i = 0
+        merge_threads = self.merge_threads
+        # Once lines are out of order (and merging is enabled), all following
+        # lines are assigned to per-thread runs:
+        unsorted_start = None
+        run_ids = array("I")
+        run_ids_append = run_ids.append
+        thread_runs = {}
+        n_runs = 0
+        for end, chunk_offsets, matches in scan(self.__fileobj, 0,
+                                                self.__file_size):
+            self.__progress_offset = end
+            if not matches:
                 yield True
+                continue
+
+            chunk_levels, chunk_times = _convert_matches(matches,
+                                                         seconds_cache,
+                                                         dict_levels)
+
+            if (unsorted_start is None and chunk_times[0] >= last_ts and
+                    _is_sorted(chunk_times)):
+                # Fast path for the common case of a chunk in order.
+                offsets.extend(chunk_offsets)
+                levels.extend(chunk_levels)
+                times.extend(chunk_times)
+                last_ts = chunk_times[-1]
+                yield True
+                continue
+
+            threads = map(get_thread, matches)
+            for offset, level, ts, thread in zip(chunk_offsets, chunk_levels,
+                                                 chunk_times, threads):
+                if unsorted_start is None:
+                    if ts >= last_ts:
+                        levels_append(level)
+                        offsets_append(offset)
+                        times_append(ts)
+                        last_ts = ts
+                        continue
+                    elif not merge_threads:
+                        pos = find_insert_position(time_args(ts))
+                        levels.insert(pos, level)
+                        offsets.insert(pos, offset)
+                        times.insert(pos, ts)
+                        continue
+                    # All lines up to here form the first run.
+                    unsorted_start = len(offsets)
+
+                run_id, thread_last_ts = thread_runs.get(thread,
+                                                         (None, None,))
+                if run_id is None or ts < thread_last_ts:
+                    # Thread went back in time, need to start a new run.
+                    n_runs += 1
+                    run_id = n_runs
+                thread_runs[thread] = (run_id, ts,)
+                run_ids_append(run_id)
+                levels_append(level)
+                offsets_append(offset)
+                times_append(ts)
 
-            offset = tell()
-            line = readline()
-            if not line:
-                break
-            match = rexp_match(line)
-            if match is None:
-                if rexp is rexp_ansi or not "\x1b" in line:
-                    continue
+            yield True
 
-                match = rexp_ansi.match(line)
-                if match is None:
-                    continue
-                # Switch to slower ANSI parsing:
-                rexp = rexp_ansi
-                rexp_match = rexp.match
-
-            # Timestamp is in the very beginning of the row, and can be sorted
-            # by lexical comparison. That's why we don't bother parsing the
-            # time to integer. We also don't have to take a substring here,
-            # which would be a useless memcpy.
-            if line >= last_line:
-                levels_append(
-                    dict_levels_get(match.group(1), debug_level_none))
-                offsets_append(offset)
-                last_line = line
+        self.__progress_offset = self.__file_size
+
+        if unsorted_start is not None:
+            self.logger.debug("merging %i runs of out of order lines", n_runs)
+            for x in self.__merge_thread_runs(unsorted_start, run_ids, n_runs):
+                yield True
+
+        self.__finish_process()
+        yield False
+
+    def __merge_thread_runs(self, unsorted_start, run_ids, n_runs):
+
+        columns = (self.offsets, self.levels, self.times,)
+
+        runs = [tuple((column[:unsorted_start] for column in columns))]
+        runs.extend([_new_columns() for i in xrange(n_runs)])
+        limit = self._lines_per_iteration
+        y = limit
+        for i, run_id in enumerate(run_ids, unsorted_start):
+            y -= 1
+            if y == 0:
+                y = limit
+                yield True
+            for run_column, column in zip(runs[run_id], columns):
+                run_column.append(column[i])
+        yield True
+
+        self.offsets, self.levels, self.times = _new_columns()
+        for x in _merge_runs(runs, self.offsets, self.levels, self.times):
+            yield True
+
+    def __split_chunks(self):
+
+        fileobj = self.__fileobj
+        size = self.__file_size
+        start = 0
+        while start < size:
+            stop = fileobj.find("\n", start + self._parallel_chunk_size)
+            if stop == -1:
+                stop = size
             else:
-                pos = find_insert_position(line)
-                levels.insert(
-                    pos, dict_levels_get(match.group(1), debug_level_none))
-                offsets.insert(pos, offset)
+                stop += 1
+            yield (self.path, start, stop, self.bulk_scan,)
+            start = stop
 
-        self.have_load_finished()
+    def close(self):
+        """Stop the worker processes of a parallel load, if any.  The load
+        process must not be continued afterwards."""
+
+        pool = self.__pool
+        if pool is None:
+            return
+
+        self.__pool = None
+        pool.terminate()
+        pool.join()
+
+    def __process_parallel(self, pool):
+
+        try:
+            chunks = list(self.__split_chunks())
+            pending = [(chunk, pool.apply_async(_index_chunk, (chunk,)),)
+                       for chunk in chunks]
+
+            # Collect the results in file order.  Consecutive chunks whose
+            # timestamps overlap form a group that gets merged by timestamp,
+            # otherwise the sorted chunks are simply concatenated.  A chunk
+            # that also overlaps lines added before the group (e.g. of a
+            # lagging thread) pulls those back into the group:
+            group = []
+            group_last_ts = None
+            for chunk, result in pending:
+                while not result.ready():
+                    result.wait(.02)
+                    yield True
+                result = result.get()
+                self.__progress_offset = chunk[2]
+
+                first_ts, last_ts = result[-2:]
+                if first_ts is None:
+                    continue
+                columns = _new_columns()
+                for column, string in zip(columns, result[:3]):
+                    column.fromstring(string)
+
+                if group and first_ts < group_last_ts:
+                    group.append(columns)
+                else:
+                    for x in self.__add_chunk_group(group):
+                        yield True
+                    group = [columns]
+                    group_last_ts = last_ts
+                if len(self.times) and first_ts < self.times[-1]:
+                    group_last_ts = max(group_last_ts, self.times[-1])
+                    group.insert(0, self.__split_added(first_ts))
+                group_last_ts = max(group_last_ts, last_ts)
+                yield True
+
+            for x in self.__add_chunk_group(group):
+                yield True
+        finally:
+            self.close()
+
+        self.__progress_offset = self.__file_size
+        self.__finish_process()
         yield False
 
+    def __split_added(self, ts):
+        """Remove the lines added so far that are later than ts and return
+        them as (offsets, levels, times) arrays."""
+
+        from bisect import bisect_right
+
+        pos = bisect_right(self.times, ts)
+        columns = (self.offsets, self.levels, self.times,)
+        tail = tuple((column[pos:] for column in columns))
+        for column in columns:
+            del column[pos:]
+
+        return tail
+
+    def __add_chunk_group(self, group):
+
+        if not group:
+            return
+        elif len(group) == 1:
+            offsets, levels, times = group[0]
+            self.offsets.extend(offsets)
+            self.levels.extend(levels)
+            self.times.extend(times)
+        else:
+            self.logger.debug("merging %i overlapping chunks", len(group))
+            for x in _merge_runs(group, self.offsets, self.levels, self.times):
+                yield True
+
+    def __finish_process(self):
+
+        if self.index_file is not None:
+            self.index_file.save(self.__fileobj, self.offsets, self.levels,
+                                 self.times)
+
+        self.dispatcher.call_main(self.have_load_finished)
+
 
-class LogLine (list):
+class LogLine (tuple):
 
-    _line_regex = default_log_line_regex()
+    """A parsed log line, with the columns of LogModelBase.  Rows are
+    immutable and slot-less to keep the many of them that are created while
+    scrolling, filtering and searching cheap.  As returned by parse_full, the
+    level column is 0 (levels are kept by LineCache) and the message column
+    holds the offset of the message within the line string, so that it is
+    only sliced out when it is actually needed."""
+
+    __slots__ = ()
+
+    _line_regex = default_log_line_regex(ansi=False)
+    _ansi_line_regex = default_log_line_regex()
 
     @classmethod
     def parse_full(cls, line_string):
 
-        match = cls._line_regex.match(line_string)
+        if "\x1b" in line_string:
+            # Coloured line.  Matching the stripped line with the bare regex is
+            # a lot faster, the message offset is then mapped back from the
+            # end of the line:
+            stripped = strip_escape(line_string)
+            match = cls._line_regex.match(stripped)
+            if match is not None:
+                msg_start = match.start(9 + 1)
+                msg_start += len(line_string) - len(stripped)
+                if line_string[msg_start:] != stripped[match.start(9 + 1):]:
+                    # Escape sequences within the message.  The coloured
+                    # regex only allows them between fields though:
+                    match = cls._ansi_line_regex.match(line_string)
+                    if match is not None:
+                        msg_start = match.start(9 + 1)
+        else:
+            match = cls._line_regex.match(line_string)
+            if match is not None:
+                msg_start = match.start(9 + 1)
+
         if match is None:
             # raise ValueError ("not a valid log line (%r)" % (line_string,))
-            groups = [0, 0, 0, 0, "", "", 0, "", "", 0]
-            return cls(groups)
-
-        line = cls(match.groups())
-        # Timestamp.
-        line[0] = parse_time(line[0])
-        # PID.
-        line[1] = int(line[1])
-        # Thread.
-        line[2] = int(line[2], 16)
-        # Level (this is handled in LineCache).
-        line[3] = 0
-        # Line.
-        line[6] = int(line[6])
-        # Message start offset.
-        line[9] = match.start(9 + 1)
-
-        for col_id in (4,   # COL_CATEGORY
-                       5,   # COL_FILENAME
-                       7,   # COL_FUNCTION,
-                       8,):  # COL_OBJECT
-            line[col_id] = intern(line[col_id] or "")
+            return cls._invalid
 
-        return line
+        return cls._from_match(match, msg_start)
+
+    @classmethod
+    def _from_match(cls, match, message):
+
+        (ts, pid, thread, level, category, filename, line, function,
+         object_, msg,) = match.groups()
+
+        return tuple.__new__(cls, (parse_time(ts),
+                                   int(pid),
+                                   int(thread, 16),
+                                   # Level (this is handled in LineCache).
+                                   0,
+                                   intern(category or ""),
+                                   intern(filename or ""),
+                                   int(line),
+                                   intern(function or ""),
+                                   intern(object_ or ""),
+                                   message,))
+
+    def with_message(self, message, level=0):
+        """Return a copy of the row with the message (and level) columns
+        filled in."""
+
+        return tuple.__new__(LogLine, self[:3] + (level,) + self[4:9] +
+                             (message,))
+
+LogLine._invalid = tuple.__new__(LogLine, (0, 0, 0, 0, "", "", 0, "", "", 0,))
+
+
+# Average number of bytes per line up to which parse_lines reads all lines in
+# one go.
+_parse_lines_max_span = 1024
+
+
+def parse_lines(fileobj, offsets):
+    """Parse the lines at the given offsets of fileobj into LogLine rows, with
+    the message column filled in (as done by LogFile.get_full_line).  If the
+    lines are close together, they are parsed from a single slice of the file
+    instead of reading them one by one."""
+
+    if not len(offsets):
+        return []
+
+    start = min(offsets)
+    stop = fileobj.find("\n", max(offsets))
+    if stop == -1:
+        stop = len(fileobj)
+    else:
+        stop += 1
+
+    if stop - start > len(offsets) * _parse_lines_max_span:
+        # Sparse lines, e.g. of a filtered model.
+        rows = []
+        for offset in offsets:
+            line_string = read_line(fileobj, offset)
+            line = LogLine.parse_full(line_string)
+            rows.append(line.with_message(line_string[line[-1]:]))
+        return rows
+
+    data = fileobj[start:stop]
+    find = data.find
+    match_line = LogLine._line_regex.match
+    from_match = LogLine._from_match
+    rows = []
+    for offset in offsets:
+        pos = offset - start
+        end = find("\n", pos) + 1 or len(data)
+        match = None
+        if find("\x1b", pos, end) == -1:
+            match = match_line(data, pos, end)
+        if match is None:
+            # Coloured or invalid line.
+            line_string = data[pos:end]
+            line = LogLine.parse_full(line_string)
+            rows.append(line.with_message(line_string[line[-1]:]))
+            continue
+        rows.append(from_match(match, data[match.start(9 + 1):end]))
+
+    return rows
+
+
+_find_lines_chunk_size = 4096
+
+
+def _is_raw_search_safe(source):
+    """Return whether the regular expression source has no anchors, word
+    boundaries or lookarounds, which can match a column but not the raw line
+    (or the other way around).  Escaped characters, like those of re.escape,
+    are not mistaken for them.  Inside character classes, they are
+    conservatively still taken as unsafe."""
+
+    i = 0
+    while i < len(source):
+        char = source[i]
+        if char == "\\":
+            if source[i + 1:i + 2] in ("A", "Z", "b", "B",):
+                return False
+            i += 2
+            continue
+        if char in "^$" or source.startswith(("(?=", "(?!", "(?<",), i):
+            return False
+        i += 1
+
+    return True
+
+
+def find_lines(fileobj, offsets, pattern, ranges, backward=False, column=-1):
+    """Generator of the indices of the lines at the given offsets of fileobj
+    with a match of pattern in the given column of their rows (the message by
+    default), for the (start, stop) line index ranges in order (in reverse
+    order if backward is set).  Yields None after each chunk of lines.
+
+    pattern is either a string to search for or a compiled regular
+    expression.  The raw file contents are searched with it first, only the
+    lines containing a match are parsed to check that it is in the column."""
+
+    from bisect import bisect_right
+
+    if isinstance(pattern, basestring):
+        text = pattern
+
+        def raw_search(data, pos, endpos=sys.maxint):
+            pos = data.find(text, pos, endpos)
+            if pos == -1:
+                return None
+            return (pos, pos + len(text),)
+
+        def match_value(value):
+            return text in value
+    else:
+        regex_search = pattern.search
+
+        if not _is_raw_search_safe(pattern.pattern):
+            raw_search = None
+        else:
+            def raw_search(data, pos, endpos=sys.maxint):
+                match = regex_search(data, pos, endpos)
+                if match is None:
+                    return None
+                return match.span()
+
+        def match_value(value):
+            return regex_search(value) is not None
+
+    chunk_size = _find_lines_chunk_size
+    chunks = []
+    for start, stop in ranges:
+        chunks.extend((chunk_start, min(chunk_start + chunk_size, stop),)
+                      for chunk_start in xrange(start, stop, chunk_size))
+    if backward:
+        chunks.reverse()
+
+    for start, stop in chunks:
+        chunk_offsets = offsets[start:stop]
+        first = min(chunk_offsets)
+        last = max(chunk_offsets)
+        if raw_search is None:
+            hits = range(len(chunk_offsets))
+        elif last - first > len(chunk_offsets) * _parse_lines_max_span:
+            # Sparse lines, search them one by one.
+            hits = [i for i, offset in enumerate(chunk_offsets)
+                    if raw_search(read_line(fileobj, offset), 0) is not None]
+        else:
+            order = sorted(xrange(len(chunk_offsets)),
+                           key=chunk_offsets.__getitem__)
+            line_starts = [chunk_offsets[i] - first for i in order]
+            end = fileobj.find("\n", last)
+            if end == -1:
+                end = len(fileobj)
+            data = fileobj[first:end]
+            hits = []
+            span = raw_search(data, 0)
+            while span is not None:
+                pos, match_end = span
+                k = bisect_right(line_starts, pos) - 1
+                line_end = data.find("\n", line_starts[k])
+                if line_end == -1:
+                    line_end = len(data)
+                if match_end <= line_end:
+                    hits.append(order[k])
+                elif (pos < line_end and
+                      raw_search(data, pos, line_end) is not None):
+                    # The match runs across lines, but a shorter one does
+                    # not.
+                    hits.append(order[k])
+                # Lines between the ones of the chunk are skipped.
+                if k + 1 == len(line_starts):
+                    break
+                span = raw_search(data, line_starts[k + 1])
+            hits.sort()
+
+        if hits:
+            rows = parse_lines(fileobj, [chunk_offsets[i] for i in hits])
+            hits = [start + i for i, row in zip(hits, rows)
+                    if row[column] is not None and match_value(row[column])]
+            if backward:
+                hits.reverse()
+            for line_index in hits:
+                yield line_index
+
+        yield None
+
+
+# Arguments of _filter_chunk, which worker processes inherit from the parent
+# process (see filter_lines_parallel).  The filter function does not need to
+# be picklable this way.
+_filter_state = None
+
+
+def _filter_chunk(args):
+    """Return a string of one byte per line in [start, stop) of the offsets of
+    _filter_state, which is 1 if the line passes the filter function and 0
+    otherwise.  Called in worker processes."""
+
+    start, stop = args
+    fileobj, offsets, levels, filter_func = _filter_state
+
+    flags = bytearray(stop - start)
+    rows = parse_lines(fileobj, offsets[start:stop])
+    for i, row in enumerate(rows):
+        if filter_func(row.with_message(row[-1], levels[start + i])):
+            flags[i] = 1
+
+    return str(flags)
+
+
+def filter_lines_parallel(fileobj, offsets, levels, filter_func, jobs,
+                          chunk_size):
+    """Generator that evaluates filter_func for the rows of the lines at the
+    given offsets (with the given levels) of fileobj, which must be an mmap,
+    using jobs worker processes.  Yields None while waiting for the workers,
+    and (start, stop, flags) for each chunk of chunk_size lines in order,
+    where flags is a bytearray of 1 for passing lines and 0 otherwise."""
+
+    global _filter_state
+
+    import multiprocessing
+
+    _filter_state = (fileobj, offsets, levels, filter_func,)
+    try:
+        pool = multiprocessing.Pool(jobs)
+    finally:
+        _filter_state = None
+
+    try:
+        pending = []
+        for start in xrange(0, len(offsets), chunk_size):
+            chunk = (start, min(start + chunk_size, len(offsets)),)
+            pending.append((chunk, pool.apply_async(_filter_chunk,
+                                                    (chunk,)),))
+
+        for (start, stop,), result in pending:
+            while not result.ready():
+                result.wait(.02)
+                yield None
+            yield (start, stop, bytearray(result.get()),)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class _CodeTable (dict):
+
+    """Maps values to integer codes, which are assigned in order of first
+    appearance.  The values list is indexed by code."""
+
+    def __init__(self):
+
+        dict.__init__(self)
+
+        self.values = []
+
+    def __missing__(self, value):
+
+        code = self[value] = len(self.values)
+        self.values.append(value)
+        return code
+
+
+class ColumnIndex (object):
+
+    """The pid, thread, category, filename, function and object columns of all
+    lines of a log file, in the order of the LineCache offsets.  The string
+    columns are stored as integer codes per line (see get_code and
+    get_value), so they can be compared without parsing any lines.  Creating
+    the index parses every line, so unlike the LineCache it is not built as
+    part of loading."""
+
+    code_columns = {"category": 4,  # COL_CATEGORY
+                    "filename": 5,  # COL_FILENAME
+                    "function": 7,  # COL_FUNCTION
+                    "object": 8}    # COL_OBJECT
+
+    _lines_per_iteration = 10000
+
+    def __init__(self, fileobj, offsets):
+
+        self.fileobj = fileobj
+        self.offsets = offsets
+        self.ready = False
+
+        self.pids = array("I")
+        # Thread IDs are pointers:
+        self.threads = array(OFFSETS_TYPECODE)
+        self.codes = {}
+        self.__tables = {}
+        for name in self.code_columns:
+            self.codes[name] = array("H")
+            self.__tables[name] = _CodeTable()
+
+    def __len__(self):
+
+        return len(self.pids)
+
+    def build(self):
+        """Generator that indexes the lines that are not indexed yet.  Yields
+        after each batch of lines, see get_build_progress."""
+
+        offsets = self.offsets
+        step = self._lines_per_iteration
+
+        while len(self.pids) < len(offsets):
+            start = len(self.pids)
+            self.__add_rows(parse_lines(self.fileobj,
+                                        offsets[start:start + step]))
+            yield True
+
+        self.ready = True
+
+    def update(self, fileobj):
+        """Index lines added to the offsets array, e.g. by LineCache.update.
+        fileobj replaces the old mapping of the log file."""
+
+        self.fileobj = fileobj
+        if self.ready:
+            for x in self.build():
+                pass
+
+    def get_build_progress(self):
+
+        if not len(self.offsets):
+            return 1.
+        return float(len(self.pids)) / len(self.offsets)
+
+    def get_code(self, column, value):
+        """Return the code of value in the named column, or None if no line has
+        that value."""
+
+        return self.__tables[column].get(value)
+
+    def get_value(self, column, code):
+
+        return self.__tables[column].values[code]
+
+    def get_values(self, column):
+        """Return the distinct values of the named column, indexed by code."""
+
+        return self.__tables[column].values
+
+    def __add_rows(self, rows):
+
+        if not rows:
+            return
+
+        columns = zip(*rows)
+        self.pids.extend(columns[1])
+        self.threads.extend(columns[2])
+        for name, col_id in self.code_columns.iteritems():
+            table = self.__tables[name]
+            codes = map(table.__getitem__, columns[col_id])
+            if len(table.values) > 0x10000 and self.codes[name].typecode == "H":
+                self.codes[name] = array("I", self.codes[name])
+            self.codes[name].extend(codes)
+
+
+class _Postings (dict):
+
+    """Maps trigrams to arrays of block numbers, which are created on first
+    use."""
+
+    def __missing__(self, trigram):
+
+        blocks = self[trigram] = array("I")
+        return blocks
+
+
+def _offsets_checksum(offsets, n_lines):
+
+    data = buffer(offsets, 0, n_lines * offsets.itemsize)
+    return zlib.crc32(data) & 0xffffffff
+
+
+class TrigramIndexFile (LineIndexFile):
+
+    """Cache file holding a TrigramIndex, see LineIndexFile."""
+
+    suffix = ".gstdv-trigrams"
+    magic = "GSTDVTRI"
+    version = 3
+
+
+class TrigramIndex (object):
+
+    """The character trigrams of the lines of a log file, per block of
+    block_lines lines in the order of the LineCache offsets.  Substring
+    searches can use get_candidates to skip the blocks that cannot contain a
+    match.  Only trigrams within runs of non-whitespace characters are
+    indexed.  Trigrams found in more than common_fraction of the blocks would
+    hardly rule out any, their block lists are dropped and they are added to
+    the common set instead.
+
+    Like the ColumnIndex, the index is not built as part of loading.  If an
+    index file is given, build loads the index from it and saves it there
+    after indexing."""
+
+    block_lines = 256
+    common_fraction = .5
+    # Common trigrams are looked for when the number of blocks reaches this,
+    # and every time it doubles:
+    _min_prune_blocks = 64
+    # Blocks of lines that are further apart in the file than this are read
+    # line by line instead of in one slice:
+    _max_span = 1024 * 1024
+    _blocks_per_iteration = 16
+
+    def __init__(self, fileobj, offsets, index_file=None):
+
+        self.fileobj = fileobj
+        self.offsets = offsets
+        self.index_file = index_file
+        self.ready = False
+
+        self.postings = _Postings()
+        self.common = set()
+        self.n_blocks = 0
+        self.__prune_blocks = self._min_prune_blocks
+
+    def __len__(self):
+        """Return the number of indexed lines."""
+
+        return self.n_blocks * self.block_lines
+
+    def build(self):
+        """Generator that indexes the complete blocks of lines that are not
+        indexed yet.  Yields after each batch of blocks, see
+        get_build_progress."""
+
+        loaded = False
+        if self.index_file is not None and self.n_blocks == 0:
+            loaded = self.__load()
+
+        while self.n_blocks < len(self.offsets) // self.block_lines:
+            self.__add_blocks(min(self.n_blocks + self._blocks_per_iteration,
+                                  len(self.offsets) // self.block_lines))
+            yield True
+
+        self.ready = True
+
+        if self.index_file is not None and not loaded:
+            self.__save()
+
+    def update(self, fileobj):
+        """Index complete blocks of lines added to the offsets array, e.g. by
+        LineCache.update.  fileobj replaces the old mapping of the log file."""
+
+        self.fileobj = fileobj
+        if self.ready:
+            self.__add_blocks(len(self.offsets) // self.block_lines)
+
+    def get_build_progress(self):
+
+        n_blocks = len(self.offsets) // self.block_lines
+        if not n_blocks:
+            return 1.
+        return float(self.n_blocks) / n_blocks
+
+    def get_candidates(self, text):
+        """Return a sorted list of (start, stop) ranges of the line indices
+        that can contain text, or None if the index cannot tell (it is not
+        ready or text has no indexed trigram).  The lines after the last
+        complete block are always included."""
+
+        if not self.ready:
+            return None
+
+        trigrams = set()
+        for token in text.split():
+            trigrams.update(zip(token, token[1:], token[2:]))
+        # Common trigrams can appear in any block.
+        trigrams.difference_update(self.common)
+        if not trigrams:
+            return None
+
+        postings = self.postings
+        blocks = None
+        for block_list in sorted((postings.get(trigram, ())
+                                  for trigram in trigrams), key=len):
+            if blocks is None:
+                blocks = set(block_list)
+            else:
+                blocks.intersection_update(block_list)
+            if not blocks:
+                break
+
+        ranges = []
+        block_lines = self.block_lines
+        tail = (len(self), len(self.offsets),)
+        for start, stop in [(block * block_lines, (block + 1) * block_lines,)
+                            for block in sorted(blocks)] + [tail]:
+            if start == stop:
+                continue
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop,)
+            else:
+                ranges.append((start, stop,))
+
+        return ranges
+
+    def __add_blocks(self, stop):
+
+        fileobj = self.fileobj
+        offsets = self.offsets
+        postings = self.postings
+        common = self.common
+        block_lines = self.block_lines
+
+        for block in xrange(self.n_blocks, stop):
+            block_offsets = offsets[block * block_lines:
+                                    (block + 1) * block_lines]
+            first = min(block_offsets)
+            last = max(block_offsets)
+            if last - first <= self._max_span:
+                # Other lines in between only add false candidates.
+                end = fileobj.find("\n", last)
+                if end == -1:
+                    end = len(fileobj)
+                text = fileobj[first:end]
+            else:
+                text = "\n".join([read_line(fileobj, offset)
+                                  for offset in block_offsets])
+            # Most tokens repeat between the lines of a block.
+            tokens = "\n".join(set(text.split()))
+            trigrams = set(zip(tokens, tokens[1:], tokens[2:]))
+            trigrams.difference_update(common)
+            for trigram in trigrams:
+                postings[trigram].append(block)
+
+        self.n_blocks = stop
+
+        if stop >= self.__prune_blocks:
+            self.__prune()
+
+    def __prune(self):
+
+        # Move the trigrams of too many blocks to the common set.
+        limit = int(self.n_blocks * self.common_fraction)
+        postings = self.postings
+        for trigram, blocks in postings.items():
+            if len(blocks) > limit:
+                del postings[trigram]
+                self.common.add(trigram)
+        self.__prune_blocks = 2 * self.n_blocks
+
+    def __load(self):
+
+        def read(index_file, n_lines):
+            header = array("I")
+            header.fromfile(index_file, 4)
+            block_lines, n_trigrams, n_common, checksum = header
+            if (n_lines > len(self.offsets) or
+                    checksum != _offsets_checksum(self.offsets, n_lines)):
+                # Indexed with the lines in a different order.
+                return None
+            keys = index_file.read(3 * n_trigrams)
+            common_keys = index_file.read(3 * n_common)
+            if len(keys + common_keys) != 3 * (n_trigrams + n_common):
+                raise EOFError("trigrams missing")
+            lengths = array("I")
+            lengths.fromfile(index_file, n_trigrams)
+            blocks = array("I")
+            blocks.fromfile(index_file, sum(lengths))
+            return (block_lines, n_lines, keys, common_keys, lengths,
+                    blocks,)
+
+        result = self.index_file._read(self.fileobj, read)
+        if result is None:
+            return False
+
+        block_lines, n_lines, keys, common_keys, lengths, blocks = result
+        postings = self.postings
+        start = 0
+        for i, length in enumerate(lengths):
+            trigram = tuple(keys[3 * i:3 * i + 3])
+            postings[trigram] = blocks[start:start + length]
+            start += length
+        self.common.update([tuple(common_keys[i:i + 3])
+                            for i in xrange(0, len(common_keys), 3)])
+        self.block_lines = block_lines
+        self.n_blocks = n_lines // block_lines
+        self.__prune_blocks = max(self._min_prune_blocks, 2 * self.n_blocks)
+        return True
+
+    def __save(self):
+
+        postings = self.postings
+
+        def write(index_file):
+            array("I", [self.block_lines, len(postings), len(self.common),
+                        _offsets_checksum(self.offsets, len(self))]
+                  ).tofile(index_file)
+            trigrams = postings.keys()
+            index_file.write("".join(["".join(trigram)
+                                      for trigram in trigrams]))
+            index_file.write("".join(["".join(trigram)
+                                      for trigram in self.common]))
+            array("I", [len(postings[trigram])
+                        for trigram in trigrams]).tofile(index_file)
+            for trigram in trigrams:
+                postings[trigram].tofile(index_file)
+
+        self.index_file._write(self.fileobj, len(self), write)
 
 
 class LogLines (object):
@@ -423,12 +2550,9 @@ class LogLines (object):
     def __getitem__(self, line_index):
 
         offset = self.__line_cache.offsets[line_index]
-        self.__fileobj.seek(offset)
-        line_string = self.__fileobj.readline()
+        line_string = read_line(self.__fileobj, offset)
         line = LogLine.parse_full(line_string)
-        msg = line_string[line[-1]:]
-        line[-1] = msg
-        return line
+        return line.with_message(line_string[line[-1]:])
 
     def __iter__(self):
 
@@ -441,6 +2565,10 @@ class LogLines (object):
 
 class LogFile (Producer):
 
+    """A log file, which is mapped into memory for random access.  Compressed
+    files (gzip, xz and zstd) are read through a BlockFile, which requires a
+    one time decompression pass at the start of loading."""
+
     def __init__(self, filename, dispatcher):
 
         import mmap
@@ -451,32 +2579,143 @@ class LogFile (Producer):
 
         self.path = os.path.normpath(os.path.abspath(filename))
         self.__real_fileobj = file(filename, "rb")
-        self.fileobj = mmap.mmap(
-            self.__real_fileobj.fileno(), 0, access=mmap.ACCESS_READ)
-        self.line_cache = LineCache(self.fileobj, dispatcher)
+        self.__dispatcher = dispatcher
+        self.__building = False
+        self.__old_fileobjs = []
+        self.lines = None
+        self.column_index = None
+        self.trigram_index = None
+        if BlockFile.detect(self.__real_fileobj) is not None:
+            self.fileobj = BlockFile(self.path)
+        else:
+            self.fileobj = mmap.mmap(
+                self.__real_fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index_file = LineIndexFile(self.path)
+        self.line_cache = LineCache(self.fileobj, dispatcher,
+                                    self.index_file, self.path)
         self.line_cache.consumers.append(self)
 
     def get_full_line(self, line_index):
 
         offset = self.line_cache.offsets[line_index]
-        self.fileobj.seek(offset)
-        line_string = self.fileobj.readline()
+        line_string = read_line(self.fileobj, offset)
         line = LogLine.parse_full(line_string)
-        msg = line_string[line[-1]:]
-        line[-1] = msg
-        return line
+        return line.with_message(line_string[line[-1]:])
+
+    def get_column_index(self):
+        """Return the ColumnIndex of the log file, which is created on the
+        first call.  Its build method needs to be run (e.g. with a
+        dispatcher) before using it."""
+
+        if self.column_index is None:
+            self.column_index = ColumnIndex(self.fileobj,
+                                            self.line_cache.offsets)
+        return self.column_index
+
+    def get_trigram_index(self):
+        """Return the TrigramIndex of the log file, which is created on the
+        first call.  Like for the column index, its build method needs to be
+        run before using it."""
+
+        if self.trigram_index is None:
+            self.trigram_index = TrigramIndex(self.fileobj,
+                                              self.line_cache.offsets,
+                                              TrigramIndexFile(self.path))
+        return self.trigram_index
 
     def start_loading(self):
 
         self.logger.debug("starting load")
+
+        if isinstance(self.fileobj, BlockFile) and not self.fileobj.ready:
+            self.logger.debug("dispatching block file creation")
+            self.__building = True
+            self.have_load_started()
+            self.__dispatcher(self.__build_process())
+        else:
+            self.line_cache.start_loading()
+
+    def __build_process(self):
+
+        for x in self.fileobj.build():
+            yield True
+
+        if self.fileobj.path is None:
+            # Worker processes cannot open a temporary block file.
+            self.line_cache.path = None
+
+        self.__dispatcher.call_main(self.__build_finished)
+        yield False
+
+    def __build_finished(self):
+
         self.line_cache.start_loading()
+        self.__building = False
+
+    def abort_loading(self):
+        """Cancel loading, if it is still running, and stop the worker
+        processes of a parallel load."""
+
+        self.__dispatcher.cancel()
+        self.line_cache.close()
+
+    def update(self):
+        """Check if the log file has grown and index the appended lines.  This
+        is the basis for following files that are still being written.
+        Consumers are notified about new lines through handle_lines_appended,
+        where they have to switch to the new mapping in the fileobj
+        attribute.  The old mappings are closed afterwards.  Returns the
+        number of new lines."""
+
+        import mmap
+
+        if self.lines is None:
+            raise ValueError("log file is not loaded yet")
+
+        if isinstance(self.fileobj, BlockFile):
+            # Compressed files are not expected to grow.
+            return 0
+
+        size = os.fstat(self.__real_fileobj.fileno()).st_size
+        if size < len(self.fileobj):
+            self.logger.warning("log file was truncated, cannot follow")
+            return 0
+        elif size == len(self.fileobj):
+            return 0
+
+        self.__old_fileobjs.append(self.fileobj)
+        self.fileobj = mmap.mmap(
+            self.__real_fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        start = len(self.line_cache.offsets)
+        count = self.line_cache.update(self.fileobj)
+        self.lines = LogLines(self.fileobj, self.line_cache)
+        if self.column_index is not None:
+            self.column_index.update(self.fileobj)
+        if self.trigram_index is not None:
+            self.trigram_index.update(self.fileobj)
+        if count:
+            self.have_lines_appended(start, start + count)
+            # Without new lines, consumers might still use an old mapping.
+            for fileobj in self.__old_fileobjs:
+                fileobj.close()
+            del self.__old_fileobjs[:]
+
+        return count
 
     def get_load_progress(self):
 
+        if self.__building:
+            return self.fileobj.get_build_progress()
+
         return self.line_cache.get_progress()
 
     def handle_load_started(self):
 
+        if self.__building:
+            # Consumers were notified when creating the block file started.
+            return
+
         # Chain up to our consumers:
         self.have_load_started()
 
@@ -19,6 +19,10 @@
 
 """GStreamer Debug Viewer GUI module."""
 
+from itertools import imap, repeat
+from operator import and_, eq, ge, lt, ne, not_, or_
+
+from GstDebugViewer import Data
 from GstDebugViewer.GUI.models import LogModelBase
 
 
@@ -32,13 +36,32 @@ def get_comparison_function(all_but_this):
 
 class Filter (object):
 
-    pass
+    """Base class for filters.  filter_func (row) returns whether to keep a row.
+    Filters that only look at the level, time or Data.ColumnIndex columns can
+    also be evaluated for all lines at once, see get_mask.
+
+    Filters can be combined with AndFilter, OrFilter and NotFilter, which
+    evaluate to a single predicate or mask."""
+
+    # Names of the columns that get_mask uses: "level", "time", or one of
+    # the columns of Data.ColumnIndex ("pid", "thread" and its code
+    # columns).  None if the filter only supports filter_func.
+    index_columns = None
+
+    def get_mask(self, columns):
+        """Return an iterable of booleans telling which lines to keep.
+        columns maps the names in index_columns to the values of all lines;
+        columns.column_index is the Data.ColumnIndex of the log."""
+
+        raise NotImplementedError("derived classes must override this method")
 
 
 class DebugLevelFilter (Filter):
 
     only_this, all_but_this, this_and_above = range(3)
 
+    index_columns = ("level",)
+
     def __init__(self, debug_level, mode=0):
 
         col_id = LogModelBase.COL_LEVEL
@@ -51,39 +74,213 @@ class DebugLevelFilter (Filter):
         def filter_func(row):
             return comparison_function(row[col_id], debug_level)
         self.filter_func = filter_func
+        self.debug_level = debug_level
+        self.mode = mode
 
+    def get_mask(self, columns):
 
-class CategoryFilter (Filter):
+        if self.mode == self.this_and_above:
+            op = lt
+        elif self.mode == self.all_but_this:
+            op = eq
+        else:
+            op = ne
 
-    def __init__(self, category, all_but_this=False):
+        return imap(op, columns["level"], repeat(int(self.debug_level)))
 
-        col_id = LogModelBase.COL_CATEGORY
-        comparison_function = get_comparison_function(all_but_this)
 
-        def category_filter_func(row):
-            return comparison_function(row[col_id], category)
-        self.filter_func = category_filter_func
+class ValueFilter (Filter):
 
+    """Base class for filters on lines with (or without) a certain value in one
+    of the columns."""
 
-class ObjectFilter (Filter):
+    col_id = None
 
-    def __init__(self, object_, all_but_this=False):
+    def __init__(self, value, all_but_this=False):
 
-        col_id = LogModelBase.COL_OBJECT
+        col_id = self.col_id
         comparison_function = get_comparison_function(all_but_this)
 
-        def object_filter_func(row):
-            return comparison_function(row[col_id], object_)
-        self.filter_func = object_filter_func
+        def filter_func(row):
+            return comparison_function(row[col_id], value)
+        self.filter_func = filter_func
+        self.value = value
+        self.all_but_this = all_but_this
 
+    def get_mask(self, columns):
 
-class FilenameFilter (Filter):
+        name = self.index_columns[0]
+        value = self.value
+        if name in Data.ColumnIndex.code_columns:
+            value = columns.column_index.get_code(name, value)
+            if value is None:
+                # No line has this value.
+                value = -1
 
-    def __init__(self, filename, all_but_this=False):
+        if self.all_but_this:
+            return imap(eq, columns[name], repeat(value))
+        else:
+            return imap(ne, columns[name], repeat(value))
 
-        col_id = LogModelBase.COL_FILENAME
-        comparison_function = get_comparison_function(all_but_this)
 
-        def filename_filter_func(row):
-            return comparison_function(row[col_id], filename)
-        self.filter_func = filename_filter_func
+class CategoryFilter (ValueFilter):
+
+    col_id = LogModelBase.COL_CATEGORY
+    index_columns = ("category",)
+
+
+class ObjectFilter (ValueFilter):
+
+    col_id = LogModelBase.COL_OBJECT
+    index_columns = ("object",)
+
+
+class FilenameFilter (ValueFilter):
+
+    col_id = LogModelBase.COL_FILENAME
+    index_columns = ("filename",)
+
+
+class ThreadFilter (ValueFilter):
+
+    col_id = LogModelBase.COL_THREAD
+    index_columns = ("thread",)
+
+
+class PidFilter (ValueFilter):
+
+    col_id = LogModelBase.COL_PID
+    index_columns = ("pid",)
+
+
+class TimeRangeFilter (Filter):
+
+    """Keeps the lines with start <= timestamp < stop."""
+
+    index_columns = ("time",)
+
+    def __init__(self, start, stop):
+
+        col_id = LogModelBase.COL_TIME
+
+        def filter_func(row):
+            return start <= row[col_id] < stop
+        self.filter_func = filter_func
+        self.start = start
+        self.stop = stop
+
+    def get_mask(self, columns):
+
+        times = columns["time"]
+        return imap(and_,
+                    imap(ge, times, repeat(self.start)),
+                    imap(lt, times, repeat(self.stop)))
+
+
+class MessageFilter (Filter):
+
+    """Hides the lines with messages matching a regular expression, or with
+    all_but_this set, all other lines."""
+
+    def __init__(self, regex, all_but_this=False):
+
+        col_id = LogModelBase.COL_MESSAGE
+        search = regex.search
+
+        if all_but_this:
+            def filter_func(row):
+                return search(row[col_id]) is not None
+        else:
+            def filter_func(row):
+                return search(row[col_id]) is None
+        self.filter_func = filter_func
+
+
+class CompoundFilter (Filter):
+
+    """Base class for filters combining other filters."""
+
+    def __init__(self, filters):
+
+        self.filters = list(filters)
+
+        index_columns = []
+        for filter in self.filters:
+            if filter.index_columns is None:
+                index_columns = None
+                break
+            for name in filter.index_columns:
+                if name not in index_columns:
+                    index_columns.append(name)
+        if index_columns is not None:
+            self.index_columns = tuple(index_columns)
+
+
+class AndFilter (CompoundFilter):
+
+    """Keeps the lines that pass all of the given filters."""
+
+    def __init__(self, filters):
+
+        CompoundFilter.__init__(self, filters)
+
+        funcs = [filter.filter_func for filter in self.filters]
+
+        def filter_func(row):
+            for func in funcs:
+                if not func(row):
+                    return False
+            return True
+        self.filter_func = filter_func
+
+    def get_mask(self, columns):
+
+        masks = [filter.get_mask(columns) for filter in self.filters]
+        if not masks:
+            return repeat(True, len(columns["level"]))
+        return reduce(lambda a, b: imap(and_, a, b), masks)
+
+
+class OrFilter (CompoundFilter):
+
+    """Keeps the lines that pass any of the given filters."""
+
+    def __init__(self, filters):
+
+        CompoundFilter.__init__(self, filters)
+
+        funcs = [filter.filter_func for filter in self.filters]
+
+        def filter_func(row):
+            for func in funcs:
+                if func(row):
+                    return True
+            return False
+        self.filter_func = filter_func
+
+    def get_mask(self, columns):
+
+        masks = [filter.get_mask(columns) for filter in self.filters]
+        if not masks:
+            return repeat(False, len(columns["level"]))
+        return reduce(lambda a, b: imap(or_, a, b), masks)
+
+
+class NotFilter (Filter):
+
+    """Keeps the lines that the given filter hides."""
+
+    def __init__(self, filter):
+
+        self.filter = filter
+        self.index_columns = filter.index_columns
+
+        func = filter.filter_func
+
+        def filter_func(row):
+            return not func(row)
+        self.filter_func = filter_func
+
+    def get_mask(self, columns):
+
+        return imap(not_, self.filter.get_mask(columns))
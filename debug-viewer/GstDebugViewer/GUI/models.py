@@ -21,7 +21,9 @@
 
 from array import array
 from bisect import bisect_left
+from itertools import compress, imap
 import logging
+from operator import not_
 
 from gi.repository import GObject
 from gi.repository import Gtk
@@ -44,14 +46,18 @@ class LogModelBase (Common.GUI.GenericTreeModel):
                "COL_OBJECT", str,
                "COL_MESSAGE", str,)
 
+    # Number of rows that iter_rows_offset parses at once.
+    rows_per_chunk = 1000
+
     def __init__(self):
 
         Common.GUI.GenericTreeModel.__init__(self)
 
         # self.props.leak_references = False
 
-        self.line_offsets = array("I")
-        self.line_levels = []  # FIXME: Not so nice!
+        self.line_offsets = array(Data.OFFSETS_TYPECODE)
+        self.line_levels = array("B")
+        self.line_times = array(Data.TIMES_TYPECODE)
         self.line_cache = {}
 
     def ensure_cached(self, line_offset):
@@ -62,24 +68,79 @@ class LogModelBase (Common.GUI.GenericTreeModel):
 
         raise NotImplementedError("derived classes must override this method")
 
-    def iter_rows_offset(self):
+    def parse_offsets(self, offsets):
 
-        ensure_cached = self.ensure_cached
-        line_cache = self.line_cache
+        raise NotImplementedError("derived classes must override this method")
+
+    def get_column_index(self):
+        """Return the Data.ColumnIndex for the lines of the model, which might
+        still need to be built."""
+
+        raise NotImplementedError("derived classes must override this method")
+
+    def search_lines(self, pattern, ranges, backward=False, col_id=None):
+        """Return a Data.find_lines generator of the indices of the lines of
+        the unfiltered model in the given ranges where the column col_id (the
+        message by default) contains pattern, a string or compiled regular
+        expression."""
+
+        raise NotImplementedError("derived classes must override this method")
+
+    def get_trigram_index(self):
+        """Return the Data.TrigramIndex of the log file, which covers the
+        lines of the unfiltered model and might still need to be built."""
+
+        raise NotImplementedError("derived classes must override this method")
+
+    def filter_offsets_parallel(self, offsets, levels, filter_func, jobs,
+                                chunk_size):
+        """Return a Data.filter_lines_parallel generator for the given lines,
+        or None if the log cannot be read by worker processes."""
+
+        raise NotImplementedError("derived classes must override this method")
+
+    def get_time_pyramid(self):
+        """Return the Data.TimePyramid of the lines of the model, or None if
+        the model does not provide one."""
+
+        return None
+
+    def iter_rows_offset(self, start=0, stop=None):
+
+        line_offsets = self.line_offsets
         line_levels = self.line_levels
-        COL_LEVEL = self.COL_LEVEL
         COL_MESSAGE = self.COL_MESSAGE
-        access_offset = self.access_offset
-
-        for i, offset in enumerate(self.line_offsets):
-            ensure_cached(offset)
-            row = line_cache[offset]
-            # adjust special rows
-            row[COL_LEVEL] = line_levels[i]
-            msg_offset = row[COL_MESSAGE]
-            row[COL_MESSAGE] =  access_offset(offset + msg_offset)
-            yield (row, offset,)
-            row[COL_MESSAGE] = msg_offset
+        parse_offsets = self.parse_offsets
+        rows_per_chunk = self.rows_per_chunk
+
+        if stop is None:
+            stop = len(line_offsets)
+
+        # Rows are parsed a chunk at a time, bypassing the line cache so that
+        # a pass over the whole log does not evict the rows in view.
+        for chunk_start in xrange(start, stop, rows_per_chunk):
+            chunk_stop = min(chunk_start + rows_per_chunk, stop)
+            rows = parse_offsets(line_offsets[chunk_start:chunk_stop])
+            for i, row in enumerate(rows, chunk_start):
+                # adjust special rows
+                yield (row.with_message(row[COL_MESSAGE], line_levels[i]),
+                       line_offsets[i],)
+
+    def prefetch(self, start, stop):
+        """Make sure the rows for the given range of line indices are cached,
+        so that they are ready when they are scrolled into view."""
+
+        ensure_cached = self.ensure_cached
+        line_offsets = self.line_offsets
+
+        for i in xrange(max(start, 0), min(stop, len(line_offsets))):
+            ensure_cached(line_offsets[i])
+
+    def emit_rows_appended(self, start, stop):
+
+        for line_index in xrange(start, stop):
+            path = (line_index,)
+            self.row_inserted(path, self.get_iter(path))
 
     def on_get_flags(self):
 
@@ -125,7 +186,9 @@ class LogModelBase (Common.GUI.GenericTreeModel):
             return None
 
         if col_id == self.COL_LEVEL:
-            return self.line_levels[line_index]
+            return Data.DebugLevel(self.line_levels[line_index])
+        elif col_id == self.COL_TIME:
+            return self.line_times[line_index]
 
         line_offset = self.line_offsets[line_index]
         self.ensure_cached(line_offset)
@@ -139,10 +202,31 @@ class LogModelBase (Common.GUI.GenericTreeModel):
 
     def get_value_range(self, col_id, start, stop):
 
-        if col_id != self.COL_LEVEL:
-            raise NotImplementedError("XXX FIXME")
+        return self.get_columns_range((col_id,), start, stop)[0]
 
-        return self.line_levels[start:stop]
+    def get_columns_range(self, col_ids, start, stop):
+        """Return a sequence of values for each of the given columns, for the
+        line indices from start to stop.  The rows are parsed in one pass over
+        the log instead of going through the line cache one by one."""
+
+        columns = []
+        rows = None
+        for col_id in col_ids:
+            if col_id == self.COL_LEVEL:
+                columns.append(self.line_levels[start:stop])
+            elif col_id == self.COL_TIME:
+                columns.append(self.line_times[start:stop])
+            else:
+                if rows is None:
+                    rows = zip(*self.parse_offsets(self.line_offsets[start:stop]))
+                    if not rows:
+                        rows = [()] * len(self.column_ids)
+                if col_id == self.COL_MESSAGE:
+                    columns.append([msg.strip() for msg in rows[col_id]])
+                else:
+                    columns.append(rows[col_id])
+
+        return columns
 
     def on_iter_next(self, line_index):
 
@@ -192,41 +276,116 @@ class LogModelBase (Common.GUI.GenericTreeModel):
 
 class LazyLogModel (LogModelBase):
 
+    # Maximum number of parsed rows kept in memory.
+    cache_size = 20000
+
     def __init__(self, log_obj=None):
 
         LogModelBase.__init__(self)
 
         self.__log_obj = log_obj
+        self.__old_line_cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
 
         if log_obj:
             self.set_log(log_obj)
 
     def set_log(self, log_obj):
 
+        self.__log_obj = log_obj
         self.__fileobj = log_obj.fileobj
 
-        self.line_cache.clear()
+        self.clear_cache()
         self.line_offsets = log_obj.line_cache.offsets
         self.line_levels = log_obj.line_cache.levels
+        self.line_times = log_obj.line_cache.times
+
+    def append_lines(self, start, stop):
+        """Add the rows for lines appended to the log by LogFile.update.  The
+        line arrays are shared with the log, only the file mapping changes."""
+
+        self.__fileobj = self.__log_obj.fileobj
+        # A row parsed from a line that was still being written is stale.
+        self.clear_cache()
+        self.emit_rows_appended(start, stop)
 
     def access_offset(self, offset):
 
-        # TODO: Implement using one slice access instead of seek+readline.
-        self.__fileobj.seek(offset)
-        return self.__fileobj.readline()
+        return Data.read_line(self.__fileobj, offset)
+
+    def parse_offsets(self, offsets):
+
+        return Data.parse_lines(self.__fileobj, offsets)
+
+    def get_column_index(self):
+
+        return self.__log_obj.get_column_index()
+
+    def search_lines(self, pattern, ranges, backward=False, col_id=None):
+
+        if col_id is None:
+            col_id = self.COL_MESSAGE
+
+        return Data.find_lines(self.__fileobj, self.line_offsets, pattern,
+                               ranges, backward, col_id)
+
+    def get_trigram_index(self):
+
+        return self.__log_obj.get_trigram_index()
+
+    def get_time_pyramid(self):
+
+        return self.__log_obj.line_cache.get_time_pyramid()
+
+    def filter_offsets_parallel(self, offsets, levels, filter_func, jobs,
+                                chunk_size):
+
+        if isinstance(self.__fileobj, Data.BlockFile):
+            # Reading blocks uses the position of the shared file.
+            return None
+
+        return Data.filter_lines_parallel(self.__fileobj, offsets, levels,
+                                          filter_func, jobs, chunk_size)
+
+    def clear_cache(self):
+
+        self.line_cache.clear()
+        self.__old_line_cache.clear()
+
+    def get_cache_stats(self):
+        """Return the number of cached rows and the cache hit and miss
+        counts."""
+
+        return (len(self.line_cache) + len(self.__old_line_cache),
+                self.cache_hits, self.cache_misses,)
 
     def ensure_cached(self, line_offset):
 
-        if line_offset in self.line_cache:
+        # The cache is split into two generations, which approximates LRU
+        # eviction without any bookkeeping on hits.  Once the current
+        # generation is full, it replaces the old one; rows from the old
+        # generation are moved back to the current one when used again.
+        line_cache = self.line_cache
+        if line_offset in line_cache:
+            self.cache_hits += 1
             return
 
-        if len(self.line_cache) > 10000:
-            self.line_cache.clear()
+        row = self.__old_line_cache.pop(line_offset, None)
+        if row is not None:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            line = Data.read_line(self.__fileobj, line_offset)
+            row = Data.LogLine.parse_full(line)
 
-        self.__fileobj.seek(line_offset)
-        line = self.__fileobj.readline()
+        if len(line_cache) >= self.cache_size // 2:
+            # The line cache object is shared with the filtered models, so it
+            # is emptied in place.
+            self.__old_line_cache = line_cache.copy()
+            line_cache.clear()
 
-        self.line_cache[line_offset] = Data.LogLine.parse_full(line)
+        line_cache[line_offset] = row
 
 
 class FilteredLogModelBase (LogModelBase):
@@ -239,6 +398,10 @@ class FilteredLogModelBase (LogModelBase):
 
         self.super_model = super_model
         self.access_offset = super_model.access_offset
+        self.parse_offsets = super_model.parse_offsets
+        self.filter_offsets_parallel = super_model.filter_offsets_parallel
+        self.search_lines = super_model.search_lines
+        self.get_trigram_index = super_model.get_trigram_index
         self.ensure_cached = super_model.ensure_cached
         self.line_cache = super_model.line_cache
 
@@ -253,6 +416,19 @@ class FilteredLogModelBase (LogModelBase):
 
 class FilteredLogModel (FilteredLogModelBase):
 
+    """A model showing the lines of the super model that pass all filters.
+
+    Filters that need to parse lines are run by jobs worker processes if there
+    are at least _parallel_min_lines lines to filter.  None uses one process
+    per CPU, 1 disables this.  The results are added to the model (and
+    emitted as inserted rows) a chunk of _parallel_chunk_size lines at a time
+    while filtering, see is_streaming."""
+
+    _parallel_min_lines = 200000
+    _parallel_chunk_size = 20000
+
+    jobs = None
+
     def __init__(self, super_model):
 
         FilteredLogModelBase.__init__(self, super_model)
@@ -260,46 +436,71 @@ class FilteredLogModel (FilteredLogModelBase):
         self.logger = logging.getLogger("filtered-log-model")
 
         self.filters = []
+        # For each filter, the (sorted) super model line indices that it
+        # rejected.  Lines outside of the base range are not included.
+        self.__rejected = []
         self.reset()
         self.__active_process = None
+        self.__removed_filter = None
+        self.__saved_state = None
         self.__filter_progress = 0.
 
     def reset(self):
 
         self.logger.debug("reset filter")
 
+        self.__set_identity()
+
+        del self.filters[:]
+        del self.__rejected[:]
+
+    def __set_identity(self):
+
         self.line_offsets = self.super_model.line_offsets
         self.line_levels = self.super_model.line_levels
+        self.line_times = self.super_model.line_times
         self.super_index = xrange(len(self.line_offsets))
 
-        del self.filters[:]
+        # The range of super model lines that is shown, and the one that the
+        # line arrays (without SubRange) cover, see set_range.
+        self.__range = (0, len(self.line_offsets),)
+        self.__base_range = self.__range
+        self.__time_pyramid = None
 
     def __filter_process(self, filter):
 
         YIELD_LIMIT = 10000
 
         self.logger.debug("preparing new filter")
-        new_line_offsets = array("I")
-        new_line_levels = []
+        new_line_offsets = array(Data.OFFSETS_TYPECODE)
+        new_line_levels = array("B")
+        new_line_times = array(Data.TIMES_TYPECODE)
         new_super_index = array("I")
+        rejected = array("I")
         level_id = self.COL_LEVEL
         func = filter.filter_func
+        model = self
+        super_index = self.super_index
+        line_times = model.line_times
 
         def enum():
             i = 0
-            for row, offset in self.iter_rows_offset():
-                line_index = self.super_index[i]
-                yield (line_index, row, offset,)
+            for row, offset in model.iter_rows_offset():
+                line_index = super_index[i]
+                yield (line_index, row, offset, line_times[i],)
                 i += 1
         self.logger.debug("running filter")
         progress = 0.
-        progress_full = float(len(self))
+        progress_full = float(len(model))
         y = YIELD_LIMIT
-        for i, row, offset in enum():
+        for i, row, offset, ts in enum():
             if func(row):
                 new_line_offsets.append(offset)
                 new_line_levels.append(row[level_id])
+                new_line_times.append(ts)
                 new_super_index.append(i)
+            else:
+                rejected.append(i)
             y -= 1
             if y == 0:
                 progress += float(YIELD_LIMIT)
@@ -308,13 +509,189 @@ class FilteredLogModel (FilteredLogModelBase):
                 yield True
         self.line_offsets = new_line_offsets
         self.line_levels = new_line_levels
+        self.line_times = new_line_times
         self.super_index = new_super_index
+        self.__base_range = self.__range
+        self.__clip_rejected()
+        self.__rejected.append(rejected)
         self.logger.debug("filtering finished")
 
         self.__filter_progress = 1.
         self.__handle_filter_process_finished()
         yield False
 
+    def __index_filter_process(self, filter):
+
+        # Fast path: The filter is evaluated over the level and time arrays
+        # and the column index at once, without parsing any lines.
+        model = self
+        super_index = self.super_index
+
+        column_index = None
+        for name in filter.index_columns:
+            if name not in ("level", "time",):
+                column_index = self.super_model.get_column_index()
+        if column_index is not None:
+            if not column_index.ready:
+                self.logger.debug("building column index")
+            for x in column_index.build():
+                self.__filter_progress = column_index.get_build_progress()
+                yield True
+
+        self.logger.debug("running filter")
+        columns = _FilterColumns(model.line_levels, model.line_times,
+                                 super_index, column_index)
+        mask = list(filter.get_mask(columns))
+        self.line_offsets = array(Data.OFFSETS_TYPECODE,
+                                  compress(model.line_offsets, mask))
+        self.line_levels = array("B", compress(model.line_levels, mask))
+        self.line_times = array(Data.TIMES_TYPECODE,
+                                compress(model.line_times, mask))
+        self.super_index = array("I", compress(super_index, mask))
+        self.__base_range = self.__range
+        self.__clip_rejected()
+        self.__rejected.append(array("I", compress(super_index,
+                                                   imap(not_, mask))))
+        self.logger.debug("filtering finished")
+
+        self.__filter_progress = 1.
+        self.__handle_filter_process_finished()
+        yield False
+
+    def __parallel_filter_process(self, filter, results):
+
+        model = self
+        super_index = self.super_index
+        line_offsets = model.line_offsets
+        line_levels = model.line_levels
+        line_times = model.line_times
+
+        # The results are streamed into new line arrays, abort_process puts
+        # back the old ones.
+        self.__saved_state = (self.__get_columns(), self.__range,
+                              self.__base_range,)
+        self.line_offsets = array(Data.OFFSETS_TYPECODE)
+        self.line_levels = array("B")
+        self.line_times = array(Data.TIMES_TYPECODE)
+        self.super_index = array("I")
+        self.__base_range = self.__range
+        rejected = array("I")
+
+        self.logger.debug("running filter in worker processes")
+        progress_full = float(len(line_offsets))
+        for result in results:
+            if result is None:
+                yield True
+                continue
+            start, stop, mask = result
+            first = len(self.line_offsets)
+            self.line_offsets.extend(compress(line_offsets[start:stop], mask))
+            self.line_levels.extend(compress(line_levels[start:stop], mask))
+            self.line_times.extend(compress(line_times[start:stop], mask))
+            if isinstance(super_index, xrange):
+                chunk_super_index = xrange(super_index[start],
+                                           super_index[start] + stop - start)
+            else:
+                chunk_super_index = super_index[start:stop]
+            self.super_index.extend(compress(chunk_super_index, mask))
+            rejected.extend(compress(chunk_super_index, imap(not_, mask)))
+            self.emit_rows_appended(first, len(self.line_offsets))
+            self.__filter_progress = stop / progress_full
+            yield True
+
+        self.__saved_state = None
+        self.__clip_rejected()
+        self.__rejected.append(rejected)
+        self.logger.debug("filtering finished")
+
+        self.__filter_progress = 1.
+        self.__handle_filter_process_finished()
+        yield False
+
+    def __get_jobs(self):
+
+        if self.jobs is not None:
+            return self.jobs
+
+        import multiprocessing
+
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+    def __start_process(self, filter, dispatcher):
+
+        if self.__active_process is not None:
+            raise ValueError("dispatched a filter process already")
+
+        self.__dispatcher = dispatcher
+        if filter.index_columns is not None:
+            self.__active_process = self.__index_filter_process(filter)
+        else:
+            results = None
+            jobs = self.__get_jobs()
+            if jobs > 1 and len(self) >= self._parallel_min_lines:
+                results = self.filter_offsets_parallel(
+                    self.line_offsets, self.line_levels,
+                    filter.filter_func, jobs, self._parallel_chunk_size)
+            if results is not None:
+                self.__active_process = self.__parallel_filter_process(
+                    filter, results)
+            else:
+                self.__active_process = self.__filter_process(filter)
+        dispatcher(self.__active_process)
+
+    def __remove_filter_process(self, position):
+
+        # The lines rejected by the removed filter are run through the filters
+        # that came after it.  The ones passing all of them are shown again,
+        # the others are now rejected by another filter.
+        filters = self.filters[position:]
+        lines = array("I", self.__rejected[position])
+        rejected = [array("I") for filter in filters]
+
+        self.logger.debug("running remaining filters")
+        for x in self.__filter_lines(filters, lines, rejected):
+            yield True
+
+        del self.__rejected[position]
+        for i, new_lines in enumerate(rejected, position):
+            self.__rejected[i] = array("I", sorted(self.__rejected[i] +
+                                                   new_lines))
+
+        super_index = getattr(self.super_index, "l", self.super_index)
+        super_index = array("I", sorted(super_index + lines))
+        (self.line_offsets, self.line_levels, self.line_times,
+         self.super_index,) = self.__get_super_columns(super_index)
+        super_start, super_stop = self.__range
+        self.__range = self.__base_range
+        self.set_range(super_start, super_stop)
+        self.logger.debug("filtering finished")
+
+        self.__filter_progress = 1.
+        self.__handle_filter_process_finished()
+        yield False
+
+    def get_time_pyramid(self):
+
+        if not self.filters and self.__range == (0, len(self.super_model),):
+            return self.super_model.get_time_pyramid()
+
+        if self.__time_pyramid is None:
+            # Counted from the time and level arrays, without going through
+            # the rows again.
+            self.__time_pyramid = Data.TimePyramid()
+            self.__time_pyramid.add(self.line_times, self.line_levels)
+        return self.__time_pyramid
+
+    def is_streaming(self):
+        """Return whether the running filter process adds the lines to the
+        model while filtering.  Otherwise, the line arrays are replaced when
+        the process finishes, so views should not use the model meanwhile."""
+
+        return self.__saved_state is not None
+
     def add_filter(self, filter, dispatcher):
 
         if self.__active_process is not None:
@@ -323,9 +700,34 @@ class FilteredLogModel (FilteredLogModelBase):
         self.logger.debug("adding filter")
 
         self.filters.append(filter)
+        self.__removed_filter = None
+
+        self.__start_process(filter, dispatcher)
+
+    def remove_filter(self, filter, dispatcher):
+        """Remove one of the active filters.  Only the lines that this filter
+        rejected are run through the filters that were added after it.  A
+        range restriction (see set_range) is kept."""
+
+        if self.__active_process is not None:
+            raise ValueError("dispatched a filter process already")
+
+        self.logger.debug("removing filter")
+
+        position = self.filters.index(filter)
+        del self.filters[position]
+        self.__removed_filter = (position, filter,)
+
+        if not self.filters:
+            super_start, super_stop = self.__range
+            self.reset()
+            self.set_range(super_start, super_stop)
+            self.__removed_filter = None
+            self.__handle_filter_process_finished()
+            return
 
         self.__dispatcher = dispatcher
-        self.__active_process = self.__filter_process(filter)
+        self.__active_process = self.__remove_filter_process(position)
         dispatcher(self.__active_process)
 
     def abort_process(self):
@@ -334,10 +736,24 @@ class FilteredLogModel (FilteredLogModelBase):
             raise ValueError("no filter process running")
 
         self.__dispatcher.cancel()
+        # Stops the worker processes, if any.
+        self.__active_process.close()
         self.__active_process = None
         self.__dispatcher = None
 
-        del self.filters[-1]
+        if self.__saved_state is not None:
+            (columns, self.__range, self.__base_range,) = self.__saved_state
+            (self.line_offsets, self.line_levels, self.line_times,
+             self.super_index,) = columns
+            self.__saved_state = None
+        self.__time_pyramid = None
+
+        if self.__removed_filter is None:
+            del self.filters[-1]
+        else:
+            position, filter = self.__removed_filter
+            self.filters.insert(position, filter)
+            self.__removed_filter = None
 
     def get_filter_progress(self):
 
@@ -349,12 +765,144 @@ class FilteredLogModel (FilteredLogModelBase):
     def __handle_filter_process_finished(self):
 
         self.__active_process = None
+        self.__time_pyramid = None
         self.handle_process_finished()
 
     def handle_process_finished(self):
 
         pass
 
+    def super_lines_appended(self, super_start, super_stop):
+        """Add rows for lines appended to the super model that pass all active
+        filters.  If set_range restricted the range to end before the old
+        last line, the new lines lie outside of it and stay hidden."""
+
+        if self.__active_process is not None:
+            raise ValueError("cannot add lines while a filter process is running")
+
+        range_start, range_stop = self.__range
+        if range_stop != super_start:
+            return
+
+        if not self.filters and range_start == 0:
+            # Identity, the line arrays are shared with the super model.
+            start = super_start
+            self.super_index = xrange(super_stop)
+            self.__range = (0, super_stop,)
+            self.__base_range = self.__range
+            self.emit_rows_appended(start, super_stop)
+            return
+
+        start = len(self.line_offsets)
+        self.__unwrap_range()
+        new_columns, rejected = self.__filter_super_range(super_start,
+                                                          super_stop)
+        for column, new_values in zip(self.__get_columns(), new_columns):
+            column.extend(new_values)
+        for lines, new_lines in zip(self.__rejected, rejected):
+            lines.extend(new_lines)
+        self.__range = (range_start, super_stop,)
+        self.__base_range = self.__range
+        if self.__time_pyramid is not None:
+            self.__time_pyramid.add(self.line_times, self.line_levels, start)
+
+        self.emit_rows_appended(start, len(self.line_offsets))
+
+    def __get_columns(self):
+
+        return (self.line_offsets, self.line_levels, self.line_times,
+                self.super_index,)
+
+    def __unwrap_range(self):
+
+        # Turn the line arrays into ones covering just the shown range.
+        if self.__range == self.__base_range:
+            return
+
+        self.line_offsets = array(Data.OFFSETS_TYPECODE, self.line_offsets)
+        self.line_levels = array("B", self.line_levels)
+        self.line_times = array(Data.TIMES_TYPECODE, self.line_times)
+        self.super_index = array("I", self.super_index)
+        self.__base_range = self.__range
+        self.__clip_rejected()
+
+    def __clip_rejected(self):
+
+        # Drop the lines outside of the base range from the rejected lines.
+        start, stop = self.__base_range
+        for i, lines in enumerate(self.__rejected):
+            if len(lines) and (lines[0] < start or lines[-1] >= stop):
+                self.__rejected[i] = lines[bisect_left(lines, start):
+                                           bisect_left(lines, stop)]
+
+    def __get_super_columns(self, super_index):
+
+        # Returns the line arrays for the given super model lines.
+        super_model = self.super_model
+        return (array(Data.OFFSETS_TYPECODE,
+                      imap(super_model.line_offsets.__getitem__, super_index)),
+                array("B", imap(super_model.line_levels.__getitem__,
+                                super_index)),
+                array(Data.TIMES_TYPECODE,
+                      imap(super_model.line_times.__getitem__, super_index)),
+                super_index,)
+
+    def __filter_lines(self, filters, super_index, rejected):
+
+        # Removes the lines that do not pass all filters from super_index, an
+        # array of sorted super model line indices, appending the lines that
+        # each filter rejects to the corresponding array in rejected.  This is
+        # a generator that yields True periodically.
+        super_model = self.super_model
+        for n, (filter, filter_rejected,) in enumerate(zip(filters, rejected)):
+            self.__filter_progress = float(n) / len(filters)
+            if filter.index_columns is not None:
+                column_index = None
+                for name in filter.index_columns:
+                    if name not in ("level", "time",):
+                        column_index = super_model.get_column_index()
+                if column_index is not None:
+                    for x in column_index.build():
+                        yield True
+                columns = _FilterColumns(
+                    map(super_model.line_levels.__getitem__, super_index),
+                    map(super_model.line_times.__getitem__, super_index),
+                    super_index, column_index)
+                mask = list(filter.get_mask(columns))
+            else:
+                func = filter.filter_func
+                COL_MESSAGE = self.COL_MESSAGE
+                line_offsets = super_model.line_offsets
+                line_levels = super_model.line_levels
+                rows_per_chunk = self.rows_per_chunk
+                mask = []
+                for chunk_start in xrange(0, len(super_index), rows_per_chunk):
+                    chunk = super_index[chunk_start:
+                                        chunk_start + rows_per_chunk]
+                    rows = self.parse_offsets(map(line_offsets.__getitem__,
+                                                  chunk))
+                    for row, i in zip(rows, chunk):
+                        # adjust special rows
+                        row = row.with_message(row[COL_MESSAGE],
+                                               line_levels[i])
+                        mask.append(func(row))
+                    yield True
+            filter_rejected.extend(compress(super_index, imap(not_, mask)))
+            super_index[:] = array("I", compress(super_index, mask))
+            yield True
+
+    def __filter_super_range(self, super_start, super_stop):
+
+        # Returns new line arrays for the lines of the super model in the
+        # given range that pass the filters, and the lines that each filter
+        # rejected.
+        super_index = array("I", xrange(super_start, super_stop))
+        rejected = [array("I") for filter in self.filters]
+        for x in self.__filter_lines(self.filters, super_index, rejected):
+            pass
+
+        return self.__get_super_columns(super_index), rejected
+
     def line_index_from_super(self, super_line_index):
 
         return bisect_left(self.super_index, super_line_index)
@@ -364,39 +912,92 @@ class FilteredLogModel (FilteredLogModelBase):
         return self.super_index[line_index]
 
     def set_range(self, super_start, super_stop):
-
-        old_super_start = self.line_index_to_super(0)
-        old_super_stop = self.line_index_to_super(
-            len(self.super_index) - 1) + 1
+        """Show only the lines between the given line indices of the super
+        model (that pass the filters).  When widening the range, only the
+        lines that become visible are filtered."""
 
         self.logger.debug("set range (%i, %i), current (%i, %i)",
-                          super_start, super_stop, old_super_start, old_super_stop)
+                          super_start, super_stop, *self.__range)
+
+        self.__time_pyramid = None
 
         if len(self.filters) == 0:
             # Identity.
+            if (super_start, super_stop,) == (0, len(self.super_model),):
+                self.__set_identity()
+                return
             self.super_index = xrange(super_start, super_stop)
             self.line_offsets = SubRange(self.super_model.line_offsets,
                                          super_start, super_stop)
             self.line_levels = SubRange(self.super_model.line_levels,
                                         super_start, super_stop)
+            self.line_times = SubRange(self.super_model.line_times,
+                                       super_start, super_stop)
+            self.__range = (super_start, super_stop,)
+            self.__base_range = (0, len(self.super_model),)
             return
 
-        if super_start < old_super_start:
-            # TODO:
-            raise NotImplementedError("Only handling further restriction of the range"
-                                      " (start offset = %i)" % (start_offset,))
-
-        if super_stop > old_super_stop:
-            # TODO:
-            raise NotImplementedError("Only handling further restriction of the range"
-                                      " (end offset = %i)" % (stop_offset,))
+        columns = [getattr(column, "l", column)
+                   for column in self.__get_columns()]
+        base_start, base_stop = self.__base_range
+
+        if super_start < base_start or super_stop > base_stop:
+            if super_start < base_start:
+                before, rejected = self.__filter_super_range(super_start,
+                                                             base_start)
+                columns = [new + old for new, old in zip(before, columns)]
+                self.__rejected = [new + old for new, old
+                                   in zip(rejected, self.__rejected)]
+                base_start = super_start
+            if super_stop > base_stop:
+                after, rejected = self.__filter_super_range(base_stop,
+                                                            super_stop)
+                columns = [old + new for old, new in zip(columns, after)]
+                self.__rejected = [old + new for old, new
+                                   in zip(self.__rejected, rejected)]
+                base_stop = super_stop
+            self.__base_range = (base_start, base_stop,)
+
+        self.__range = (super_start, super_stop,)
+        if self.__range != self.__base_range:
+            super_index = columns[-1]
+            start = bisect_left(super_index, super_start)
+            stop = bisect_left(super_index, super_stop)
+            columns = [SubRange(column, start, stop) for column in columns]
+
+        (self.line_offsets, self.line_levels, self.line_times,
+         self.super_index,) = columns
+
+
+class _FilterColumns (dict):
+
+    """The values of the columns named in Filter.index_columns for the lines of
+    a filtered model, which are fetched on first use."""
+
+    def __init__(self, line_levels, line_times, super_index, column_index):
+
+        dict.__init__(self, level=line_levels, time=line_times)
+
+        self.super_index = super_index
+        self.column_index = column_index
+
+    def __missing__(self, name):
+
+        column_index = self.column_index
+        if name == "pid":
+            values = column_index.pids
+        elif name == "thread":
+            values = column_index.threads
+        else:
+            values = column_index.codes[name]
 
-        start = self.line_index_from_super(super_start)
-        stop = self.line_index_from_super(super_stop)
+        super_index = self.super_index
+        if not (isinstance(super_index, xrange) and
+                len(super_index) == len(values)):
+            values = map(values.__getitem__, super_index)
 
-        self.super_index = SubRange(self.super_index, start, stop)
-        self.line_offsets = SubRange(self.line_offsets, start, stop)
-        self.line_levels = SubRange(self.line_levels, start, stop)
+        self[name] = values
+        return values
 
 
 class SubRange (object):
@@ -422,13 +1023,9 @@ class SubRange (object):
     def __getitem__(self, i):
 
         if isinstance(i, slice):
-            stop = i.stop
-            if stop >= 0:
-                stop += self.start
-            else:
-                stop += self.stop
+            start, stop, step = i.indices(len(self))
 
-            return self.l[i.start + self.start:stop]
+            return self.l[start + self.start:stop + self.start:step]
         else:
             return self.l[i + self.start]
 
@@ -449,15 +1046,18 @@ class LineViewLogModel (FilteredLogModelBase):
 
         FilteredLogModelBase.__init__(self, super_model)
 
-        self.line_offsets = []
-        self.line_levels = []
+        self.line_offsets = array(Data.OFFSETS_TYPECODE)
+        self.line_levels = array("B")
+        self.line_times = array(Data.TIMES_TYPECODE)
 
-        self.parent_indices = []
+        self.parent_indices = array("I")
 
     def reset(self):
 
         del self.line_offsets[:]
         del self.line_levels[:]
+        del self.line_times[:]
+        del self.parent_indices[:]
 
     def line_index_to_super(self, line_index):
 
@@ -470,6 +1070,7 @@ class LineViewLogModel (FilteredLogModelBase):
         li = super_line_index
         self.line_offsets.insert(position, self.super_model.line_offsets[li])
         self.line_levels.insert(position, self.super_model.line_levels[li])
+        self.line_times.insert(position, self.super_model.line_times[li])
         self.parent_indices.insert(position, super_line_index)
 
         path = (position,)
@@ -481,6 +1082,7 @@ class LineViewLogModel (FilteredLogModelBase):
         li = line_index
         self.line_offsets[li] = self.super_model.line_offsets[super_line_index]
         self.line_levels[li] = self.super_model.line_levels[super_line_index]
+        self.line_times[li] = self.super_model.line_times[super_line_index]
         self.parent_indices[li] = super_line_index
 
         path = (line_index,)
@@ -491,6 +1093,7 @@ class LineViewLogModel (FilteredLogModelBase):
 
         for l in (self.line_offsets,
                   self.line_levels,
+                  self.line_times,
                   self.parent_indices,):
             del l[line_index]
 
@@ -143,9 +143,8 @@ class LineView (object):
             return
 
         if len(line_model):
-            timestamps = [row[line_model.COL_TIME] for row in line_model]
-            row = log_model[(line_index,)]
-            position = bisect_right(timestamps, row[line_model.COL_TIME])
+            position = bisect_right(line_model.line_times,
+                                    log_model.line_times[line_index])
         else:
             position = 0
         if len(line_model) > 1:
@@ -232,6 +231,10 @@ class Window (object):
         self.info_widget = None
         self.progress_dialog = None
         self.update_progress_id = None
+        self.follow_id = None
+        self.prefetch_id = None
+        self.scroll_value = 0.
+        self.scroll_forward = True
 
         self.window_state = Common.GUI.WindowState()
         self.column_manager = ViewColumnManager(app.state_section)
@@ -264,8 +267,11 @@ class Window (object):
              ("shrink-text", Gtk.STOCK_ZOOM_OUT, _(
               "Shrink Text"), "<Ctrl>minus"),
              ("reset-text", Gtk.STOCK_ZOOM_100, _("Normal Text Size"), "<Ctrl>0")])
+        group.add_toggle_actions(
+            [("follow-file", None, _("_Follow File"), "<Ctrl>T")])
         self.actions.add_group(group)
         self.actions.reload_file.props.sensitive = False
+        self.actions.follow_file.props.sensitive = False
 
         group = Gtk.ActionGroup("RowActions")
         group.add_actions(
@@ -274,6 +280,8 @@ class Window (object):
               "Hide lines after this point")),
              ("show-hidden-lines", None, _(
               "Show hidden lines")),
+             ("remove-last-filter", None, _(
+              "Remove last filter")),
              ("edit-copy-line", Gtk.STOCK_COPY, _(
               "Copy line"), "<Ctrl>C"),
              ("edit-copy-message", Gtk.STOCK_COPY, _(
@@ -301,6 +309,8 @@ class Window (object):
         self.log_file = None
         self.log_model = None
         self.log_filter = None
+        # (model, rows) of the current search, as set by the find bar.
+        self.search_matches = None
 
         self.widget_factory = Common.GUI.WidgetFactory(Main.Paths.data_dir)
         self.widgets = self.widget_factory.make(
@@ -320,6 +330,8 @@ class Window (object):
         self.log_view.set_search_column(-1)
         sel = self.log_view.get_selection()
         sel.connect("changed", self.handle_log_view_selection_changed)
+        self.log_view.get_vadjustment().connect(
+            "value-changed", self.handle_log_view_adjustment_value_changed)
 
         self.view_popup = ui.get_widget(
             "/ui/context/LogViewContextMenu").get_submenu()
@@ -397,6 +409,14 @@ class Window (object):
 
     def detach(self):
 
+        if self.follow_id is not None:
+            GObject.source_remove(self.follow_id)
+            self.follow_id = None
+
+        if self.prefetch_id is not None:
+            GObject.source_remove(self.prefetch_id)
+            self.prefetch_id = None
+
         self.set_log_file(None)
         for feature in self.features:
             feature.handle_detach_window(self)
@@ -404,6 +424,42 @@ class Window (object):
         self.window_state.detach()
         self.column_manager.detach()
 
+    def handle_log_view_adjustment_value_changed(self, adjustment):
+
+        value = adjustment.props.value
+        self.scroll_forward = value >= self.scroll_value
+        self.scroll_value = value
+
+        if self.prefetch_id is None:
+            self.prefetch_id = GObject.idle_add(self.prefetch_rows)
+
+    def prefetch_rows(self):
+
+        self.prefetch_id = None
+
+        model = self.log_view.get_model()
+        vis_range = self.log_view.get_visible_range()
+        if model is None or vis_range is None:
+            return False
+
+        # Parse the rows of the next pages in the scroll direction while
+        # idle.
+        start_path, end_path = vis_range
+        start_index = start_path[0]
+        stop_index = end_path[0] + 1
+        margin = (stop_index - start_index) * 2
+        if self.scroll_forward:
+            model.prefetch(start_index, stop_index + margin)
+        else:
+            model.prefetch(start_index - margin, stop_index)
+
+        size, hits, misses = self.log_model.get_cache_stats()
+        scrollbar = self.widgets.log_view_scrolled_window.get_vscrollbar()
+        scrollbar.set_tooltip_text(
+            _("%i cached lines, %i hits, %i misses") % (size, hits, misses,))
+
+        return False
+
     def get_active_line_index(self):
 
         selection = self.log_view.get_selection()
@@ -514,6 +570,19 @@ class Window (object):
                         path, use_align=True, row_align=0.)
                     break
 
+    def set_search_matches(self, model, rows):
+        """Set the rows (an ascending array of row indices) of model that
+        match the current search, or None if there is no search.  Features
+        are notified with handle_search_matches_changed."""
+
+        if rows is None:
+            self.search_matches = None
+        else:
+            self.search_matches = (model, rows,)
+
+        for feature in self.features:
+            feature.handle_search_matches_changed(self)
+
     def update_view(self):
 
         view = self.log_view
@@ -574,6 +643,32 @@ class Window (object):
 
         self.set_log_file(self.log_file.path)
 
+    @action
+    def handle_follow_file_action_activate(self, action):
+
+        if action.props.active:
+            if self.follow_id is None:
+                self.follow_id = GObject.timeout_add(1000, self.update_follow)
+        elif self.follow_id is not None:
+            GObject.source_remove(self.follow_id)
+            self.follow_id = None
+
+    def update_follow(self):
+
+        if self.log_file is None or self.progress_dialog is not None:
+            # Nothing loaded, or busy loading/filtering.
+            return True
+
+        try:
+            self.log_file.update()
+        except EnvironmentError as exc:
+            self.logger.warning("cannot follow log file: %s", exc)
+            self.follow_id = None
+            self.actions.follow_file.props.active = False
+            return False
+
+        return True
+
     @action
     def handle_cancel_load_action_activate(self, action):
 
@@ -666,6 +761,15 @@ class Window (object):
         self.update_model(self.log_filter)
         self.pop_view_state(scroll_to_selection=True)
         self.actions.show_hidden_lines.props.sensitive = False
+        self.actions.remove_last_filter.props.sensitive = False
+
+    @action
+    def handle_remove_last_filter_action_activate(self, action):
+
+        if not self.log_filter.filters:
+            return
+
+        self.remove_model_filter(self.log_filter.filters[-1])
 
     @action
     def handle_edit_copy_line_action_activate(self, action):
@@ -761,6 +865,21 @@ class Window (object):
 
         self.set_sensitive(False)
 
+    def remove_model_filter(self, filter):
+
+        self.progress_dialog = ProgressDialog(self, _("Filtering"))
+        self.show_info(self.progress_dialog.widget)
+        self.progress_dialog.handle_cancel = self.handle_filter_progress_dialog_cancel
+        dispatcher = Common.Data.GSourceDispatcher()
+
+        self.push_view_state()
+        self.log_view.set_model(None)
+        self.set_sensitive(False)
+        GObject.timeout_add(250, self.update_filter_progress)
+
+        # Finishes right away if this was the only filter.
+        self.log_filter.remove_filter(filter, dispatcher=dispatcher)
+
     def update_filter_progress(self):
 
         if self.progress_dialog is None:
@@ -774,6 +893,11 @@ class Window (object):
 
         self.progress_dialog.update(progress)
 
+        if (self.log_filter.is_streaming() and len(self.log_filter) and
+                self.log_view.get_model() is None):
+            # Show the first results while the rest is still being filtered.
+            self.log_view.set_model(self.log_filter)
+
         return True
 
     def handle_filter_progress_dialog_cancel(self):
@@ -781,6 +905,8 @@ class Window (object):
         self.hide_info()
         self.progress_dialog = None
 
+        # Aborting can put back the old line arrays of a streaming filter.
+        self.log_view.set_model(None)
         self.log_filter.abort_process()
         self.log_view.set_model(self.log_filter)
         self.pop_view_state()
@@ -797,6 +923,8 @@ class Window (object):
         self.pop_view_state()
 
         self.actions.show_hidden_lines.props.sensitive = True
+        self.actions.remove_last_filter.props.sensitive = bool(
+            self.log_filter.filters)
 
         self.set_sensitive(True)
 
@@ -899,6 +1027,7 @@ class Window (object):
         if self.log_file is not None:
             for feature in self.features:
                 feature.handle_detach_log_file(self, self.log_file)
+            self.log_file.abort_loading()
 
         if filename is None:
             if self.dispatcher is not None:
@@ -906,13 +1035,19 @@ class Window (object):
             self.dispatcher = None
             self.log_file = None
             self.actions.groups["RowActions"].props.sensitive = False
+            self.actions.follow_file.props.sensitive = False
         else:
             self.logger.debug("setting log file %r", filename)
 
             try:
                 self.setup_model(LazyLogModel())
 
-                self.dispatcher = Common.Data.GSourceDispatcher()
+                if self.dispatcher is not None:
+                    self.dispatcher.cancel()
+                # Loading only hands consumer notifications to the main loop,
+                # so it can run in a worker thread.
+                self.dispatcher = Common.Data.ThreadedDispatcher()
+                self.dispatcher.handle_error = self.handle_load_error
                 self.log_file = Data.LogFile(filename, self.dispatcher)
             except EnvironmentError as exc:
                 try:
@@ -972,6 +1107,11 @@ class Window (object):
 
         self.actions.cancel_load.activate()
 
+    def handle_load_error(self, exc):
+
+        self.actions.cancel_load.activate()
+        self.show_error(_("Could not load file"), str(exc))
+
     def update_load_progress(self):
 
         if self.progress_dialog is None:
@@ -996,8 +1136,10 @@ class Window (object):
         self.log_filter.reset()
 
         self.actions.reload_file.props.sensitive = True
+        self.actions.follow_file.props.sensitive = True
         self.actions.groups["RowActions"].props.sensitive = True
         self.actions.show_hidden_lines.props.sensitive = False
+        self.actions.remove_last_filter.props.sensitive = False
 
         self.set_sensitive(True)
 
@@ -1019,3 +1161,21 @@ class Window (object):
             return False
 
         GObject.idle_add(idle_set)
+
+    def handle_lines_appended(self, start, stop):
+
+        self.logger.debug("%i lines appended", stop - start)
+
+        # Keep following the end of the log if it is in view.
+        at_end = False
+        vis_range = self.log_view.get_visible_range()
+        if vis_range is not None and self.log_view.get_model() is self.log_filter:
+            start_path, end_path = vis_range
+            at_end = end_path[0] >= len(self.log_filter) - 1
+
+        self.log_model.append_lines(start, stop)
+        self.log_filter.super_lines_appended(start, stop)
+
+        if at_end and len(self.log_filter):
+            path = (len(self.log_filter) - 1,)
+            self.log_view.scroll_to_cell(path, use_align=True, row_align=1.)
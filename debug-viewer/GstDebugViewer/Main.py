@@ -50,6 +50,12 @@ class OptionParser (Common.Main.LogOptionParser):
         options["args"] = []
 
         self.add_option("version", None, _("Display version and exit"))
+        self.add_option("index-next-to-log", None,
+                        _("Store line indices next to the log files instead "
+                          "of the cache directory"))
+        self.add_option("clear-cache", None,
+                        _("Remove the cached indices and decompressed logs "
+                          "and exit"))
 
     def get_parameter_string(self):
 
@@ -65,6 +71,15 @@ class OptionParser (Common.Main.LogOptionParser):
             main_version()
             sys.exit(0)
 
+        if "clear_cache" in self.options:
+            from GstDebugViewer import Data
+            Data.prune_cache(0)
+            sys.exit(0)
+
+        if "index_next_to_log" in self.options:
+            from GstDebugViewer import Data
+            Data.LineIndexFile.next_to_log = True
+
         if self.options["main"] is None:
             from GstDebugViewer import GUI
             self.options["main"] = GUI.main
@@ -20,44 +20,88 @@
 """GStreamer Debug Viewer timeline widget plugin."""
 
 import logging
+import re
+from array import array
+from bisect import bisect_left, bisect_right
 
 from GstDebugViewer import Common, Data, GUI
 from GstDebugViewer.Plugins import FeatureBase, PluginBase, _N
 
-from gettext import gettext as _
+from gettext import gettext as _, ngettext
 from gi.repository import GObject, GLib
 from gi.repository import Gtk
 
 
 class SearchOperation (object):
 
-    def __init__(self, model, search_text, search_forward=True, start_position=None):
+    def __init__(self, model, search_text, match_case=True, use_regex=False,
+                 col_id=None):
+        """Raises re.error if use_regex is set and search_text is not a valid
+        regular expression."""
+
+        if col_id is None:
+            col_id = GUI.models.LogModelBase.COL_MESSAGE
 
         self.model = model
         self.search_text = search_text
-        self.search_forward = search_forward
-        self.start_position = start_position
-
-        col_id = GUI.models.LogModelBase.COL_MESSAGE
-        len_search_text = len(search_text)
-
-        def match_func(model_row):
-
-            message = model_row[col_id]
-            if search_text in message:
-                ranges = []
-                start = 0
-                while True:
-                    pos = message.find(search_text, start)
-                    if pos == -1:
-                        break
-                    ranges.append((pos, pos + len_search_text,))
-                    start = pos + len_search_text
-                return ranges
+        self.col_id = col_id
+
+        # Plain, case sensitive searches use the faster substring search.
+        if match_case and not use_regex:
+            self.pattern = search_text
+        else:
+            if not use_regex:
+                search_text = re.escape(search_text)
+            if match_case:
+                flags = 0
             else:
-                return ()
+                flags = re.IGNORECASE
+            self.pattern = re.compile(search_text, flags)
+
+        # Indices of the matching rows in ascending order, filled in by the
+        # SearchSentinel.
+        self.matches = array("I")
+
+        pattern = self.pattern
+        if isinstance(pattern, basestring):
+            len_search_text = len(pattern)
+
+            def match_func(model_row):
+
+                message = model_row[col_id]
+                if pattern in message:
+                    ranges = []
+                    start = 0
+                    while True:
+                        pos = message.find(pattern, start)
+                        if pos == -1:
+                            break
+                        ranges.append((pos, pos + len_search_text,))
+                        start = pos + len_search_text
+                    return ranges
+                else:
+                    return ()
+        else:
 
-        self.match_func = match_func
+            def match_func(model_row):
+
+                message = model_row[col_id]
+                return [match.span() for match in pattern.finditer(message)
+                        if match.end() > match.start()]
+
+        # Only the message column supports highlighting.
+        if col_id == GUI.models.LogModelBase.COL_MESSAGE:
+            self.match_func = match_func
+        else:
+            self.match_func = None
+
+        # Ranges of the log lines that can match, if the trigram index is
+        # built.  The index only knows about case sensitive substrings.
+        if isinstance(pattern, basestring):
+            self.line_ranges = model.get_trigram_index().get_candidates(
+                pattern)
+        else:
+            self.line_ranges = None
 
 
 class SearchSentinel (object):
@@ -66,10 +110,12 @@ class SearchSentinel (object):
 
         self.dispatcher = Common.Data.GSourceDispatcher()
         self.cancelled = False
+        self.operation = None
 
     def run_for(self, operation):
 
         self.dispatcher.cancel()
+        self.operation = operation
         self.dispatcher(self.__process(operation))
         self.cancelled = False
 
@@ -81,54 +127,49 @@ class SearchSentinel (object):
     def __process(self, operation):
 
         model = operation.model
-
-        if operation.start_position is not None:
-            start_pos = operation.start_position
-        elif operation.search_forward:
-            start_pos = 0
+        matches = operation.matches
+
+        # The lines of the log file are searched, and the matches mapped to
+        # rows of the (filtered) model.
+        n_rows = len(model)
+        to_super = model.line_index_to_super
+        if n_rows == 0:
+            ranges = []
         else:
-            start_pos = len(model) - 1
-
-        start_iter = model.iter_nth_child(None, start_pos)
-
-        match_func = operation.match_func
-        if operation.search_forward:
-            iter_next = model.iter_next
-        else:
-            # FIXME: This is really ugly.
-            nth_child = model.iter_nth_child
-
-            def iter_next_():
-                for i in xrange(start_pos, -1, -1):
-                    yield nth_child(None, i)
-                yield None
-            it_ = iter_next_()
-
-            def iter_next(it):
-                return it_.next()
-
-        YIELD_LIMIT = 1000
-        i = YIELD_LIMIT
-        tree_iter = start_iter
-        while tree_iter and not self.cancelled:
-            i -= 1
-            if i == 0:
+            ranges = [(to_super(0), to_super(n_rows - 1) + 1,)]
+
+        if ranges and operation.line_ranges is not None:
+            (first, last,), = ranges
+            ranges = [(max(start, first), min(stop, last),)
+                      for start, stop in operation.line_ranges
+                      if start < last and stop > first]
+
+        n_reported = 0
+        search = model.search_lines(operation.pattern, ranges,
+                                    col_id=operation.col_id)
+        for line_index in search:
+            if self.cancelled or self.operation is not operation:
+                # Aborted, or replaced by a new search from a match handler.
+                break
+            if line_index is None:
+                if len(matches) > n_reported:
+                    n_reported = len(matches)
+                    self.handle_matches_found(operation)
                 yield True
-                i = YIELD_LIMIT
-            row = model[tree_iter]
-            if match_func(row):
-                self.handle_match_found(model, tree_iter)
-            tree_iter = iter_next(tree_iter)
-
-        if not self.cancelled:
-            self.handle_search_complete()
+                continue
+            row_index = model.line_index_from_super(line_index)
+            if row_index < n_rows and to_super(row_index) == line_index:
+                matches.append(row_index)
+
+        if not self.cancelled and self.operation is operation:
+            self.handle_search_complete(operation)
         yield False
 
-    def handle_match_found(self, model, tree_iter):
+    def handle_matches_found(self, operation):
 
         pass
 
-    def handle_search_complete(self):
+    def handle_search_complete(self, operation):
 
         pass
 
@@ -136,7 +177,16 @@ class SearchSentinel (object):
 class FindBarWidget (Gtk.HBox):
 
     __status = {"no-match-found": _N("No match found"),
-                "searching": _N("Searching...")}
+                "searching": _N("Searching..."),
+                "invalid-pattern": _N("Invalid regular expression"),
+                # Only used for the size of the status label:
+                "match-count": _N("%i matches")}
+
+    # Columns that can be searched, the first one is the default.
+    search_columns = (GUI.columns.MessageColumn,
+                      GUI.columns.ObjectColumn,
+                      GUI.columns.CategoryColumn,
+                      GUI.columns.FunctionColumn,)
 
     def __init__(self, action_group):
 
@@ -158,6 +208,19 @@ class FindBarWidget (Gtk.HBox):
         next_button.set_related_action(next_action)
         self.pack_start(next_button, False, False, 0)
 
+        self.column_combo = Gtk.ComboBoxText()
+        for column_class in self.search_columns:
+            self.column_combo.append_text(column_class.label_header)
+        self.column_combo.props.active = 0
+        self.pack_start(self.column_combo, False, False, 2)
+
+        self.match_case_button = Gtk.CheckButton(label=_("Match case"))
+        self.match_case_button.props.active = True
+        self.pack_start(self.match_case_button, False, False, 2)
+
+        self.regex_button = Gtk.CheckButton(label=_("Regular expression"))
+        self.pack_start(self.regex_button, False, False, 2)
+
         self.status_label = Gtk.Label()
         self.status_label.props.xalign = 0.
         self.status_label.props.use_markup = True
@@ -186,6 +249,10 @@ class FindBarWidget (Gtk.HBox):
 
         self.__compute_status_size()
 
+    def get_search_column(self):
+
+        return self.search_columns[self.column_combo.props.active].id
+
     def __set_status(self, text):
 
         markup = "<b>%s</b>" % (GLib.markup_escape_text(text),)
@@ -200,6 +267,15 @@ class FindBarWidget (Gtk.HBox):
 
         self.__set_status(_(self.__status["searching"]))
 
+    def status_invalid_pattern(self):
+
+        self.__set_status(_(self.__status["invalid-pattern"]))
+
+    def status_match_count(self, n_matches):
+
+        self.__set_status(ngettext("%i match", "%i matches", n_matches) %
+                          (n_matches,))
+
     def clear_status(self):
 
         self.__set_status("")
@@ -227,15 +303,21 @@ class FindBarFeature (FeatureBase):
 
         self.bar = None
         self.operation = None
-        self.search_state = None
-        self.next_match = None
-        self.prev_match = None
+        # Row of the last match navigated to, the next and previous matches
+        # are looked up relative to it (or to search_start before that).
+        self.current_match = None
+        self.search_start = 0
         self.scroll_match = False
 
         self.sentinel = SearchSentinel()
-        self.sentinel.handle_match_found = self.handle_match_found
+        self.sentinel.handle_matches_found = self.handle_matches_found
         self.sentinel.handle_search_complete = self.handle_search_complete
 
+        # The trigram index is built in the background on the first search,
+        # searches only use it once it is ready.
+        self.index_dispatcher = Common.Data.GSourceDispatcher()
+        self.building_index = None
+
     def scroll_view_to_line(self, line_index):
 
         view = self.log_view
@@ -290,10 +372,22 @@ class FindBarFeature (FeatureBase):
         action.connect("activate", handler)
 
         self.bar.entry.connect("changed", self.handle_entry_changed)
+        self.bar.column_combo.connect("changed", self.handle_mode_changed)
+        self.bar.match_case_button.connect("toggled",
+                                           self.handle_mode_changed)
+        self.bar.regex_button.connect("toggled", self.handle_mode_changed)
+
+        # The matches are rows of the model, search again when it changes.
+        self.log_view.connect("notify::model",
+                              self.handle_log_view_notify_model)
 
     def handle_detach_window(self, window):
 
         self.window = None
+        self.sentinel.abort()
+        self.operation = None
+        self.index_dispatcher.cancel()
+        self.building_index = None
 
         window.ui_manager.remove_ui(self.merge_id)
         self.merge_id = None
@@ -305,188 +399,204 @@ class FindBarFeature (FeatureBase):
             self.bar.entry.grab_focus()
             self.update_search()
         else:
+            self.sentinel.abort()
+            self.operation = None
+            self.current_match = None
             try:
                 column = self.window.column_manager.find_item(
                     name="message")
                 del column.highlighters[self]
             except KeyError:
                 pass
+            self.window.set_search_matches(None, None)
             self.bar.clear_status()
             self.bar.hide()
-            for action_name in ["goto-next-search-result",
-                                "goto-previous-search-result"]:
-                self.action_group.get_action(
-                    action_name).props.sensitive = False
+            self.update_sensitivity()
 
     def handle_goto_previous_search_result_action_activate(self, action):
 
-        if self.prev_match is None:
+        line_index = self.get_previous_match()
+        if line_index is None:
             self.logger.warning("inconsistent action sensitivity")
             return
 
-        self.scroll_view_to_line(self.prev_match)
-        self.prev_match = None
-
-        start_path = self.log_view.get_visible_range()[0]
-        new_position = start_path[0] - 1
-        self.start_search_operation(start_position=new_position,
-                                    forward=False)
-
-        # FIXME
+        self.goto_match(line_index)
 
     def handle_goto_next_search_result_action_activate(self, action):
 
-        if self.next_match is None:
+        line_index = self.get_next_match()
+        if line_index is None:
             self.logger.warning("inconsistent action sensitivity")
             return
 
-        self.scroll_view_to_line(self.next_match)
-        self.next_match = None
-
-        end_path = self.log_view.get_visible_range()[1]
-        new_position = end_path[0] + 1
-        self.start_search_operation(start_position=new_position,
-                                    forward=True)
-        # FIXME: Finish.
+        self.goto_match(line_index)
 
-        # model = self.log_view.get_model ()
+    def handle_entry_changed(self, entry):
 
-        # start_path, end_path = self.log_view.get_visible_range ()
-        # start_index, end_index = start_path[0], end_path[0]
+        self.update_search()
 
-        # for line_index in self.matches:
-        # if line_index > end_index:
-        # break
-        # else:
-        # return
+    def handle_mode_changed(self, widget):
 
-        # self.scroll_view_to_line (line_index)
+        if self.bar.entry.props.text != "":
+            self.update_search()
 
-    def handle_entry_changed(self, entry):
+    def handle_log_view_notify_model(self, view, gparam):
 
-        self.update_search()
+        if self.bar.props.visible and self.bar.entry.props.text != "":
+            self.update_search()
 
     def update_search(self):
 
         model = self.log_view.get_model()
         search_text = self.bar.entry.props.text
         column = self.window.column_manager.find_item(name="message")
-        if search_text == "":
+
+        self.sentinel.abort()
+        self.operation = None
+        self.current_match = None
+        self.update_sensitivity()
+        try:
+            del column.highlighters[self]
+        except KeyError:
+            pass
+        self.window.set_search_matches(None, None)
+
+        if search_text == "" or model is None:
             self.logger.debug("search string set to '', aborting search")
-            self.search_state = None
-            self.next_match = None
-            self.prev_match = None
-            self.update_sensitivity()
-            self.sentinel.abort()
-            try:
-                del column.highlighters[self]
-            except KeyError:
-                pass
+            self.bar.clear_status()
+            if model is not None:
+                self.window.update_view()
+            return
+
+        self.build_index(model)
+        try:
+            operation = SearchOperation(
+                model, search_text,
+                match_case=self.bar.match_case_button.props.active,
+                use_regex=self.bar.regex_button.props.active,
+                col_id=self.bar.get_search_column())
+        except re.error as exc:
+            self.logger.debug("invalid search pattern %r: %s",
+                              search_text, exc)
+            self.bar.status_invalid_pattern()
         else:
             self.logger.debug("starting search for %r", search_text)
-            self.next_match = None
-            self.prev_match = None
-            self.update_sensitivity()
+            visible_range = self.log_view.get_visible_range()
+            if visible_range is None:
+                self.search_start = 0
+            else:
+                self.search_start = visible_range[0][0]
             self.scroll_match = True
-
-            start_path = self.log_view.get_visible_range()[0]
-            self.start_search_operation(
-                search_text, start_position=start_path[0])
+            self.operation = operation
+            self.sentinel.run_for(operation)
             self.bar.status_searching()
-            column.highlighters[self] = self.operation.match_func
+            if operation.match_func is not None:
+                column.highlighters[self] = operation.match_func
 
         self.window.update_view()
 
-    def update_sensitivity(self):
-
-        for name, value in (("goto-next-search-result", self.next_match,),
-                            ("goto-previous-search-result", self.prev_match,),):
-            action = self.action_group.get_action(name)
-            action.props.sensitive = (value is not None)
+    def handle_detach_log_file(self, window, log_file):
 
-    def start_search_operation(self, search_text=None, forward=True, start_position=None):
+        self.sentinel.abort()
+        self.operation = None
+        self.index_dispatcher.cancel()
+        self.building_index = None
 
-        model = self.log_view.get_model()
+    def build_index(self, model):
 
-        if forward:
-            self.search_state = "search-forward"
-            if start_position is None:
-                start_position = 0
-        else:
-            self.search_state = "search-backward"
-            if start_position is None:
-                start_position = len(model) - 1
-
-        if search_text is None:
-            operation = self.operation
-            if operation is None:
-                raise ValueError(
-                    "search_text not given but have no previous search operation")
-            search_text = operation.search_text
-
-        self.operation = SearchOperation(model, search_text,
-                                         start_position=start_position,
-                                         search_forward=forward)
-        self.sentinel.run_for(self.operation)
-
-    def handle_match_found(self, model, tree_iter):
-
-        if not self.search_state in ("search-forward", "search-backward",):
-            self.logger.warning(
-                "inconsistent search state %r", self.search_state)
+        index = model.get_trigram_index()
+        if index.ready or index is self.building_index:
             return
 
-        line_index = model.get_path(tree_iter)[0]
-        forward_search = (self.search_state == "search-forward")
+        self.logger.debug("building trigram index")
+        self.building_index = index
+        self.index_dispatcher(self.__build_index_process(index))
+
+    def __build_index_process(self, index):
+
+        for x in index.build():
+            yield True
 
-        if forward_search:
-            self.logger.debug("forward search for %r matches line %i",
-                              self.operation.search_text, line_index)
+        self.logger.debug("trigram index ready")
+        self.building_index = None
+        yield False
+
+    def get_next_match(self):
+
+        if self.operation is None:
+            return None
+
+        matches = self.operation.matches
+        if self.current_match is None:
+            pos = bisect_left(matches, self.search_start)
         else:
-            self.logger.debug("backward search for %r matches line %i",
-                              self.operation.search_text, line_index)
+            pos = bisect_right(matches, self.current_match)
 
-        self.sentinel.abort()
+        if pos < len(matches):
+            return matches[pos]
+        else:
+            return None
 
-        if self.scroll_match:
-            self.logger.debug("scrolling to matching line")
-            self.scroll_view_to_line(line_index)
-            # Now search for the next one:
-            self.scroll_match = False
-            # FIXME: Start with first line that is outside of the visible
-            # range.
-            self.start_search_operation(start_position=line_index + 1,
-                                        forward=forward_search)
+    def get_previous_match(self):
+
+        if self.operation is None:
+            return None
+
+        matches = self.operation.matches
+        if self.current_match is None:
+            pos = bisect_left(matches, self.search_start)
         else:
-            if forward_search:
-                self.next_match = line_index
+            pos = bisect_left(matches, self.current_match)
 
-                self.search_state = "search-backward"
-                self.start_search_operation(forward=False,
-                                            start_position=line_index - 1)
-            else:
-                self.prev_match = line_index
-                self.update_sensitivity()
-                self.bar.clear_status()
-
-    def handle_search_complete(self):
-
-        if self.search_state == "search-forward":
-            self.logger.debug("forward search for %r reached last line",
-                              self.operation.search_text)
-            self.next_match = None
-        elif self.search_state == "search-backward":
-            self.logger.debug("backward search for %r reached first line",
-                              self.operation.search_text)
-            self.prev_match = None
+        if pos > 0:
+            return matches[pos - 1]
         else:
-            self.logger.warning("inconsistent search state %r",
-                                self.search_state)
-            return
+            return None
+
+    def goto_match(self, line_index):
+
+        self.current_match = line_index
+        self.scroll_view_to_line(line_index)
+        self.update_sensitivity()
+
+    def update_sensitivity(self):
+
+        for name, value in (("goto-next-search-result",
+                             self.get_next_match(),),
+                            ("goto-previous-search-result",
+                             self.get_previous_match(),),):
+            action = self.action_group.get_action(name)
+            action.props.sensitive = (value is not None)
+
+    def handle_matches_found(self, operation):
+
+        self.logger.debug("search for %r has %i matches so far",
+                          operation.search_text, len(operation.matches))
+
+        if self.scroll_match:
+            line_index = self.get_next_match()
+            if line_index is not None:
+                self.logger.debug("scrolling to matching line")
+                self.scroll_match = False
+                self.goto_match(line_index)
+                return
+
+        self.update_sensitivity()
+
+    def handle_search_complete(self, operation):
+
+        n_matches = len(operation.matches)
+        self.logger.debug("search for %r complete, %i matches",
+                          operation.search_text, n_matches)
 
+        self.scroll_match = False
         self.update_sensitivity()
-        if self.prev_match is None and self.next_match is None:
+        if n_matches == 0:
             self.bar.status_no_match_found()
+        else:
+            self.bar.status_match_count(n_matches)
+
+        self.window.set_search_matches(operation.model, operation.matches)
 
 
 class Plugin (PluginBase):
@@ -20,6 +20,8 @@
 """GStreamer Debug Viewer timeline widget plugin."""
 
 import logging
+from array import array
+from bisect import bisect_left
 
 from GstDebugViewer import Common, Data
 from GstDebugViewer.GUI.colors import LevelColorThemeTango, ThreadColorThemeTango
@@ -32,15 +34,13 @@ from gi.repository import Gdk
 import cairo
 
 
-def iter_model_reversed(model):
-
-    count = model.iter_n_children(None)
-    for i in xrange(count - 1, 0, -1):
-        yield model[i]
-
-
 class LineFrequencySentinel (object):
 
+    """Counts the lines of the model in n_partitions partitions of its time
+    range.  If the model has a time pyramid, the line counts per level are
+    taken from it as well (level_counts), and the level distribution sentinel
+    does not need to look at the lines."""
+
     def __init__(self, model):
 
         self.model = model
@@ -53,26 +53,12 @@ class LineFrequencySentinel (object):
         self.partitions = None
         self.step = None
         self.ts_range = None
+        self.level_counts = None
 
     def _search_ts(self, target_ts, first_index, last_index):
 
-        model_get = self.model.get_value
-        model_iter_nth_child = self.model.iter_nth_child
-        col_id = self.model.COL_TIME
-
-        # TODO: Rewrite using a lightweight view object + bisect.
-
-        while True:
-            middle = (last_index - first_index) // 2 + first_index
-            if middle == first_index:
-                return first_index
-            ts = model_get(model_iter_nth_child(None, middle), col_id)
-            if ts < target_ts:
-                first_index = middle
-            elif ts > target_ts:
-                last_index = middle
-            else:
-                return middle
+        return bisect_left(self.model.line_times, target_ts,
+                           first_index, last_index)
 
     def run_for(self, n):
 
@@ -83,34 +69,23 @@ class LineFrequencySentinel (object):
 
     def process(self):
 
-        model = self.model
+        line_times = self.model.line_times
         result = []
         partitions = []
 
-        first_ts = None
-        for row in self.model:
-            first_ts = row[model.COL_TIME]
-            if first_ts is not None:
-                break
-
-        if first_ts is None:
+        if not len(line_times):
             return
 
-        last_ts = None
-        i = 0
-        UNPARSABLE_LIMIT = 500
-        for row in iter_model_reversed(self.model):
-            last_ts = row[model.COL_TIME]
-            # FIXME: We ignore 0 here (unparsable lines!), this should be
-            # handled differently!
-            i += 1
-            if i == UNPARSABLE_LIMIT:
-                break
-            if last_ts:
-                last_index = row.path[0]
-                break
+        first_ts = line_times[0]
+        last_index = len(line_times) - 1
+        last_ts = line_times[last_index]
+
+        if last_ts < first_ts:
+            return
 
-        if last_ts is None or last_ts < first_ts:
+        pyramid = self.model.get_time_pyramid()
+        if pyramid is not None:
+            self.__process_pyramid(pyramid, first_ts, last_ts)
             return
 
         step = int(float(last_ts - first_ts) / float(self.n_partitions))
@@ -142,6 +117,28 @@ class LineFrequencySentinel (object):
         self.partitions = partitions
         self.ts_range = (first_ts, last_ts,)
 
+    def __process_pyramid(self, pyramid, first_ts, last_ts):
+
+        step = float(last_ts - first_ts) / self.n_partitions
+        if step == 0:
+            level_counts = []
+        else:
+            level_counts = pyramid.get_counts(first_ts, last_ts,
+                                              self.n_partitions)
+
+        result = [sum(counts) for counts in level_counts]
+        partitions = []
+        found = 0
+        for count in result:
+            found += count
+            partitions.append(found)
+
+        self.step = step
+        self.data = result
+        self.partitions = partitions
+        self.level_counts = level_counts
+        self.ts_range = (first_ts, last_ts,)
+
 
 class LevelDistributionSentinel (object):
 
@@ -176,6 +173,10 @@ class LevelDistributionSentinel (object):
         if not partitions:
             return
 
+        if self.freq_sentinel.level_counts is not None:
+            data.extend(self.freq_sentinel.level_counts)
+            return
+
         level_index = 0
         level_iter = None
 
@@ -428,6 +429,36 @@ class VerticalTimelineWidget (Gtk.DrawingArea):
         self.queue_draw()
 
 
+def stack_level_counts(dist_data):
+    """Return the graph series of the levels drawn on top of the line
+    frequency, for the per level line counts of each partition in dist_data.
+    The series are (level, counts) pairs, where the counts of each level
+    include the ones of the levels below it, in drawing order."""
+
+    trace_series = []
+    fixme_series = []
+    log_series = []
+    debug_series = []
+    info_series = []
+    for counts in dist_data:
+        count = counts[Data.debug_level_trace]
+        trace_series.append(count)
+        count += counts[Data.debug_level_fixme]
+        fixme_series.append(count)
+        count += counts[Data.debug_level_log]
+        log_series.append(count)
+        count += counts[Data.debug_level_debug]
+        debug_series.append(count)
+        count += counts[Data.debug_level_info]
+        info_series.append(count)
+
+    return ((Data.debug_level_info, info_series,),
+            (Data.debug_level_debug, debug_series,),
+            (Data.debug_level_log, log_series,),
+            (Data.debug_level_fixme, fixme_series,),
+            (Data.debug_level_trace, trace_series,),)
+
+
 class TimelineWidget (Gtk.DrawingArea):
 
     __gtype_name__ = "GstDebugViewerTimelineWidget"
@@ -456,6 +487,13 @@ class TimelineWidget (Gtk.DrawingArea):
         self.__offscreen_dirty = (0, 0)
 
         self.__position_ts_range = None
+        self.__level_series = None
+
+        # Search matches shown in a density strip, and their counts per
+        # partition of the graph.
+        self.__match_model = None
+        self.__match_pyramid = None
+        self.__match_counts = None
 
         try:
             self.set_tooltip_text(_("Log event histogram\n"
@@ -470,11 +508,14 @@ class TimelineWidget (Gtk.DrawingArea):
             old_progress = self.__dist_sentinel_progress
             new_progress = len(sentinel.data)
             if new_progress - old_progress >= 32:
+                self.__level_series = None
                 self.__invalidate_offscreen(old_progress, new_progress)
                 self.__dist_sentinel_progress = new_progress
 
     def __handle_sentinel_finished(self, sentinel):
 
+        self.__level_series = None
+        self.__match_counts = None
         if sentinel == self.process.freq_sentinel:
             self.__invalidate_offscreen(0, -1)
         else:
@@ -565,11 +606,33 @@ class TimelineWidget (Gtk.DrawingArea):
     def clear(self):
 
         self.model = None
+        self.__level_series = None
+        self.__match_counts = None
         self.process.abort()
         self.process.freq_sentinel = None
         self.process.dist_sentinel = None
         self.__invalidate_offscreen(0, -1)
 
+    def update_matches(self, search_matches):
+        """Show the density of search matches as given by
+        Window.search_matches, a (model, rows) tuple or None."""
+
+        self.__match_model = None
+        self.__match_pyramid = None
+        self.__match_counts = None
+
+        if search_matches is not None:
+            model, rows = search_matches
+            line_times = model.line_times
+            times = array(Data.TIMES_TYPECODE,
+                          sorted(line_times[row] for row in rows))
+            pyramid = Data.TimePyramid()
+            pyramid.add(times, array("B", [0]) * len(times))
+            self.__match_model = model
+            self.__match_pyramid = pyramid
+
+        self.__invalidate_offscreen(0, -1)
+
     def update_position(self, start_ts, end_ts):
 
         if not self.process.freq_sentinel:
@@ -631,7 +694,7 @@ class TimelineWidget (Gtk.DrawingArea):
             y = i * 16 - .5
             ctx.move_to(0, y)
             ctx.line_to(width, y)
-            ctx.stroke()
+        ctx.stroke()
 
         if self.process.freq_sentinel is None:
             return
@@ -643,7 +706,7 @@ class TimelineWidget (Gtk.DrawingArea):
         for x in xrange(start + pixel_step, dirty_stop, pixel_step):
             ctx.move_to(x - .5, 0)
             ctx.line_to(x - .5, height)
-            ctx.stroke()
+        ctx.stroke()
 
         if not self.process.freq_sentinel.data:
             self.logger.debug("frequency sentinel has no data yet")
@@ -659,66 +722,92 @@ class TimelineWidget (Gtk.DrawingArea):
 
         if not self.process.dist_sentinel.data:
             self.logger.debug("level distribution sentinel has no data yet")
-            return
+        else:
+            self.__draw_levels(ctx, height, maximum, dirty_start, dirty_stop)
+
+        self.__draw_matches(ctx, height, dirty_start, dirty_stop)
+
+    def __draw_levels(self, ctx, height, maximum, dirty_start, dirty_stop):
 
         colors = LevelColorThemeTango().colors
-        dist_data = self.process.dist_sentinel.data[dirty_start:dirty_stop]
 
-        def cumulative_level_counts(*levels):
-            for level_counts in dist_data:
-                yield sum((level_counts[level] for level in levels))
-
-        level = Data.debug_level_info
-        levels_prev = (Data.debug_level_trace,
-                       Data.debug_level_fixme,
-                       Data.debug_level_log,
-                       Data.debug_level_debug,)
-        ctx.set_source_rgb(*(colors[level][1].float_tuple()))
-        self.__draw_graph(ctx, height, maximum,
-                          list(cumulative_level_counts(level, *levels_prev)))
-
-        level = Data.debug_level_debug
-        levels_prev = (Data.debug_level_trace,
-                       Data.debug_level_fixme,
-                       Data.debug_level_log,)
-        ctx.set_source_rgb(*(colors[level][1].float_tuple()))
-        self.__draw_graph(ctx, height, maximum,
-                          list(cumulative_level_counts(level, *levels_prev)))
-
-        level = Data.debug_level_log
-        levels_prev = (Data.debug_level_trace, Data.debug_level_fixme,)
-        ctx.set_source_rgb(*(colors[level][1].float_tuple()))
-        self.__draw_graph(ctx, height, maximum,
-                          list(cumulative_level_counts(level, *levels_prev)))
-
-        level = Data.debug_level_fixme
-        levels_prev = (Data.debug_level_trace,)
-        ctx.set_source_rgb(*(colors[level][1].float_tuple()))
-        self.__draw_graph(ctx, height, maximum,
-                          list(cumulative_level_counts(level, *levels_prev)))
-
-        level = Data.debug_level_trace
-        ctx.set_source_rgb(*(colors[level][1].float_tuple()))
-        self.__draw_graph(ctx, height, maximum, [
-                          counts[level] for counts in dist_data])
+        # Each level is drawn on top of the area of the ones stacked below.
+        for level, series in self.__get_level_series():
+            ctx.set_source_rgb(*(colors[level][1].float_tuple()))
+            self.__draw_graph(ctx, height, maximum,
+                              series[dirty_start:dirty_stop])
 
         # Draw error and warning triangle indicators:
 
-        def triangle(ctx, size=8):
-            ctx.move_to(-size // 2, 0)
-            ctx.line_to((size + 1) // 2, 0)
-            ctx.line_to(0, size / 1.41)
-            ctx.close_path()
-
+        dist_data = self.process.dist_sentinel.data[dirty_start:dirty_stop]
+        size = 8
         for level in (Data.debug_level_warning, Data.debug_level_error,):
             ctx.set_source_rgb(*(colors[level][1].float_tuple()))
             for i, counts in enumerate(dist_data):
                 if counts[level] == 0:
                     continue
-                ctx.translate(i, 0.)
-                triangle(ctx)
-                ctx.fill()
-                ctx.translate(-i, 0.)
+                ctx.move_to(i - size // 2, 0)
+                ctx.line_to(i + (size + 1) // 2, 0)
+                ctx.line_to(i, size / 1.41)
+                ctx.close_path()
+            ctx.fill()
+
+    def __draw_matches(self, ctx, height, dirty_start, dirty_stop):
+
+        counts = self.__get_match_counts()
+        if not counts:
+            return
+
+        maximum = max(counts)
+        if maximum == 0:
+            return
+
+        # A strip along the bottom edge, where partitions with more matches
+        # are drawn more opaque.  Each shade is filled once.
+        n_shades = 4
+        strip_height = 4
+        shades = [[] for i in range(n_shades)]
+        for i, count in enumerate(counts[dirty_start:dirty_stop]):
+            if count:
+                shades[(count * n_shades - 1) // maximum].append(i)
+
+        for shade, positions in enumerate(shades):
+            if not positions:
+                continue
+            ctx.set_source_rgba(.36, .21, .4, float(shade + 1) / n_shades)
+            for i in positions:
+                ctx.rectangle(i, height - strip_height, 1, strip_height)
+            ctx.fill()
+
+    def __get_match_counts(self):
+
+        # The number of search matches per partition of the frequency
+        # sentinel, computed once per data update.
+        if self.__match_counts is not None:
+            return self.__match_counts
+
+        freq_sentinel = self.process.freq_sentinel
+        if (self.__match_pyramid is None or
+                self.__match_model is not self.model or
+                not freq_sentinel.data):
+            return None
+
+        first_ts = freq_sentinel.ts_range[0]
+        n_partitions = len(freq_sentinel.data)
+        last_ts = int(first_ts + freq_sentinel.step * n_partitions)
+        self.__match_counts = [
+            sum(counts) for counts in
+            self.__match_pyramid.get_counts(first_ts, last_ts, n_partitions)]
+        return self.__match_counts
+
+    def __get_level_series(self):
+
+        # The stacked line counts of the levels drawn in the graph, computed
+        # once per data update of the level distribution sentinel.
+        if self.__level_series is None:
+            self.__level_series = stack_level_counts(
+                self.process.dist_sentinel.data)
+        return self.__level_series
 
     def __draw_graph(self, ctx, height, maximum, data):
 
@@ -964,6 +1053,10 @@ class AttachedWindow (object):
             return False
         GObject.idle_add(idle_update, priority=GObject.PRIORITY_LOW)
 
+    def handle_search_matches_changed(self):
+
+        self.timeline.update_matches(self.window.search_matches)
+
     def handle_log_view_adjustment_value_changed(self, adj):
 
         # FIXME: If not visible, disconnect this handler!
@@ -1076,6 +1169,11 @@ class TimelineFeature (FeatureBase):
         attached_window = self.attached_windows[window]
         attached_window.handle_detach_log_file(log_file)
 
+    def handle_search_matches_changed(self, window):
+
+        attached_window = self.attached_windows[window]
+        attached_window.handle_search_matches_changed()
+
 
 class TimelineState (Common.GUI.StateSection):
 
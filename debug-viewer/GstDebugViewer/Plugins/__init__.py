@@ -88,6 +88,13 @@ class FeatureBase (object):
 
         pass
 
+    def handle_search_matches_changed(self, window):
+        """
+        window: GstDebugViewer.GUI.window.Window
+        """
+
+        pass
+
 
 class PluginBase (object):
     """
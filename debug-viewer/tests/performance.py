@@ -40,6 +40,8 @@ class TestParsingPerformance (object):
 
         self.main_loop = GObject.MainLoop ()
         self.log_file = Data.LogFile (filename, Common.Data.DefaultDispatcher ())
+        # Measure parsing, not reading a saved index file.
+        self.log_file.line_cache.index_file = None
         self.log_file.consumers.append (self)
 
     def start (self):
@@ -68,11 +70,42 @@ class TestParsingPerformance (object):
         print "time spent in user mode: %.2f s" % (rusage.ru_utime,)
         print "time spent in system mode: %.2f s" % (rusage.ru_stime,)
 
+class TestScanningPerformance (object):
+
+    """Compares the line by line and the bulk scanning engine of LineCache."""
+
+    def __init__ (self, filename):
+
+        self.log_file = Data.LogFile (filename, Common.Data.DefaultDispatcher ())
+
+    def run (self):
+
+        saved = Data.LineCache.bulk_scan
+        try:
+            for bulk_scan in (False, True,):
+                Data.LineCache.bulk_scan = bulk_scan
+                # No index file, so the file is always scanned.
+                line_cache = Data.LineCache (self.log_file.fileobj,
+                                             Common.Data.DefaultDispatcher ())
+                start_time = time.time ()
+                line_cache.start_loading ()
+                diff = time.time () - start_time
+                if bulk_scan:
+                    name = "bulk"
+                else:
+                    name = "line by line"
+                print "%s scanning: %0.1f ms (%i lines)" % (name, diff * 1000.,
+                                                             len (line_cache.offsets),)
+        finally:
+            Data.LineCache.bulk_scan = saved
+
 def main ():
 
     if len (sys.argv) > 1:
         test = TestParsingPerformance (sys.argv[1])
         test.start ()
+        test = TestScanningPerformance (sys.argv[1])
+        test.run ()
 
 if __name__ == "__main__":
     main ()
@@ -0,0 +1,1335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; mode: python; -*-
+#
+#  GStreamer Debug Viewer - View and analyze GStreamer debug log files
+#
+#  Copyright (C) 2007 René Stadler <mail@renestadler.de>
+#
+#  This program is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU General Public License as published by the Free
+#  Software Foundation; either version 3 of the License, or (at your option)
+#  any later version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT
+#  ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#  FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+#  more details.
+#
+#  You should have received a copy of the GNU General Public License along with
+#  this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""GStreamer Debug Viewer test suite for the log file data layer."""
+
+import sys
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import threading
+
+sys.path.insert (0, os.path.join (sys.path[0], os.pardir))
+
+from unittest import TestCase, main as test_main
+
+from GstDebugViewer import Common, Data
+from GstDebugViewer.GUI.filters import (AndFilter, CategoryFilter,
+                                        DebugLevelFilter, Filter,
+                                        MessageFilter, NotFilter, OrFilter,
+                                        PidFilter, ThreadFilter,
+                                        TimeRangeFilter,)
+from GstDebugViewer.GUI.models import FilteredLogModel, LazyLogModel
+from GstDebugViewer.Plugins.Timeline import stack_level_counts
+
+def line_string (ts, thread, level, category, message):
+
+    return "%s %5d 0x%x %s %20s dummy.c:1:dummy:<obj> %s" % (Data.time_args (ts),
+                                                          12345, thread,
+                                                          level.name.ljust (5),
+                                                          category, message,)
+
+class LogFileTestCase (TestCase):
+
+    def setUp (self):
+
+        self.directory = tempfile.mkdtemp ()
+        self.path = os.path.join (self.directory, "test.log")
+
+        # Keep index files out of the user's cache directory:
+        self.saved_cache_home = os.environ.get ("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = os.path.join (self.directory, "cache")
+
+    def tearDown (self):
+
+        if self.saved_cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.saved_cache_home
+        shutil.rmtree (self.directory)
+
+    def write_log (self, lines):
+
+        f = open (self.path, "wb")
+        f.write ("".join ([line + "\n" for line in lines]))
+        f.close ()
+
+    def load (self):
+
+        log_file = Data.LogFile (self.path, Common.Data.DefaultDispatcher ())
+        log_file.start_loading ()
+        return log_file
+
+class TestLineIndexFile (LogFileTestCase):
+
+    def test_reload (self):
+
+        self.write_log ([line_string (i * 1000, 1, Data.debug_level_debug,
+                                      "GST_DUMMY", "message %i" % (i,))
+                         for i in range (100)])
+
+        log_file = self.load ()
+        offsets = list (log_file.line_cache.offsets)
+        levels = list (log_file.line_cache.levels)
+        self.assertEquals (len (offsets), 100)
+        self.assertTrue (os.path.exists (log_file.index_file.paths[0]))
+
+        index = log_file.index_file.load (log_file.fileobj)
+        self.assertNotEquals (index, None)
+        self.assertEquals (list (index[0]), offsets)
+        self.assertEquals (list (index[1]), levels)
+
+    def test_stale (self):
+
+        self.write_log ([line_string (0, 1, Data.debug_level_debug,
+                                      "GST_DUMMY", "first")])
+        self.load ()
+
+        self.write_log ([line_string (0, 1, Data.debug_level_debug,
+                                      "GST_DUMMY", "first"),
+                         line_string (1, 1, Data.debug_level_info,
+                                      "GST_DUMMY", "second")])
+        log_file = self.load ()
+        self.assertEquals (len (log_file.line_cache.offsets), 2)
+        self.assertEquals (list (log_file.line_cache.levels),
+                           [Data.debug_level_debug, Data.debug_level_info])
+
+    def test_location (self):
+
+        self.write_log ([line_string (0, 1, Data.debug_level_debug,
+                                      "GST_DUMMY", "first")])
+        sidecar_path = self.path + Data.LineIndexFile.suffix
+
+        log_file = self.load ()
+        cache_path = log_file.index_file.paths[0]
+        self.assertTrue (cache_path.startswith (os.environ["XDG_CACHE_HOME"]))
+        self.assertTrue (os.path.exists (cache_path))
+        self.assertFalse (os.path.exists (sidecar_path))
+
+        os.unlink (cache_path)
+        Data.LineIndexFile.next_to_log = True
+        try:
+            log_file = self.load ()
+        finally:
+            Data.LineIndexFile.next_to_log = False
+        self.assertEquals (log_file.index_file.paths[0], sidecar_path)
+        self.assertTrue (os.path.exists (sidecar_path))
+        self.assertFalse (os.path.exists (cache_path))
+
+class TestLineArrays (LogFileTestCase):
+
+    def test_types (self):
+
+        levels = [Data.debug_level_error, Data.debug_level_warning,
+                  Data.debug_level_info, Data.debug_level_debug,
+                  Data.debug_level_log,] * 2
+        self.write_log ([line_string (i * 1000, 1, level,
+                                      "GST_DUMMY", "message %i" % (i,))
+                         for i, level in enumerate (levels)])
+
+        for reload_ in (False, True,):
+            log_file = self.load ()
+            line_cache = log_file.line_cache
+            self.assertEquals (line_cache.offsets.typecode,
+                               Data.OFFSETS_TYPECODE)
+            self.assertEquals (line_cache.levels.typecode, "B")
+            self.assertEquals (list (line_cache.levels), map (int, levels))
+
+        offsets = line_cache.offsets[:]
+        offsets.append (1 << 40)
+        self.assertEquals (offsets[-1], 1 << 40)
+
+    def test_read_line (self):
+
+        self.write_log ([line_string (i * 1000, 1, Data.debug_level_info,
+                                      "GST_DUMMY", "message %i" % (i,))
+                         for i in range (3)])
+        f = open (self.path, "ab")
+        f.write ("unterminated")
+        f.close ()
+
+        log_file = self.load ()
+        offsets = log_file.line_cache.offsets
+        self.assertEquals (len (offsets), 3)
+        line = Data.read_line (log_file.fileobj, offsets[1])
+        self.assertTrue (line.endswith ("message 1\n"))
+        self.assertEquals (line.count ("\n"), 1)
+        self.assertEquals (Data.read_line (log_file.fileobj,
+                                           len (log_file.fileobj) - 12),
+                           "unterminated")
+
+class TestInterleavedLoad (LogFileTestCase):
+
+    def test_merge_threads (self):
+
+        # Four threads, each flushing blocks of three lines at a time.
+        lines = []
+        for block in range (50):
+            for thread in range (4):
+                for i in range (3):
+                    ts = (block * 12 + i * 4 + thread) * 1000
+                    lines.append (line_string (ts, thread, Data.debug_level_log,
+                                               "GST_DUMMY", "message"))
+        self.write_log (lines)
+
+        line_cache = Data.LineCache
+        saved = line_cache.merge_threads
+        try:
+            line_cache.merge_threads = False
+            log_file = self.load ()
+            offsets = list (log_file.line_cache.offsets)
+            os.unlink (log_file.index_file.paths[0])
+            line_cache.merge_threads = True
+            log_file = self.load ()
+        finally:
+            line_cache.merge_threads = saved
+
+        self.assertEquals (list (log_file.line_cache.offsets), offsets)
+        fileobj = log_file.fileobj
+        times = [fileobj[offset:offset + 18] for offset in offsets]
+        self.assertEquals (times, sorted (times))
+
+    def test_merge_yields (self):
+
+        self.write_log ([line_string ((i + 5) * 1000 - (i % 2) * 2500, i % 2,
+                                      Data.debug_level_log,
+                                      "GST_DUMMY", "message")
+                         for i in range (1000)])
+
+        class CountingDispatcher (Common.Data.DefaultDispatcher):
+
+            count = 0
+
+            def __call__ (self, iterator):
+
+                for x in iterator:
+                    self.count += 1
+
+        line_cache = Data.LineCache
+        saved = line_cache._lines_per_iteration
+        try:
+            line_cache._lines_per_iteration = 10
+            dispatcher = CountingDispatcher ()
+            log_file = Data.LogFile (self.path, dispatcher)
+            log_file.start_loading ()
+        finally:
+            line_cache._lines_per_iteration = saved
+
+        self.assertEquals (len (log_file.line_cache.offsets), 1000)
+        # Building the per-thread runs and merging them both yield every ten
+        # lines, the scan itself only a few times.
+        self.assertTrue (dispatcher.count > 1000 / 10 + 50)
+
+class TestParallelLoad (LogFileTestCase):
+
+    def test_same_result (self):
+
+        # Every fourth line is logged late by another thread.
+        self.write_log ([line_string (i * 1000 - (i % 4 == 3) * 2500, i % 4,
+                                      Data.debug_levels[i % 8],
+                                      "GST_DUMMY", "message %i" % (i,))
+                         for i in range (2000)])
+
+        log_file = self.load ()
+        offsets = list (log_file.line_cache.offsets)
+        levels = list (log_file.line_cache.levels)
+        os.unlink (log_file.index_file.paths[0])
+
+        line_cache = Data.LineCache
+        saved = (line_cache.jobs, line_cache._parallel_min_size,
+                 line_cache._parallel_chunk_size,)
+        try:
+            line_cache.jobs = 2
+            line_cache._parallel_min_size = 0
+            line_cache._parallel_chunk_size = 4096
+            log_file = self.load ()
+        finally:
+            (line_cache.jobs, line_cache._parallel_min_size,
+             line_cache._parallel_chunk_size,) = saved
+
+        self.assertEquals (list (log_file.line_cache.offsets), offsets)
+        self.assertEquals (list (log_file.line_cache.levels), levels)
+
+    def test_lagging_chunks (self):
+
+        # Chunks of the third block overlap the first one, but not the second
+        # one in between.
+        lines = []
+        for block, (first_ts, thread,) in enumerate (((0, 1,), (2000000, 1,),
+                                                      (505000, 2,),)):
+            lines.extend ([line_string (first_ts + i * 10000, thread,
+                                        Data.debug_level_info, "GST_DUMMY",
+                                        "message %i %i" % (block, i,))
+                           for i in range (100)])
+        self.write_log (lines)
+
+        log_file = self.load ()
+        offsets = list (log_file.line_cache.offsets)
+        times = list (log_file.line_cache.times)
+        self.assertEquals (times, sorted (times))
+        os.unlink (log_file.index_file.paths[0])
+
+        line_cache = Data.LineCache
+        saved = (line_cache.jobs, line_cache._parallel_min_size,
+                 line_cache._parallel_chunk_size,)
+        try:
+            line_cache.jobs = 2
+            line_cache._parallel_min_size = 0
+            line_cache._parallel_chunk_size = 2048
+            log_file = self.load ()
+        finally:
+            (line_cache.jobs, line_cache._parallel_min_size,
+             line_cache._parallel_chunk_size,) = saved
+
+        self.assertEquals (list (log_file.line_cache.times), times)
+        self.assertEquals (list (log_file.line_cache.offsets), offsets)
+
+    def test_abort (self):
+
+        import multiprocessing
+
+        self.write_log ([line_string (i * 1000, 1, Data.debug_level_info,
+                                      "GST_DUMMY", "message %i" % (i,))
+                         for i in range (100)])
+
+        class PendingDispatcher (Common.Data.Dispatcher):
+
+            def __call__ (self, iterator):
+                self.iterator = iterator
+
+        class FailingDispatcher (Common.Data.Dispatcher):
+
+            def __call__ (self, iterator):
+                raise RuntimeError ("cannot dispatch")
+
+        line_cache = Data.LineCache
+        saved = (line_cache.jobs, line_cache._parallel_min_size,)
+        try:
+            line_cache.jobs = 2
+            line_cache._parallel_min_size = 0
+
+            # The load process never ran:
+            log_file = Data.LogFile (self.path, PendingDispatcher ())
+            log_file.start_loading ()
+            self.assertNotEquals (multiprocessing.active_children (), [])
+            log_file.abort_loading ()
+            self.assertEquals (multiprocessing.active_children (), [])
+
+            log_file = Data.LogFile (self.path, FailingDispatcher ())
+            self.assertRaises (RuntimeError, log_file.start_loading)
+            self.assertEquals (multiprocessing.active_children (), [])
+        finally:
+            line_cache.jobs, line_cache._parallel_min_size = saved
+
+class TestScanning (LogFileTestCase):
+
+    def test_engines (self):
+
+        levels = (Data.debug_level_error, Data.debug_level_info,
+                  Data.debug_level_log, Data.debug_level_trace,)
+        lines = []
+        for i in range (300):
+            line = line_string (i * 1000, i % 3, levels[i % 4],
+                                "GST_DUMMY", "message %i" % (i,))
+            if i % 7 == 0:
+                lines.append ("continued message 0:00:00.000000000")
+            if 100 <= i < 150:
+                line = line.replace (" 0x", "\x1b[00m 0x")
+            lines.append (line)
+        self.write_log (lines)
+
+        line_cache = Data.LineCache
+        saved = (line_cache.bulk_scan, line_cache._scan_chunk_size,)
+        results = []
+        try:
+            line_cache._scan_chunk_size = 512
+            for bulk_scan in (False, True,):
+                line_cache.bulk_scan = bulk_scan
+                log_file = self.load ()
+                results.append ((list (log_file.line_cache.offsets),
+                                 list (log_file.line_cache.levels),
+                                 list (log_file.line_cache.times),))
+                os.unlink (log_file.index_file.paths[0])
+        finally:
+            line_cache.bulk_scan, line_cache._scan_chunk_size = saved
+
+        self.assertEquals (len (results[0][0]), 300)
+        self.assertEquals (results[0], results[1])
+
+class TestColouredLines (TestCase):
+
+    def test_strip_escape (self):
+
+        self.assertEquals (Data.strip_escape ("\x1b[31;01mERROR\x1b[00m x"),
+                           "ERROR x")
+        self.assertEquals (Data.strip_escape ("stray \x1b"), "stray \x1b")
+
+    def test_parse_full (self):
+
+        plain = line_string (1000, 1, Data.debug_level_error,
+                             "GST_DUMMY", "message")
+        coloured = ("0:00:00.000001000 \x1b[00m12345\x1b[00m 0x1 "
+                    "\x1b[31;01mERROR\x1b[00m \x1b[00m           GST_DUMMY "
+                    "dummy.c:1:dummy:<obj>\x1b[00m message")
+
+        for line_string_ in (plain, coloured,):
+            line = Data.LogLine.parse_full (line_string_)
+            self.assertEquals (line[:9], (1000, 12345, 1, 0, "GST_DUMMY",
+                                          "dummy.c", 1, "dummy", "obj",))
+            self.assertEquals (line_string_[line[9]:], "message")
+
+        line = Data.LogLine.parse_full (plain).with_message ("message",
+                                                             Data.debug_level_error)
+        self.assertTrue (isinstance (line, Data.LogLine))
+        self.assertEquals (line[3], Data.debug_level_error)
+        self.assertEquals (line[9], "message")
+        self.assertRaises (AttributeError, setattr, line, "extra", None)
+        self.assertEquals (Data.LogLine.parse_full ("garbage")[:],
+                           (0, 0, 0, 0, "", "", 0, "", "", 0,))
+        # Only valid without its escape sequences, which are not all between
+        # fields:
+        invalid = ("0:00:00.000001000 12345 0x1 ERROR           GST_DUMMY "
+                   "dummy.c:1:du\x1b[31mmmy:<obj> message \x1b[00mred\n")
+        self.assertEquals (Data.LogLine.parse_full (invalid)[:],
+                           (0, 0, 0, 0, "", "", 0, "", "", 0,))
+
+    def test_parse_lines (self):
+
+        lines = []
+        for i in range (100):
+            line = line_string (i * 1000, 1, Data.debug_level_info,
+                                "GST_DUMMY", "message %i" % (i,))
+            if i % 10 == 0:
+                line = line.replace (" 0x", "\x1b[00m 0x")
+            elif i % 10 == 5:
+                line = "invalid %i" % (i,)
+            lines.append (line + "\n")
+        data = "".join (lines)
+        offsets = [data.find (line_string_) for line_string_ in lines]
+
+        class FileObj (str):
+
+            def seek (self, offset):
+                self.position = offset
+
+            def readline (self):
+                return self[self.position:self.find ("\n", self.position) + 1]
+
+        fileobj = FileObj (data)
+        expected = []
+        for line_string_ in lines:
+            line = Data.LogLine.parse_full (line_string_)
+            expected.append (line.with_message (line_string_[line[-1]:]))
+
+        saved = Data._parse_lines_max_span
+        try:
+            for max_span in (saved, 0,):
+                Data._parse_lines_max_span = max_span
+                self.assertEquals (Data.parse_lines (fileobj, offsets), expected)
+                self.assertEquals (Data.parse_lines (fileobj, offsets[::7]),
+                                   expected[::7])
+        finally:
+            Data._parse_lines_max_span = saved
+
+        self.assertEquals (expected[10][9], "message 10\n")
+        self.assertEquals (expected[15][9], "invalid 15\n")
+
+class TestCompressedLoad (LogFileTestCase):
+
+    def setUp (self):
+
+        LogFileTestCase.setUp (self)
+
+        self.saved = (os.environ.get ("XDG_CACHE_HOME"), Data.BlockFile.block_size,)
+        os.environ["XDG_CACHE_HOME"] = self.directory
+        Data.BlockFile.block_size = 4096
+
+    def tearDown (self):
+
+        cache_home, Data.BlockFile.block_size = self.saved
+        if cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = cache_home
+
+        LogFileTestCase.tearDown (self)
+
+    def write_uncompressed (self):
+
+        self.write_log ([line_string (i * 1000, i % 2, Data.debug_level_info,
+                                      "GST_DUMMY", "message %i" % (i,))
+                         for i in range (1000)])
+        data = open (self.path, "rb").read ()
+        log_file = self.load ()
+        offsets = list (log_file.line_cache.offsets)
+
+        return data, offsets
+
+    def test_gzip (self):
+
+        import gzip
+
+        data, offsets = self.write_uncompressed ()
+
+        # Two members, as written by concatenating gzip files.
+        self.path += ".gz"
+        for part in (data[:len (data) // 2], data[len (data) // 2:],):
+            f = gzip.GzipFile (self.path, "ab")
+            f.write (part)
+            f.close ()
+
+        self.assertLoads (data, offsets)
+
+    def test_zstd (self):
+
+        import struct
+
+        try:
+            import zstandard
+        except ImportError:
+            self.skipTest ("zstandard module not available")
+
+        data, offsets = self.write_uncompressed ()
+
+        # A frame with its content size and checksum, a skippable frame and a
+        # streamed frame without content size.
+        third = len (data) // 3
+        compressor = zstandard.ZstdCompressor (write_checksum = True)
+        frames = [compressor.compress (data[:third]),
+                  struct.pack ("<II", 0x184d2a50, 3) + "abc"]
+        compressor = zstandard.ZstdCompressor (write_content_size = False)
+        compressobj = compressor.compressobj ()
+        frames.append (compressobj.compress (data[third:]) +
+                       compressobj.flush ())
+        self.path += ".zst"
+        f = open (self.path, "wb")
+        f.write ("".join (frames))
+        f.close ()
+
+        saved = Data.BlockFile._read_size
+        try:
+            # Split the frames into several pieces.
+            Data.BlockFile._read_size = 1024
+            self.assertLoads (data, offsets)
+        finally:
+            Data.BlockFile._read_size = saved
+
+    def assertLoads (self, data, offsets):
+
+        for i in range (2):
+            log_file = self.load ()
+            self.assertEquals (log_file.fileobj.ready, True)
+            self.assertEquals (len (log_file.fileobj), len (data))
+            self.assertEquals (log_file.fileobj[5000:9000], data[5000:9000])
+            self.assertEquals (list (log_file.line_cache.offsets), offsets)
+            self.assertEquals (log_file.lines[999][-1].strip (), "message 999")
+            log_file.fileobj.seek (0)
+            self.assertEquals ([Data.read_line (log_file.fileobj, offset)
+                                for offset in offsets],
+                               [line + "\n" for line in data.splitlines ()])
+            self.assertEquals (log_file.fileobj.tell (), 0)
+            os.unlink (log_file.index_file.paths[0])
+
+    def test_prune_cache (self):
+
+        import gzip
+
+        data, offsets = self.write_uncompressed ()
+        self.path += ".gz"
+        f = gzip.GzipFile (self.path, "wb")
+        f.write (data)
+        f.close ()
+        log_file = self.load ()
+        block_path = log_file.fileobj.path
+        index_path = log_file.index_file.paths[0]
+
+        # The index file was used last.
+        os.utime (block_path, (0, 0,))
+        index_size = os.path.getsize (index_path)
+        self.assertEquals (Data.prune_cache (index_size), 2)
+        self.assertFalse (os.path.exists (block_path))
+        self.assertTrue (os.path.exists (index_path))
+
+        self.assertEquals (Data.prune_cache (0, keep = (index_path,)), 0)
+        self.assertEquals (Data.prune_cache (0), 1)
+        self.assertEquals (os.listdir (os.path.dirname (index_path)), [])
+
+class TestFollow (LogFileTestCase):
+
+    def handle_lines_appended (self, start, stop):
+
+        self.appended.append ((start, stop,))
+
+    def test_update (self):
+
+        lines = [line_string (i * 1000, 1, Data.debug_level_info,
+                              "GST_DUMMY", "message %i" % (i,))
+                 for i in range (20)]
+        # The last line is still being written when loading.
+        f = open (self.path, "wb")
+        f.write ("".join ([line + "\n" for line in lines[:10]]) + lines[10][:20])
+        f.close ()
+
+        log_file = self.load ()
+        self.appended = []
+        log_file.consumers.append (self)
+        self.assertEquals (len (log_file.line_cache.offsets), 10)
+        self.assertEquals (log_file.update (), 0)
+
+        # Still no complete line, the old mapping stays usable.
+        old_fileobj = log_file.fileobj
+        f = open (self.path, "ab")
+        f.write (lines[10][20:21])
+        f.close ()
+        self.assertEquals (log_file.update (), 0)
+        self.assertEquals (old_fileobj[:4], log_file.fileobj[:4])
+
+        f = open (self.path, "ab")
+        f.write (lines[10][21:] + "\n" + "".join ([line + "\n" for line in lines[11:]]))
+        f.close ()
+
+        self.assertEquals (log_file.update (), 10)
+        self.assertEquals (self.appended, [(10, 20,)])
+        self.assertRaises (ValueError, old_fileobj.read_byte)
+        self.assertEquals (list (log_file.line_cache.times),
+                           [i * 1000 for i in range (20)])
+        self.assertEquals (log_file.lines[19][-1].strip (), "message 19")
+
+class TestColumnIndex (LogFileTestCase):
+
+    def test_build (self):
+
+        lines = [line_string (i * 1000, i % 3, Data.debug_level_info,
+                              "GST_CAT%i" % (i % 4,), "message %i" % (i,))
+                 for i in range (30)]
+        self.write_log (lines[:20])
+        log_file = self.load ()
+        column_index = log_file.get_column_index ()
+        for x in column_index.build ():
+            pass
+
+        self.assertEquals (column_index.ready, True)
+        self.assertEquals (len (column_index), 20)
+        self.assertEquals (list (column_index.pids), [12345] * 20)
+        self.assertEquals (list (column_index.threads),
+                           [i % 3 for i in range (20)])
+        codes = column_index.codes["category"]
+        self.assertEquals ([column_index.get_value ("category", code)
+                            for code in codes],
+                           ["GST_CAT%i" % (i % 4,) for i in range (20)])
+        self.assertEquals (column_index.get_code ("category", "GST_CAT1"),
+                           codes[1])
+        self.assertEquals (column_index.get_code ("category", "GST_NONE"), None)
+        self.assertEquals (set (column_index.codes["filename"]), set ([0]))
+        self.assertEquals (column_index.get_values ("object"), ["obj"])
+
+        self.write_log (lines)
+        self.assertEquals (log_file.update (), 10)
+        self.assertEquals (len (column_index), 30)
+        self.assertEquals (column_index.get_value ("category", codes[29]),
+                           "GST_CAT1")
+
+class TestFindLines (LogFileTestCase):
+
+    def test_find (self):
+
+        self.write_log ([line_string (i * 1000, 1, Data.debug_level_info,
+                                      "GST_CAT%i" % (i,), "message %i" % (i,))
+                         for i in range (20)])
+        log_file = self.load ()
+        offsets = log_file.line_cache.offsets
+
+        def find (text, ranges, backward=False):
+            return [line_index
+                    for line_index in Data.find_lines (log_file.fileobj,
+                                                       offsets, text, ranges,
+                                                       backward)
+                    if line_index is not None]
+
+        self.assertEquals (find ("message 1", [(0, 20,)]),
+                           [1] + range (10, 20))
+        self.assertEquals (find ("message 1", [(0, 5,), (15, 20,)], True),
+                           [19, 18, 17, 16, 15, 1])
+        # Only the message is searched:
+        self.assertEquals (find ("GST_CAT1", [(0, 20,)]), [])
+
+    def test_find_pattern (self):
+
+        self.write_log ([line_string (i * 1000, 1, Data.debug_level_info,
+                                      "GST_CAT%i" % (i,), "Message %i" % (i,))
+                         for i in range (20)])
+        log_file = self.load ()
+        offsets = log_file.line_cache.offsets
+
+        def find (pattern, column=-1):
+            return [line_index
+                    for line_index in Data.find_lines (log_file.fileobj,
+                                                       offsets, pattern,
+                                                       [(0, 20,)],
+                                                       column=column)
+                    if line_index is not None]
+
+        self.assertEquals (find (re.compile ("message 1[45]", re.I)),
+                           [14, 15])
+        # Anchors apply to the column, not to the line:
+        self.assertEquals (find (re.compile ("^Message 1$")), [1])
+        self.assertEquals (find (re.compile ("^GST_CAT1"), 4),
+                           [1] + range (10, 20))
+        self.assertEquals (find ("CAT2", 4), [2])
+
+    def test_raw_search_safe (self):
+
+        for text in ("message 1", "^$", "\\b(?=",):
+            self.assertTrue (Data._is_raw_search_safe (re.escape (text)))
+        for source in ("^message", "message$", "\\bmessage", "mess(?!x)",
+                       "\\\\\\Z",):
+            self.assertFalse (Data._is_raw_search_safe (source))
+
+class TestThreadedDispatcher (LogFileTestCase):
+
+    def test_load (self):
+
+        from gi.repository import GLib
+
+        self.write_log ([line_string (i * 1000, 1, Data.debug_level_info,
+                                      "GST_DUMMY", "message %i" % (i,))
+                         for i in range (100)])
+        log_file = self.load ()
+        offsets = list (log_file.line_cache.offsets)
+        os.unlink (log_file.index_file.paths[0])
+
+        loop = GLib.MainLoop ()
+
+        class Consumer (object):
+
+            def handle_load_started (self):
+                pass
+
+            def handle_load_finished (self):
+                loop.quit ()
+
+        log_file = Data.LogFile (self.path, Common.Data.ThreadedDispatcher ())
+        log_file.consumers.append (Consumer ())
+        log_file.start_loading ()
+        GLib.timeout_add_seconds (10, loop.quit)
+        loop.run ()
+
+        self.assertNotEquals (log_file.lines, None)
+        self.assertEquals (list (log_file.line_cache.offsets), offsets)
+
+    def test_error (self):
+
+        from gi.repository import GLib
+
+        loop = GLib.MainLoop ()
+        errors = []
+
+        def process ():
+            yield True
+            raise ValueError ("broken")
+
+        def handle_error (exc):
+            errors.append ((exc, threading.current_thread ().name,))
+            loop.quit ()
+
+        dispatcher = Common.Data.ThreadedDispatcher ()
+        dispatcher.handle_error = handle_error
+        dispatcher.logger.disabled = True
+        try:
+            dispatcher (process ())
+            GLib.timeout_add_seconds (10, loop.quit)
+            loop.run ()
+        finally:
+            dispatcher.logger.disabled = False
+
+        self.assertEquals (len (errors), 1)
+        exc, thread_name = errors[0]
+        self.assertTrue (isinstance (exc, ValueError))
+        self.assertEquals (thread_name, threading.current_thread ().name)
+
+class TestTrigramIndex (LogFileTestCase):
+
+    def test_candidates (self):
+
+        lines = [line_string (i * 1000, 1, Data.debug_level_info, "GST_DUMMY",
+                              "message %i" % (i,))
+                 for i in range (20)]
+        lines[5] = line_string (5000, 1, Data.debug_level_info, "GST_DUMMY",
+                                "needle found")
+        self.write_log (lines)
+        log_file = self.load ()
+        index = log_file.get_trigram_index ()
+        index.block_lines = 4
+        self.assertEquals (index.get_candidates ("needle"), None)
+        for x in index.build ():
+            pass
+
+        self.assertEquals (len (index), 20)
+        self.assertEquals (index.get_candidates ("needle"), [(4, 8,)])
+        self.assertEquals (index.get_candidates ("haystack"), [])
+        self.assertEquals (index.get_candidates ("message 1"), [(0, 20,)])
+        # Nothing to look up:
+        self.assertEquals (index.get_candidates ("ne"), None)
+
+        log_file = self.load ()
+        index = log_file.get_trigram_index ()
+        for x in index.build ():
+            pass
+        self.assertEquals (index.block_lines, 4)
+        self.assertEquals (index.get_candidates ("needle"), [(4, 8,)])
+
+        index_path = index.index_file.paths[0]
+        self.assertTrue (index_path.startswith (os.environ["XDG_CACHE_HOME"]))
+        self.assertTrue (os.path.exists (index_path))
+        self.assertFalse (os.path.exists (self.path +
+                                          Data.TrigramIndexFile.suffix))
+
+    def test_stale (self):
+
+        lines = [line_string (i * 1000, 1, Data.debug_level_info, "GST_DUMMY",
+                              "message %i" % (i,))
+                 for i in range (20)]
+        self.write_log (lines)
+        index = self.load ().get_trigram_index ()
+        index.block_lines = 4
+        for x in index.build ():
+            pass
+        self.assertEquals (index.get_candidates ("needle"), [])
+
+        lines[13] = line_string (13000, 1, Data.debug_level_info, "GST_DUMMY",
+                                 "needle found")
+        self.write_log (lines)
+        index = self.load ().get_trigram_index ()
+        index.block_lines = 4
+        for x in index.build ():
+            pass
+        self.assertEquals (index.get_candidates ("needle"), [(12, 16,)])
+
+    def test_common (self):
+
+        lines = [line_string (i * 1000, 1, Data.debug_level_info, "GST_DUMMY",
+                              "message %i" % (i,))
+                 for i in range (40)]
+        lines[5] = line_string (5000, 1, Data.debug_level_info, "GST_DUMMY",
+                                "needle message")
+        self.write_log (lines)
+
+        saved = Data.TrigramIndex._min_prune_blocks
+        try:
+            Data.TrigramIndex._min_prune_blocks = 4
+            for reload_ in (False, True,):
+                index = self.load ().get_trigram_index ()
+                index.block_lines = 4
+                for x in index.build ():
+                    pass
+
+                self.assertTrue (("m", "e", "s",) in index.common)
+                self.assertFalse (("m", "e", "s",) in index.postings)
+                self.assertFalse (("n", "e", "e",) in index.common)
+                for blocks in index.postings.values ():
+                    self.assertTrue (len (blocks) <= 5)
+                # Common trigrams match everywhere.
+                self.assertEquals (index.get_candidates ("message"), None)
+                self.assertEquals (index.get_candidates ("needle message"),
+                                   [(4, 8,)])
+        finally:
+            Data.TrigramIndex._min_prune_blocks = saved
+
+    def test_load_order (self):
+
+        # Every fourth line is logged late, with the same timestamp as lines
+        # of other threads further up.
+        lines = [line_string (5000 + (i // 4) * 1000 - (i % 4 == 3) * 3000,
+                              i % 4,
+                              Data.debug_level_info, "GST_DUMMY",
+                              "message %i" % (i,))
+                 for i in range (400)]
+        lines[201] = line_string (55000, 1, Data.debug_level_info,
+                                  "GST_DUMMY", "needle found")
+        self.write_log (lines)
+
+        log_file = self.load ()
+        offsets = list (log_file.line_cache.offsets)
+        index = log_file.get_trigram_index ()
+        index.block_lines = 4
+        for x in index.build ():
+            pass
+        candidates = index.get_candidates ("needle")
+        self.assertNotEquals (candidates, [])
+        self.assertEquals (len (offsets), 400)
+        os.unlink (log_file.index_file.paths[0])
+
+        line_cache = Data.LineCache
+        saved = (line_cache.jobs, line_cache._parallel_min_size,
+                 line_cache._parallel_chunk_size,)
+        try:
+            line_cache.jobs = 2
+            line_cache._parallel_min_size = 0
+            line_cache._parallel_chunk_size = 2048
+            log_file = self.load ()
+        finally:
+            (line_cache.jobs, line_cache._parallel_min_size,
+             line_cache._parallel_chunk_size,) = saved
+
+        self.assertEquals (list (log_file.line_cache.offsets), offsets)
+        index = log_file.get_trigram_index ()
+        for x in index.build ():
+            pass
+        # Loaded from the index file:
+        self.assertEquals (index.block_lines, 4)
+        self.assertEquals (index.get_candidates ("needle"), candidates)
+
+        # An index file of the lines in another order is not used.
+        log_file = self.load ()
+        offsets = log_file.line_cache.offsets
+        offsets[0], offsets[1] = offsets[1], offsets[0]
+        index = log_file.get_trigram_index ()
+        for x in index.build ():
+            pass
+        self.assertEquals (index.block_lines, Data.TrigramIndex.block_lines)
+
+class TestTimePyramid (TestCase):
+
+    def test_counts (self):
+
+        from array import array
+
+        times = array ("l", [i * 1000 for i in range (100)])
+        levels = array ("B", [Data.debug_level_info] * 50 +
+                        [Data.debug_level_error] * 50)
+        pyramid = Data.TimePyramid ()
+        pyramid.max_buckets = 16
+        pyramid.add (times, levels, 0, 60)
+        pyramid.add (times, levels, 60)
+
+        self.assertEquals (pyramid.n_lines, 100)
+        for level_counts in pyramid.counts:
+            self.assertEquals (sum (map (sum, level_counts)), 100)
+        self.assertEquals (pyramid.get_counts (0, 99000, 1),
+                           [(0, 50, 0, 50, 0, 0, 0, 0,)])
+        counts = pyramid.get_counts (0, 99000, 2)
+        self.assertEquals (sum (map (sum, counts)), 100)
+        self.assertEquals (counts[0][Data.debug_level_error], 0)
+        self.assertEquals (counts[1][Data.debug_level_info], 0)
+
+    def test_pieces (self):
+
+        from array import array
+
+        levels = [Data.debug_level_error, Data.debug_level_warning,
+                  Data.debug_level_info, Data.debug_level_debug,
+                  Data.debug_level_log,]
+        times = array ("l", [0, 0, 0, 3] + [i * i * 7 for i in range (2, 300)])
+        levels = array ("B", [levels[i % 5] for i in range (len (times))])
+
+        def build (splits):
+            pyramid = Data.TimePyramid ()
+            pyramid.max_buckets = 16
+            for start, stop in zip ([0] + splits, splits + [len (times)]):
+                pyramid.add (times, levels, start, stop)
+            return pyramid
+
+        pyramid = Data.TimePyramid ()
+        pyramid.add (times[:4], levels, 0, 3)
+        pyramid.add (times[:4], levels, 3)
+        self.assertEquals (pyramid.get_counts (0, 400, 1),
+                           [(0, 1, 1, 1, 1, 0, 0, 0,)])
+
+        whole = build ([])
+        for splits in ([3], [4, 5], range (1, len (times), 7),
+                       range (1, len (times)),):
+            pyramid = build (splits)
+            self.assertEquals (pyramid.shift, whole.shift)
+            self.assertEquals (pyramid.counts, whole.counts)
+            for k in range (len (pyramid.counts)):
+                # Partitions of 4 << k buckets use level k.
+                n = max (len (times) >> k, 1)
+                stop_ts = (4 << (whole.shift + k)) * n
+                self.assertEquals (pyramid.get_counts (0, stop_ts, n),
+                                   whole.get_counts (0, stop_ts, n))
+            for level_counts in pyramid.counts:
+                self.assertEquals (sum (map (sum, level_counts)), len (times))
+
+class TestTimelineSeries (TestCase):
+
+    def test_stack (self):
+
+        # Level counts (none, error, warn, info, debug, log, fixme, trace):
+        dist_data = [(0, 0, 0, 0, 0, 0, 0, 0,),
+                     (0, 1, 2, 3, 4, 5, 6, 7,),
+                     (0, 9, 9, 0, 1, 0, 0, 2,),]
+        series = stack_level_counts (dist_data)
+
+        self.assertEquals ([level for level, counts in series],
+                           [Data.debug_level_info, Data.debug_level_debug,
+                            Data.debug_level_log, Data.debug_level_fixme,
+                            Data.debug_level_trace,])
+        self.assertEquals (dict (series),
+                           {Data.debug_level_info: [0, 25, 3],
+                            Data.debug_level_debug: [0, 22, 3],
+                            Data.debug_level_log: [0, 18, 2],
+                            Data.debug_level_fixme: [0, 13, 2],
+                            Data.debug_level_trace: [0, 7, 2],})
+        self.assertEquals (stack_level_counts ([]),
+                           tuple ([(level, [],) for level, counts in series]))
+
+class TestLazyLogModel (LogFileTestCase):
+
+    def test_cache (self):
+
+        self.write_log ([line_string (i * 1000, 1, Data.debug_level_info,
+                                      "GST_DUMMY", "message %i" % (i,))
+                         for i in range (40)])
+        log_file = self.load ()
+        model = LazyLogModel (log_file)
+        model.cache_size = 10
+        offsets = model.line_offsets
+
+        model.prefetch (-5, 5)
+        self.assertEquals (model.get_cache_stats (), (5, 0, 5,))
+        model.prefetch (0, 5)
+        self.assertEquals (model.get_cache_stats (), (5, 5, 5,))
+        self.assertEquals (model.line_cache[offsets[3]],
+                           Data.LogLine.parse_full (Data.read_line (log_file.fileobj,
+                                                                    offsets[3])))
+
+        # A row that is used again survives the next generation change, the
+        # rows that are not used are evicted.
+        model.prefetch (5, 8)
+        model.ensure_cached (offsets[2])
+        self.assertEquals (model.get_cache_stats (), (8, 6, 8,))
+        model.prefetch (8, 13)
+        model.ensure_cached (offsets[2])
+        self.assertEquals (model.get_cache_stats ()[1:], (7, 13,))
+        model.ensure_cached (offsets[0])
+        self.assertEquals (model.get_cache_stats (), (6, 7, 14,))
+
+        model.prefetch (0, 40)
+        self.assertTrue (model.get_cache_stats ()[0] <= model.cache_size)
+
+        model.clear_cache ()
+        self.assertEquals (model.get_cache_stats ()[0], 0)
+
+class ParsingFilter (Filter):
+
+    """Wraps a filter so that only its filter_func is used."""
+
+    def __init__ (self, filter):
+
+        self.filter_func = filter.filter_func
+
+class TestFilteredLogModel (LogFileTestCase):
+
+    def make_lines (self, start, stop):
+
+        levels = [Data.debug_level_error, Data.debug_level_warning,
+                  Data.debug_level_info, Data.debug_level_debug,
+                  Data.debug_level_log,]
+        # (ts, thread, level, category, message) of each line:
+        return [(i * 1000, i % 3 + 1, levels[i % 5],
+                 "GST_CAT%i" % (i % 4,), "message %i" % (i,),)
+                for i in range (start, stop)]
+
+    def load_model (self, n_lines = 200):
+
+        self.lines = self.make_lines (0, n_lines)
+        self.write_log ([line_string (*line) for line in self.lines])
+        self.log_file = self.load ()
+        self.dispatcher = Common.Data.DefaultDispatcher ()
+        return LazyLogModel (self.log_file)
+
+    def assertLines (self, model, func, super_start = 0, super_stop = None):
+
+        if super_stop is None:
+            super_stop = len (self.lines)
+        expected = [i for i, line in enumerate (self.lines)
+                    if super_start <= i < super_stop and func (*line)]
+        offsets = self.log_file.line_cache.offsets
+        self.assertEquals (list (model.super_index), expected)
+        self.assertEquals (list (model.line_offsets),
+                           [offsets[i] for i in expected])
+        self.assertEquals (list (model.line_levels),
+                           [int (self.lines[i][2]) for i in expected])
+        self.assertEquals (list (model.line_times),
+                           [self.lines[i][0] for i in expected])
+
+    def test_compound (self):
+
+        model = self.load_model ()
+        warning = int (Data.debug_level_warning)
+        cases = [(OrFilter ([CategoryFilter ("GST_CAT1", True),
+                             DebugLevelFilter (Data.debug_level_warning,
+                                               DebugLevelFilter.this_and_above)]),
+                  lambda ts, thread, level, category, message:
+                      category == "GST_CAT1" or int (level) < warning),
+                 (AndFilter ([NotFilter (ThreadFilter (2)),
+                              TimeRangeFilter (50000, 150000)]),
+                  lambda ts, thread, level, category, message:
+                      thread == 2 and 50000 <= ts < 150000),
+                 (AndFilter ([MessageFilter (re.compile ("7$")),
+                              NotFilter (CategoryFilter ("GST_CAT0"))]),
+                  lambda ts, thread, level, category, message:
+                      not message.endswith ("7") and category == "GST_CAT0"),
+                 (NotFilter (OrFilter ([])),
+                  lambda ts, thread, level, category, message: True),
+                 (AndFilter ([DebugLevelFilter (Data.debug_level_log),
+                              OrFilter ([])]),
+                  lambda ts, thread, level, category, message: False),]
+
+        for filter, func in cases:
+            filtered = FilteredLogModel (model)
+            filtered.add_filter (filter, self.dispatcher)
+            self.assertLines (filtered, func)
+            if filter.index_columns is not None:
+                filtered = FilteredLogModel (model)
+                filtered.add_filter (ParsingFilter (filter), self.dispatcher)
+                self.assertLines (filtered, func)
+
+    def test_remove_filter (self):
+
+        model = self.load_model ()
+        log = int (Data.debug_level_log)
+        filters = [CategoryFilter ("GST_CAT1"),
+                   MessageFilter (re.compile ("5")),
+                   DebugLevelFilter (Data.debug_level_log),
+                   TimeRangeFilter (0, 180000),]
+        funcs = [lambda ts, thread, level, category, message:
+                     category != "GST_CAT1",
+                 lambda ts, thread, level, category, message:
+                     "5" not in message,
+                 lambda ts, thread, level, category, message:
+                     int (level) != log,
+                 lambda ts, thread, level, category, message:
+                     ts < 180000,]
+
+        def all_funcs (funcs):
+            return lambda *line: all ([func (*line) for func in funcs])
+
+        for super_range in ((0, len (self.lines),), (10, 190,),):
+            for position in range (len (filters)):
+                filtered = FilteredLogModel (model)
+                for filter in filters:
+                    filtered.add_filter (filter, self.dispatcher)
+                filtered.set_range (*super_range)
+                self.assertLines (filtered, all_funcs (funcs), *super_range)
+
+                filtered.remove_filter (filters[position], self.dispatcher)
+                remaining = funcs[:position] + funcs[position + 1:]
+                self.assertLines (filtered, all_funcs (remaining), *super_range)
+                self.assertEquals (filtered.filters,
+                                   filters[:position] + filters[position + 1:])
+
+                filtered.remove_filter (filtered.filters[-1], self.dispatcher)
+                self.assertLines (filtered, all_funcs (remaining[:-1]),
+                                  *super_range)
+
+                # The lines rejected by the removed filters are shown again
+                # when widening the range.
+                filtered.set_range (0, len (self.lines))
+                self.assertLines (filtered, all_funcs (remaining[:-1]))
+
+                for filter in list (filtered.filters):
+                    filtered.remove_filter (filter, self.dispatcher)
+                self.assertLines (filtered, all_funcs ([]))
+                self.assertEquals (len (filtered), len (model))
+
+        # Filters added after restricting the range only see the lines in it.
+        filtered = FilteredLogModel (model)
+        filtered.add_filter (filters[0], self.dispatcher)
+        filtered.set_range (10, 190)
+        filtered.add_filter (filters[1], self.dispatcher)
+        filtered.remove_filter (filters[0], self.dispatcher)
+        self.assertLines (filtered, funcs[1], 10, 190)
+        filtered.set_range (0, len (self.lines))
+        self.assertLines (filtered, funcs[1])
+
+    def test_set_range (self):
+
+        model = self.load_model ()
+
+        calls = []
+        message_filter = MessageFilter (re.compile ("5"))
+        message_func = message_filter.filter_func
+        def counting_func (row):
+            calls.append (row[LazyLogModel.COL_TIME])
+            return message_func (row)
+        message_filter.filter_func = counting_func
+
+        cases = [([], lambda *line: True,),
+                 ([CategoryFilter ("GST_CAT1"), message_filter],
+                  lambda ts, thread, level, category, message:
+                      category != "GST_CAT1" and "5" not in message,),]
+
+        for filters, func in cases:
+            # The filters only run on the lines in the restricted range.
+            filtered = FilteredLogModel (model)
+            filtered.set_range (50, 150)
+            for filter in filters:
+                filtered.add_filter (filter, self.dispatcher)
+
+            for super_range in ((50, 150,), (60, 140,), (40, 140,), (40, 170,),
+                                (0, 200,), (100, 101,), (90, 110,),):
+                del calls[:]
+                filtered.set_range (*super_range)
+                self.assertLines (filtered, func, *super_range)
+                if filters and super_range == (40, 170,):
+                    # Only the lines that became visible were filtered.
+                    self.assertEquals (sorted (calls),
+                                       [self.lines[i][0]
+                                        for i in range (150, 170)
+                                        if self.lines[i][3] != "GST_CAT1"])
+                self.assertEquals (filtered.line_index_from_super (
+                        filtered.super_index[0]), 0)
+
+    def test_column_filters (self):
+
+        model = self.load_model ()
+        cases = [(PidFilter (12345), lambda *line: False,),
+                 (PidFilter (12345, True), lambda *line: True,),
+                 (PidFilter (1), lambda *line: True,),
+                 (ThreadFilter (2),
+                  lambda ts, thread, level, category, message: thread != 2,),
+                 (ThreadFilter (3, True),
+                  lambda ts, thread, level, category, message: thread == 3,),
+                 (ThreadFilter (4), lambda *line: True,),
+                 (TimeRangeFilter (10000, 20000),
+                  lambda ts, thread, level, category, message:
+                      10000 <= ts < 20000,),
+                 (TimeRangeFilter (20000, 10000), lambda *line: False,),]
+
+        for filter, func in cases:
+            for filter in (filter, ParsingFilter (filter),):
+                filtered = FilteredLogModel (model)
+                filtered.add_filter (filter, self.dispatcher)
+                self.assertLines (filtered, func)
+
+    def test_parallel (self):
+
+        class StepDispatcher (Common.Data.Dispatcher):
+
+            def __call__ (self, iterator):
+
+                self.iterator = iterator
+
+            def cancel (self):
+
+                self.iterator = None
+
+        model = self.load_model ()
+        filter = MessageFilter (re.compile ("[24]"))
+        func = lambda ts, thread, level, category, message: \
+            "2" not in message and "4" not in message
+
+        filtered = FilteredLogModel (model)
+        filtered.jobs = 2
+        filtered._parallel_min_lines = 0
+        filtered._parallel_chunk_size = 30
+
+        # The first chunks are added while the others are still filtered.
+        dispatcher = StepDispatcher ()
+        filtered.add_filter (filter, dispatcher)
+        dispatcher.iterator.next ()
+        while not len (filtered):
+            dispatcher.iterator.next ()
+        self.assertTrue (filtered.is_streaming ())
+        self.assertTrue (filtered.super_index[-1] < 30)
+        filtered.abort_process ()
+        self.assertEquals (filtered.filters, [])
+        self.assertFalse (filtered.is_streaming ())
+        self.assertLines (filtered, lambda *line: True)
+
+        filtered.add_filter (filter, self.dispatcher)
+        self.assertLines (filtered, func)
+        filtered.add_filter (ThreadFilter (1), self.dispatcher)
+        filtered.remove_filter (filter, self.dispatcher)
+        self.assertLines (filtered,
+                          lambda ts, thread, level, category, message:
+                              thread != 1)
+
+    def handle_lines_appended (self, start, stop):
+
+        self.model.append_lines (start, stop)
+        self.filtered.super_lines_appended (start, stop)
+
+    def test_append (self):
+
+        filters = [CategoryFilter ("GST_CAT1"), MessageFilter (re.compile ("5"))]
+        filters_func = lambda ts, thread, level, category, message: \
+            category != "GST_CAT1" and "5" not in message
+        cases = [([], lambda *line: True, None,),
+                 (filters[:1],
+                  lambda ts, thread, level, category, message:
+                      category != "GST_CAT1", None,),
+                 (filters, filters_func, None,),
+                 # A single line before appending:
+                 ([OrFilter ([TimeRangeFilter (0, 1000),
+                              TimeRangeFilter (120000, 200000)])],
+                  lambda ts, thread, level, category, message:
+                      ts < 1000 or ts >= 120000, None,),
+                 ([], lambda *line: True, (20, 120,),),
+                 ([], lambda *line: True, (20, 60,),),
+                 (filters, filters_func, (20, 120,),),
+                 (filters, filters_func, (20, 60,),),]
+
+        for filters, func, super_range in cases:
+            self.model = self.load_model (120)
+            self.filtered = FilteredLogModel (self.model)
+            for filter in filters:
+                self.filtered.add_filter (filter, self.dispatcher)
+            if super_range is not None:
+                self.filtered.set_range (*super_range)
+            # Updated when adding the lines:
+            self.filtered.get_time_pyramid ()
+            self.log_file.consumers.append (self)
+
+            new_lines = self.make_lines (120, 200)
+            f = open (self.path, "ab")
+            f.write ("".join ([line_string (*line) + "\n"
+                               for line in new_lines]))
+            f.close ()
+            self.assertEquals (self.log_file.update (), 80)
+            self.lines.extend (new_lines)
+
+            if super_range is None:
+                super_range = (0, 200,)
+            elif super_range[1] == 120:
+                # The new lines are shown if the range reached the end.
+                super_range = (super_range[0], 200,)
+            self.assertLines (self.filtered, func, *super_range)
+
+            refiltered = FilteredLogModel (self.model)
+            for filter in filters:
+                refiltered.add_filter (filter, self.dispatcher)
+            refiltered.set_range (*super_range)
+            self.assertLines (refiltered, func, *super_range)
+
+            expected = Data.TimePyramid ()
+            expected.add (refiltered.line_times, refiltered.line_levels)
+            pyramid = self.filtered.get_time_pyramid ()
+            self.assertEquals (pyramid.n_lines, len (refiltered))
+            self.assertEquals (pyramid.counts, expected.counts)
+            for n in (1, 7, 200,):
+                self.assertEquals (pyramid.get_counts (0, 200000, n),
+                                   expected.get_counts (0, 200000, n))
+
+if __name__ == "__main__":
+    test_main ()
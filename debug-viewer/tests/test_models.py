@@ -79,6 +79,7 @@ class Model (LogModelBase):
         for i in range (20):
             self.line_offsets.append (i * 100)
             self.line_levels.append (Data.debug_level_debug)
+            self.line_times.append (0)
 
     def ensure_cached (self, line_offset):
 